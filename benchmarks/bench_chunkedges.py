@@ -0,0 +1,56 @@
+"""
+Benchmark the chunk planning of grouped operations on halo catalogs.
+
+Draws halo lengths from a power law resembling the halo length distribution of TNG50
+(about a million halos, the largest with 1e8 particles, sorted by length) and plans the
+chunks with map_group_operation_get_chunkedges for different target task counts. Task
+times are modelled by the planner's cost model, i.e. particles plus a fixed cost per halo.
+The makespan is the longest task relative to an ideal distribution of the total cost.
+
+Usage: python benchmarks/bench_chunkedges.py [--nhalos 1000000] [--ntasks 8 64 512]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from scida.customs.arepo.dataset import map_group_operation_get_chunkedges
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nhalos", type=int, default=1_000_000)
+    parser.add_argument("--lmax", type=int, default=100_000_000)
+    parser.add_argument("--cpucost-halo", type=float, default=1e4)
+    parser.add_argument("--ntasks", type=int, nargs="+", default=[8, 64, 512])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    lengths = np.minimum((32 * (1 + rng.pareto(0.9, size=args.nhalos))).astype(np.int64), args.lmax)
+    lengths = np.sort(lengths)[::-1]
+    cost = lengths + args.cpucost_halo
+    sumcost = np.concatenate([[0.0], np.cumsum(cost)])
+    entry_nbytes_in = 12  # e.g. float32 coordinates
+    print("%i halos, %i particles, largest halo %i" % (lengths.shape[0], lengths.sum(), lengths.max()))
+    for ntasks in args.ntasks:
+        t0 = time.perf_counter()
+        edges = map_group_operation_get_chunkedges(
+            lengths, entry_nbytes_in, 8, cpucost_halo=args.cpucost_halo, ntasks=ntasks
+        )
+        dt = time.perf_counter() - t0
+        taskcost = sumcost[edges[:, 1]] - sumcost[edges[:, 0]]
+        print(
+            "ntasks %i: %i chunks planned in %.1f ms, makespan %.2f of ideal, task cost std/mean %.2f"
+            % (
+                ntasks,
+                edges.shape[0],
+                dt * 1e3,
+                taskcost.max() / max(sumcost[-1] / ntasks, cost.max()),
+                taskcost.std() / taskcost.mean(),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Benchmark the assignment of halo indices to particles ordered by halo membership.
+
+Compares the numba loop (get_hidx) to the vectorized implementation (get_hidx_vectorized)
+used for GroupID/SubhaloID and group quantities of particles, for a block of particles
+with random halo lengths and a tail of unbound particles.
+
+Usage: python benchmarks/bench_hidx.py [--npart 10000000] [--nhalos 100000] [--repeat 5]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from scida.customs.arepo.dataset import get_hidx, get_hidx_vectorized
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t0)
+    return np.median(timings) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--npart", type=int, default=10_000_000)
+    parser.add_argument("--nhalos", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    # heavy-tailed halo lengths, about 80% of particles bound
+    lengths = rng.pareto(1.5, size=args.nhalos) + 1.0
+    lengths = np.floor(lengths / lengths.sum() * 0.8 * args.npart).astype(np.int64)
+    celloffsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    get_hidx(0, 1, celloffsets)  # trigger compilation
+    ref = get_hidx(0, args.npart, celloffsets)
+    res = get_hidx_vectorized(0, args.npart, celloffsets)
+    assert np.array_equal(ref, res)
+
+    t_numba = timeit(lambda: get_hidx(0, args.npart, celloffsets), args.repeat)
+    t_vec = timeit(lambda: get_hidx_vectorized(0, args.npart, celloffsets), args.repeat)
+    print("get_hidx (numba): %i particles, %i halos, median %.1f ms" % (args.npart, args.nhalos, t_numba))
+    print("get_hidx_vectorized: %i particles, %i halos, median %.1f ms" % (args.npart, args.nhalos, t_vec))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark the registration of lazy fields when opening a HDF5 file.
+
+Creates a synthetic snapshot-like HDF5 file with many groups and fields and times
+scida.io.load_datadict_old, i.e. the part of opening a dataset that scales with
+the number of datasets in the file.
+
+Usage: python benchmarks/bench_load_datadict.py [--ngroups 6] [--nfields 50] [--repeat 20]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from scida.helpers_hdf5 import walk_hdf5file
+from scida.io import load_datadict_old
+
+
+def write_testfile(path, ngroups, nfields, npart=16):
+    """Write a file with 'ngroups' groups holding 'nfields' datasets each."""
+    with h5py.File(path, "w") as hf:
+        grp = hf.create_group("Header")
+        grp.attrs["NumPart_ThisFile"] = np.full(ngroups, npart)
+        for i in range(ngroups):
+            grp = hf.create_group("PartType%i" % i)
+            for j in range(nfields):
+                grp.create_dataset("Field%i" % j, data=np.zeros((npart, 3) if j % 2 else npart))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ngroups", type=int, default=6)
+    parser.add_argument("--nfields", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "bench.hdf5")
+        write_testfile(path, args.ngroups, args.nfields)
+        with h5py.File(path, "r") as hf:
+            tree = walk_hdf5file(path, {})
+            timings = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                load_datadict_old(path, hf, chunksize="auto", tree=tree)
+                timings.append(time.perf_counter() - t0)
+    timings = np.array(timings) * 1e3
+    ndatasets = args.ngroups * args.nfields
+    print(
+        "load_datadict_old: %i datasets, median %.2f ms (min %.2f ms), %.1f us per dataset"
+        % (ndatasets, np.median(timings), timings.min(), np.median(timings) * 1e3 / ndatasets)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -70,6 +70,28 @@ def get_config(reload: bool = False, update_global=True) -> dict:
     return config
 
 
+def get_config_flag(key: str, default: bool = False) -> bool:
+    """
+    Get a boolean option from the configuration.
+    Options set via environment variables are strings, which are interpreted here.
+
+    Parameters
+    ----------
+    key: str
+        The configuration key.
+    default: bool
+        The value if the key is not set.
+
+    Returns
+    -------
+    bool
+    """
+    val = get_config().get(key, default)
+    if isinstance(val, str):
+        return val.strip().lower() in ("1", "true", "yes", "on")
+    return bool(val)
+
+
 def combine_configs(configs: List[Dict], mode="overwrite_keys") -> Dict:
     """
     Combine multiple configurations recursively.
@@ -73,6 +73,24 @@ class MTNGArepoSnapshot(ArepoSnapshot):
                 del self.mostbound.data[k]
         self.merge_data(self.mostbound, fieldname_suffix="_mostbound")
 
+    @classmethod
+    def check_fingerprint(cls, fingerprint: dict) -> bool:
+        """
+        Prune paths that cannot be valid for this dataset class.
+
+        Parameters
+        ----------
+        fingerprint: dict
+            Fingerprint of the path, see scida.discovertypes.get_fingerprint.
+
+        Returns
+        -------
+        bool
+        """
+        if not super().check_fingerprint(fingerprint):
+            return False
+        return fingerprint["attrs"] is None or "/Config" in fingerprint["attrs"]
+
     @classmethod
     def validate_path(cls, path: Union[str, os.PathLike], *args, **kwargs) -> CandidateStatus:
         """
@@ -141,6 +159,24 @@ class MTNGArepoCatalog(ArepoCatalog):
         kwargs["choose_prefix"] = True
         super().__init__(*args, **kwargs)
 
+    @classmethod
+    def check_fingerprint(cls, fingerprint: dict) -> bool:
+        """
+        Prune paths that cannot be valid for this dataset class.
+
+        Parameters
+        ----------
+        fingerprint: dict
+            Fingerprint of the path, see scida.discovertypes.get_fingerprint.
+
+        Returns
+        -------
+        bool
+        """
+        if not super().check_fingerprint(fingerprint):
+            return False
+        return fingerprint["attrs"] is None or "/Config" in fingerprint["attrs"]
+
     @classmethod
     def validate_path(cls, path: Union[str, os.PathLike], *args, **kwargs) -> CandidateStatus:
         """
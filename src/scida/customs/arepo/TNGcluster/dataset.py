@@ -225,6 +225,24 @@ class TNGClusterSnapshot(ArepoSnapshot):
         """
         return super().return_data()
 
+    @classmethod
+    def check_fingerprint(cls, fingerprint: dict) -> bool:
+        """
+        Prune paths that cannot be valid for this dataset class.
+
+        Parameters
+        ----------
+        fingerprint: dict
+            Fingerprint of the path, see scida.discovertypes.get_fingerprint.
+
+        Returns
+        -------
+        bool
+        """
+        if not super().check_fingerprint(fingerprint):
+            return False
+        return fingerprint["attrs"] is None or "/Parameters" in fingerprint["attrs"]
+
     @classmethod
     def validate_path(cls, path: str | os.PathLike, *args, **kwargs) -> CandidateStatus:
         """
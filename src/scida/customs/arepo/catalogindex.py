@@ -0,0 +1,243 @@
+"""
+Persisted index of the group and subhalo membership of particles in Arepo snapshots.
+
+Particles in Arepo snapshots are ordered by halo and subhalo membership. The membership of all
+particles of a type can thus be stored as a run-length encoding with one run per subhalo, per
+halo's inner fuzz and for the unbound particles at the end. The index is stored as sidecar in
+the cache directory and keyed by the snapshot, the catalog and the state of their files.
+"""
+
+import hashlib
+import logging
+import os
+from typing import Optional
+
+import h5py
+import numpy as np
+
+from scida.helpers_hdf5 import get_filestats
+from scida.misc import get_pathfiles, return_cachefile_path
+
+log = logging.getLogger(__name__)
+
+_version = 1
+_fields = ["GroupID", "SubhaloID", "LocalSubhaloID"]
+
+
+def get_catalogindex_path(snappath, catalogpath, npart, kind="particles") -> Optional[str]:
+    """
+    Return the path of the sidecar index for a snapshot and its catalog.
+
+    Parameters
+    ----------
+    snappath: str
+        Path to the snapshot.
+    catalogpath: str
+        Path to the group catalog.
+    npart: dict
+        Number of particles for each particle type.
+    kind: str
+        Kind of index, "particles" for the particle membership or "subhalos" for the subhalo offset table.
+
+    Returns
+    -------
+    Optional[str]
+        Path of the index in the cache directory, None if there is no cache directory.
+    """
+    sha = hashlib.sha256()
+    sha.update(str(_version).encode())
+    for path in [snappath, catalogpath]:
+        files = get_pathfiles(path)
+        mtimes, sizes = get_filestats(files)
+        sha.update(os.path.realpath(path).encode())
+        sha.update("".join(files).encode())
+        sha.update(mtimes.tobytes())
+        sha.update(sizes.tobytes())
+    sha.update(str(sorted(npart.items())).encode())
+    if kind != "particles":
+        sha.update(kind.encode())
+    return return_cachefile_path(os.path.join("catalogindex", sha.hexdigest()[:32] + ".hdf5"))
+
+
+def get_subhalocounts(subhalogrnr, ngroups):
+    """
+    Get the index of the first subhalo and the number of subhalos for each halo.
+
+    Parameters
+    ----------
+    subhalogrnr: np.ndarray
+        The halo index of each subhalo, sorted.
+    ngroups: int
+        Number of halos.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        first subhalo (-1 if none) and number of subhalos per halo
+    """
+    subhalogrnr = np.asarray(subhalogrnr, dtype=np.int64)
+    nsubs = np.bincount(subhalogrnr, minlength=ngroups).astype(np.int64)
+    firstsub = np.searchsorted(subhalogrnr, np.arange(ngroups), side="left").astype(np.int64)
+    firstsub[nsubs == 0] = -1
+    return firstsub, nsubs
+
+
+def get_subhalooffsettype(grouplentype, subhalolentype, subhalogrnr) -> np.ndarray:
+    """
+    Get the particle offsets of all subhalos for all particle types.
+
+    Parameters
+    ----------
+    grouplentype: np.ndarray
+        Number of particles per type in each halo, shape (Ngroups, 6).
+    subhalolentype: np.ndarray
+        Number of particles per type in each subhalo, shape (Nsubhalos, 6).
+    subhalogrnr: np.ndarray
+        Halo index of each subhalo. Subhalos need to be ordered by their halo.
+
+    Returns
+    -------
+    np.ndarray
+        Index of the first particle of each type in each subhalo, shape (Nsubhalos, 6).
+    """
+    grouplentype = np.asarray(grouplentype, dtype=np.int64).reshape(-1, 6)
+    subhalolentype = np.asarray(subhalolentype, dtype=np.int64).reshape(-1, 6)
+    subhalogrnr = np.asarray(subhalogrnr, dtype=np.int64)
+    goffsets = np.zeros_like(grouplentype)
+    np.cumsum(grouplentype[:-1], axis=0, out=goffsets[1:])
+    shoffsets = np.zeros_like(subhalolentype)
+    np.cumsum(subhalolentype[:-1], axis=0, out=shoffsets[1:])
+    firstsub, _ = get_subhalocounts(subhalogrnr, grouplentype.shape[0])
+    # subhalos start at their halo's offset, followed by the preceding subhalos of the same halo
+    return goffsets[subhalogrnr] + shoffsets - shoffsets[firstsub[subhalogrnr]]
+
+
+def build_catalogindex(grouplentype, subhalolentype, subhalogrnr, npart, index_unbound=None) -> dict:
+    """
+    Build the run-length encoded group and subhalo membership of particles.
+
+    Parameters
+    ----------
+    grouplentype: np.ndarray
+        Number of particles per type in each halo, shape (Ngroups, 6).
+    subhalolentype: np.ndarray
+        Number of particles per type in each subhalo, shape (Nsubhalos, 6).
+    subhalogrnr: np.ndarray
+        Halo index of each subhalo. Subhalos need to be ordered by their halo.
+    npart: dict
+        Number of particles for each particle type to index, e.g. {"PartType0": 1000}.
+    index_unbound: Optional[int]
+        Index to use for particles not belonging to a halo/subhalo. Default: maximum int64 value.
+
+    Returns
+    -------
+    dict
+        "GroupFirstSub"/"GroupNsubs" arrays and for each particle type a dictionary with the
+        run lengths ("RunLength"), the run values of "GroupID", "SubhaloID" and "LocalSubhaloID",
+        the lengths of halos ("GroupLength") and subhalos ("SubhaloLength") and the particle
+        offsets of subhalos ("SubhaloOffset").
+    """
+    if index_unbound is None:
+        index_unbound = np.iinfo(np.int64).max
+    grouplentype = np.asarray(grouplentype, dtype=np.int64)
+    subhalolentype = np.asarray(subhalolentype, dtype=np.int64).reshape(-1, 6)
+    subhalogrnr = np.asarray(subhalogrnr, dtype=np.int64)
+    ngroups, nsubs = grouplentype.shape[0], subhalogrnr.shape[0]
+    firstsub, groupnsubs = get_subhalocounts(subhalogrnr, ngroups)
+
+    shidx = np.arange(nsubs, dtype=np.int64)
+    gidx = np.arange(ngroups, dtype=np.int64)
+    unbound_sub = np.full(ngroups, index_unbound, dtype=np.int64)
+    # one run per subhalo followed by one fuzz run per halo; stable sort keeps the subhalo order
+    rungroup = np.concatenate([subhalogrnr, gidx])
+    order = np.lexsort((np.repeat([0, 1], [nsubs, ngroups]), rungroup))
+    runsub = np.concatenate([shidx, unbound_sub])[order]
+    runlocal = np.concatenate([shidx - firstsub[subhalogrnr], unbound_sub])[order]
+    rungroup = rungroup[order]
+    issubrun = runsub != index_unbound
+
+    result = dict(GroupFirstSub=firstsub, GroupNsubs=groupnsubs)
+    for ptype, n in npart.items():
+        num = int(ptype[-1])
+        glen = grouplentype[:, num]
+        shlen = subhalolentype[:, num]
+        fuzzlen = glen - np.bincount(subhalogrnr, weights=shlen, minlength=ngroups).astype(np.int64)
+        runlen = np.concatenate([shlen, fuzzlen])[order]
+        runoffsets = np.concatenate([[0], np.cumsum(runlen)])
+        shoffsets = runoffsets[:-1][issubrun]
+        nbound = int(runoffsets[-1])
+        if nbound > n:
+            raise ValueError("Catalog assigns %i particles of type '%s', but only %i exist." % (nbound, ptype, n))
+        # drop empty runs and add the run of unbound particles
+        keep = runlen > 0
+        d = dict(
+            RunLength=np.append(runlen[keep], n - nbound),
+            GroupID=np.append(rungroup[keep], index_unbound),
+            SubhaloID=np.append(runsub[keep], index_unbound),
+            LocalSubhaloID=np.append(runlocal[keep], index_unbound),
+            GroupLength=glen,
+            SubhaloLength=shlen,
+            SubhaloOffset=shoffsets,
+        )
+        result[ptype] = d
+    return result
+
+
+def write_catalogindex(path, index) -> None:
+    """
+    Write a catalog index as returned by build_catalogindex to a HDF5 file.
+
+    Parameters
+    ----------
+    path: str
+        Path of the HDF5 file.
+    index: dict
+        The catalog index.
+
+    Returns
+    -------
+    None
+    """
+    tmppath = "%s.%i.tmp" % (path, os.getpid())
+    with h5py.File(tmppath, "w") as hf:
+        hf.attrs["version"] = _version
+        for k, v in index.items():
+            if isinstance(v, dict):
+                grp = hf.create_group(k)
+                for field, arr in v.items():
+                    grp.create_dataset(field, data=arr)
+            else:
+                hf.create_dataset(k, data=v)
+    os.replace(tmppath, path)  # other processes never see partially written files
+
+
+def read_catalogindex(path) -> Optional[dict]:
+    """
+    Read a catalog index written by write_catalogindex.
+
+    Parameters
+    ----------
+    path: str
+        Path of the HDF5 file.
+
+    Returns
+    -------
+    Optional[dict]
+        The catalog index or None if it does not exist or cannot be read.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with h5py.File(path, "r") as hf:
+            if hf.attrs.get("version", -1) != _version:
+                return None
+            index = dict()
+            for k, v in hf.items():
+                if isinstance(v, h5py.Group):
+                    index[k] = {field: arr[()] for field, arr in v.items()}
+                else:
+                    index[k] = v[()]
+    except OSError as e:
+        log.warning("Could not read catalog index '%s': %s", path, e)
+        return None
+    return index
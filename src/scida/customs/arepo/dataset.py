@@ -1,32 +1,54 @@
 import copy
+import functools
+import hashlib
+import inspect
 import logging
 import os
 from typing import Dict, List, Optional, Union
 
 import dask
+import h5py
 import numpy as np
 import pint
 from dask import array as da
 from dask import delayed
 from numba import jit
+from numba.extending import is_jitted
 from numpy.typing import NDArray
 
+from scida.config import get_config_flag
+from scida.customs.arepo.catalogindex import (
+    build_catalogindex,
+    get_catalogindex_path,
+    get_subhalooffsettype,
+    read_catalogindex,
+    write_catalogindex,
+)
 from scida.customs.arepo.extra_fields import fielddefs
+from scida.customs.arepo.groupexport import (
+    GroupExport,
+    get_groupexport_fingerprint,
+    get_groupexport_indexpath,
+    get_groupexport_path,
+    write_groupfile,
+)
 from scida.customs.arepo.helpers import grp_type_str, part_type_num
 from scida.customs.arepo.selector import ArepoSelector
 from scida.customs.gadgetstyle.dataset import GadgetStyleSnapshot
 from scida.discovertypes import CandidateStatus, _determine_mixins
-from scida.fields import FieldContainer
+from scida.fields import FieldContainer, FieldType
 from scida.helpers_misc import (
     computedecorator,
     get_args,
     get_kwargs,
+    get_nworkers,
     map_blocks,
     parse_humansize,
 )
 from scida.interface import create_datasetclass_with_mixins
 from scida.interfaces.mixins import CosmologyMixin, SpatialCartesian3DMixin, UnitMixin
 from scida.io import load_metadata
+from scida.misc import return_cachefile_path, take_ranges
 
 log = logging.getLogger(__name__)
 
@@ -65,6 +87,10 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
         self._subhalolengths = {}
         # not needed for group catalogs as entries are back-to-back there, we will provide a property for this
         self._subhalooffsets = {}
+        self._grouptables = None
+        self._subhalotables = None
+        self._groupalignedviews = {}
+        self._groupexports = {}
         self.misc = {}  # for storing misc info
         prfx = kwargs.pop("fileprefix", None)
         if prfx is None:
@@ -191,6 +217,16 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
             if len(ngkeys) > 0:
                 self.add_catalogIDs()
 
+        sh = self.data["Subhalo"] if "Subhalo" in self.data else None
+        if sh is not None and "SubhaloLenType" in sh and "SubhaloOffsetType" not in sh:
+
+            def SubhaloOffsetType(arrs, **kwargs):
+                return da.from_array(self.get_subhalotables()[0])
+
+            self.data.register_field(
+                "Subhalo", name="SubhaloOffsetType", description="Index of the first particle of each type."
+            )(SubhaloOffsetType)
+
         # merge hints from snap and catalog
         self.merge_hints(self.catalog)
 
@@ -330,6 +366,10 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
 
         index_unbound = self.misc["unboundID"]
 
+        if "Subhalo" in self.data and get_config_flag("persist_catalog_index"):
+            self.add_catalogIDs_from_index()
+            return
+
         for key in self.data:
             if not (key.startswith("PartType")):
                 continue
@@ -368,9 +408,9 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
             # if not provided, we calculate:
             # "GroupFirstSub": First subhalo index for each halo
             # "GroupNsubs": Number of subhalos for each halo
-            dlyd = delayed(get_shcounts_shcells)(subhalogrnr, ngrp)
-            grp["GroupFirstSub"] = dask.compute(dlyd[1])[0]
-            grp["GroupNsubs"] = dask.compute(dlyd[0])[0]
+            dlyd = delayed(get_shcounts_shcells, nout=2)(subhalogrnr, ngrp)
+            grp["GroupFirstSub"] = da.from_delayed(dlyd[1], shape=(ngrp,), dtype=np.int64)
+            grp["GroupNsubs"] = da.from_delayed(dlyd[0], shape=(ngrp,), dtype=np.int64)
 
         # remove "units" for numba funcs
         grpfirstsub = grp["GroupFirstSub"]
@@ -412,8 +452,11 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
 
             # calculate first subhalo of each halo that a particle belongs to
             self.add_groupquantity_to_particles("GroupFirstSub", parttype=key)
-            pdata["SubhaloID"] = pdata["GroupFirstSub"] + pdata["LocalSubhaloID"]
-            pdata["SubhaloID"] = da.where(pdata["SubhaloID"] == index_unbound, index_unbound, pdata["SubhaloID"])
+            pdata["SubhaloID"] = da.where(
+                pdata["LocalSubhaloID"] == index_unbound,
+                index_unbound,
+                pdata["GroupFirstSub"] + pdata["LocalSubhaloID"],
+            )
 
         # add GroupID and SubhaloID to catalogs/groups themselves
         self.data["Group"]["GroupID"] = self.data["Group"]["uid"]
@@ -429,6 +472,8 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
         nmax=None,
         idxlist=None,
         objtype="halo",
+        ntasks=None,
+        gap_tolerance=None,
     ):
         """
         Apply a function to each halo in the catalog.
@@ -449,6 +494,10 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
         chunksize_bytes: Optional[int]
         nmax: Optional[int]
             Only process the first nmax halos.
+        ntasks: Optional[int]
+            Target number of dask tasks. Defaults to the number of workers of the current scheduler.
+        gap_tolerance: Optional[int]
+            Maximum number of particles between halos in idxlist to read for processing them in the same task.
 
         Returns
         -------
@@ -481,8 +530,60 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
             entry_nbytes_in=entry_nbytes_in,
             nmax=nmax,
             idxlist=idxlist,
+            ntasks=ntasks,
+            gap_tolerance=gap_tolerance,
         )
 
+    def add_catalogIDs_from_index(self) -> None:
+        """
+        Add fields for halo and subgroup IDs for all particle types from the persisted catalog index.
+        The index is built from the catalog and stored in the cache directory if it does not exist yet.
+
+        Returns
+        -------
+        None
+        """
+        index_unbound = self.misc["unboundID"]
+        npart = dict()
+        for key in self.data:
+            if key.startswith("PartType") and "uid" in self.data[key]:
+                npart[key] = self.data[key]["uid"].shape[0]
+
+        path = get_catalogindex_path(self.path, self.catalog.path, npart)
+        index = read_catalogindex(path)
+        if index is None:
+            grp, sh = self.data["Group"], self.data["Subhalo"]
+            shnr_attr = "SubhaloGrNr" if "SubhaloGrNr" in sh else "SubhaloGroupNr"  # latter for MTNG
+            if shnr_attr not in sh:
+                raise ValueError(f"Could not find 'SubhaloGrNr' or 'SubhaloGroupNr' in {self.catalog}")
+            arrs = dask.compute(grp["GroupLenType"], sh["SubhaloLenType"], sh[shnr_attr])
+            arrs = [arr.magnitude if hasattr(arr, "magnitude") else arr for arr in arrs]
+            index = build_catalogindex(*arrs, npart, index_unbound=index_unbound)
+            if path is not None:
+                log.info("Writing catalog index to '%s'.", path)
+                write_catalogindex(path, index)
+        else:
+            log.debug("Read catalog index from '%s'.", path)
+
+        grp = self.data["Group"]
+        for name in ["GroupFirstSub", "GroupNsubs"]:
+            if name not in grp:
+                grp[name] = da.from_array(index[name])
+        for key in npart:
+            pdata = self.data[key]
+            d = index[key]
+            runoffsets = da.from_array(np.concatenate([[0], np.cumsum(d["RunLength"])]), chunks=-1)
+            gidx = pdata["uid"]
+            for name in ["GroupID", "SubhaloID", "LocalSubhaloID"]:
+                pdata[name] = compute_haloquantity(gidx, runoffsets, da.from_array(d[name], chunks=-1))
+            self._grouplengths[key] = d["GroupLength"]
+            self._subhalolengths[key] = d["SubhaloLength"]
+            self._subhalooffsets[key] = d["SubhaloOffset"]
+            self.add_groupquantity_to_particles("GroupFirstSub", parttype=key)
+
+        self.data["Group"]["GroupID"] = self.data["Group"]["uid"]
+        self.data["Subhalo"]["SubhaloID"] = self.data["Subhalo"]["uid"]
+
     def add_groupquantity_to_particles(self, name, parttype="PartType0"):
         """
         Map a quantity from the group catalog to the particles based on a particle's group index.
@@ -529,10 +630,7 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
         pnum = part_type_num(parttype)
         ptype = "PartType%i" % pnum
         if ptype not in self._grouplengths:
-            lengths = self.data["Group"]["GroupLenType"][:, pnum].compute()
-            if isinstance(lengths, pint.Quantity):
-                lengths = lengths.magnitude
-            self._grouplengths[ptype] = lengths
+            self._grouplengths[ptype] = np.ascontiguousarray(self.get_grouptables()[1][:, pnum])
         return self._grouplengths[ptype]
 
     def get_groupoffsets(self, parttype="PartType0"):
@@ -559,6 +657,59 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
         offsets = {k: np.concatenate([[0], np.cumsum(v)[:-1]]) for k, v in lengths.items()}
         return offsets
 
+    def get_grouptables(self):
+        """
+        Get the particle offsets and lengths of all halos for all particle types.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            offsets and lengths of shape (Ngroups, 6)
+        """
+        if self._grouptables is None:
+            lengths = self.data["Group"]["GroupLenType"].compute()
+            if isinstance(lengths, pint.Quantity):
+                lengths = lengths.magnitude
+            lengths = np.asarray(lengths, dtype=np.int64).reshape(-1, 6)
+            offsets = np.zeros_like(lengths)
+            np.cumsum(lengths[:-1], axis=0, out=offsets[1:])
+            self._grouptables = (offsets, lengths)
+        return self._grouptables
+
+    def get_subhalotables(self):
+        """
+        Get the particle offsets and lengths of all subhalos for all particle types.
+        The tables are computed in one pass and cached, and optionally persisted next to the
+        catalog index (config option "persist_catalog_index").
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            offsets and lengths of shape (Nsubhalos, 6)
+        """
+        if self._subhalotables is not None:
+            return self._subhalotables
+        path = None
+        if get_config_flag("persist_catalog_index") and hasattr(self.catalog, "path"):
+            path = get_catalogindex_path(self.path, self.catalog.path, dict(), kind="subhalos")
+        tables = read_catalogindex(path)
+        if tables is None:
+            grp, sh = self.data["Group"], self.data["Subhalo"]
+            shnr_attr = "SubhaloGrNr" if "SubhaloGrNr" in sh else "SubhaloGroupNr"  # latter for MTNG
+            if shnr_attr not in sh:
+                raise ValueError(f"Could not find 'SubhaloGrNr' or 'SubhaloGroupNr' in {self.catalog}")
+            arrs = dask.compute(grp["GroupLenType"], sh["SubhaloLenType"], sh[shnr_attr])
+            arrs = [arr.magnitude if hasattr(arr, "magnitude") else arr for arr in arrs]
+            tables = dict(
+                SubhaloOffsetType=get_subhalooffsettype(*arrs),
+                SubhaloLenType=np.asarray(arrs[1], dtype=np.int64).reshape(-1, 6),
+            )
+            if path is not None:
+                log.info("Writing subhalo offset table to '%s'.", path)
+                write_catalogindex(path, tables)
+        self._subhalotables = (tables["SubhaloOffsetType"], tables["SubhaloLenType"])
+        return self._subhalotables
+
     def get_subhalolengths(self, parttype="PartType0"):
         """
         Get the lengths, i.e. the total number of particles, of a given type in all subhalos.
@@ -573,12 +724,8 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
         """
         pnum = part_type_num(parttype)
         ptype = "PartType%i" % pnum
-        if ptype in self._subhalolengths:
-            return self._subhalolengths[ptype]
-        lengths = self.data["Subhalo"]["SubhaloLenType"][:, pnum].compute()
-        if isinstance(lengths, pint.Quantity):
-            lengths = lengths.magnitude
-        self._subhalolengths[ptype] = lengths
+        if ptype not in self._subhalolengths:
+            self._subhalolengths[ptype] = np.ascontiguousarray(self.get_subhalotables()[1][:, pnum])
         return self._subhalolengths[ptype]
 
     def get_subhalooffsets(self, parttype="PartType0"):
@@ -596,35 +743,169 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
 
         pnum = part_type_num(parttype)
         ptype = "PartType%i" % pnum
-        if ptype in self._subhalooffsets:
-            return self._subhalooffsets[ptype]  # use cached result
-        goffsets = self.get_groupoffsets(ptype)
-        shgrnr = self.data["Subhalo"]["SubhaloGrNr"]
-        # calculate the index of the first particle for the central subhalo of each subhalos's parent halo
-        shoffset_central = goffsets[shgrnr]
+        if ptype not in self._subhalooffsets:
+            self._subhalooffsets[ptype] = np.ascontiguousarray(self.get_subhalotables()[0][:, pnum])
+        return self._subhalooffsets[ptype]
+
+    def get_group_aligned_view(self, parttype="PartType0", objtype="halo") -> "GroupAlignedView":
+        """
+        Return the cached group-aligned view for a particle type and group type.
+        The view holds the chunk plan for operations on all groups and the particle arrays realigned to it,
+        so that repeated group operations reuse them. See GroupAlignedView.persist/materialize.
 
-        grpfirstsub = self.data["Group"]["GroupFirstSub"]
-        shlens = self.get_subhalolengths(ptype)
-        shoffsets = np.concatenate([[0], np.cumsum(shlens)[:-1]])
+        Parameters
+        ----------
+        parttype: str
+            Particle type.
+        objtype: str
+            Type of object. Can be "halo" or "subhalo". Default: "halo"
 
-        # particle offset for the first subhalo of each group that a subhalo belongs to
-        shfirstshoffset = shoffsets[grpfirstsub[shgrnr]]
+        Returns
+        -------
+        GroupAlignedView
+        """
+        objtype = grp_type_str(objtype)
+        key = (parttype, objtype)
+        if key in self._groupalignedviews:
+            return self._groupalignedviews[key]
+        if objtype == "halo":
+            offsets = self.get_groupoffsets(parttype=parttype)
+            lengths = self.get_grouplengths(parttype=parttype)
+        elif objtype == "subhalo":
+            offsets = self.get_subhalooffsets(parttype=parttype)
+            lengths = self.get_subhalolengths(parttype=parttype)
+        else:
+            raise ValueError("Unknown object type '%s'." % objtype)
+        # plan for the largest field already instantiated
+        arrs = [v for k, v in self.data[parttype].items(withrecipes=False) if hasattr(v, "dtype")]
+        entry_nbytes_in = max([_get_entry_nbytes([arr]) for arr in arrs] + [8])
+        sha = hashlib.sha256()
+        for k in [os.path.realpath(self.path), str(getattr(self.catalog, "path", self.catalog)), parttype, objtype]:
+            sha.update(k.encode())
+        store = return_cachefile_path(os.path.join("groupaligned", sha.hexdigest()[:32] + ".zarr"))
+        view = GroupAlignedView(offsets, lengths, entry_nbytes_in, store=store)
+        self._groupalignedviews[key] = view
+        return view
+
+    def export_groups(self, ids, objtype="halo", fields=None, path=None, overwrite=False) -> GroupExport:
+        """
+        Export the particles of halos or subhalos into one compact HDF5 file per object, listed in an index.
+        Later selections of exported objects via return_data(haloID=...)/return_data(subhaloID=...) are served
+        from these files, see get_group_export(). Files are written in parallel by dask, reading one contiguous
+        range of the snapshot per object, particle type and field.
 
-        # "LocalSubhaloOffset": particle offset of each subhalo in the parent group
-        shoffset_local = shoffsets - shfirstshoffset
+        Parameters
+        ----------
+        ids: Union[int, np.ndarray, str]
+            Halo or subhalo indices to export. "all" exports all objects, writing one file per object.
+        objtype: str
+            Type of object. Can be "halo" or "subhalo". Default: "halo"
+        fields: Optional[Union[List[str], Dict[str, List[str]]]]
+            Fields to export, for all particle types or per particle type. Default: all fields read from disk.
+        path: Optional[str]
+            Directory to write to. Default: a directory in the cache directory.
+        overwrite: bool
+            Whether to rewrite objects that have already been exported.
 
-        # "SubhaloOffset": particle offset of each subhalo in the simulation
-        offsets = shoffset_central + shoffset_local
+        Returns
+        -------
+        GroupExport
+        """
+        objtype = grp_type_str(objtype)
+        if objtype == "halo":
+            offsets, lengths = self.get_grouptables()
+        elif objtype == "subhalo":
+            offsets, lengths = self.get_subhalotables()
+        else:
+            raise ValueError("Unknown object type '%s'." % objtype)
+        if isinstance(ids, str):
+            if ids != "all":
+                raise ValueError("Unknown ids '%s', pass indices or 'all'." % ids)
+            ids = np.arange(lengths.shape[0])
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        if ids.shape[0] > 0 and (ids.min() < 0 or ids.max() >= lengths.shape[0]):
+            raise ValueError("%s indices must be in [0, %i)." % (objtype, lengths.shape[0]))
+        catalogpath = getattr(self.catalog, "path", self.catalog)
+        if path is None:
+            path = get_groupexport_path(self.path, catalogpath)
+            if path is None:
+                raise ValueError("No cache directory available, specify 'path'.")
+        os.makedirs(path, exist_ok=True)
+
+        ptypes = [p for p in self.data.keys(withfields=False) if p.startswith("PartType")]
+        if fields is None:
+            hf = self.file if isinstance(self.file, h5py.File) and self.file.id.valid else None
+            fields = {p: _get_io_fields(self.data[p], grp=hf.get(p) if hf is not None else None) for p in ptypes}
+        elif not isinstance(fields, dict):
+            fields = {p: [k for k in fields if k in self.data[p]] for p in ptypes}
+        fields = {p: sorted(v) for p, v in fields.items()}
+
+        fingerprint = get_groupexport_fingerprint(self.path, catalogpath)
+        export = GroupExport.read(path, objtype)
+        if export is None or overwrite or export.fingerprint != fingerprint or export.fields != fields:
+            export = GroupExport(path, objtype, fingerprint, fields=fields)
+        else:
+            ids = ids[~np.isin(ids, export.ids)]  # already exported
+
+        tasks = []
+        for idx in ids:
+            arrs = dict()
+            for p, fieldnames in fields.items():
+                o, n = offsets[idx, part_type_num(p)], lengths[idx, part_type_num(p)]
+                for k in fieldnames:
+                    v = self.data[p][k]
+                    arrs["%s/%s" % (p, k)] = getattr(v, "magnitude", v)[o : o + n]
+            attrs = dict(objtype=objtype, id=idx)
+            tasks.append(delayed(write_groupfile)(export.get_filename(idx), arrs, attrs=attrs))
+        log.info("Exporting %i %ss to '%s'.", len(tasks), objtype, path)
+        dask.compute(*tasks)
+        export.add(ids, lengths[ids])
+        export.write_index()
+        self._groupexports[objtype] = export
+        return export
+
+    def get_group_export(self, objtype="halo", path=None) -> Optional[GroupExport]:
+        """
+        Get the exported halos or subhalos of this snapshot, see export_groups().
 
-        self._subhalooffsets[ptype] = offsets
+        Parameters
+        ----------
+        objtype: str
+            Type of object. Can be "halo" or "subhalo". Default: "halo"
+        path: Optional[str]
+            Directory of the export. If given, the export is used for later selections. Default: the last export
+            of this instance or the export in the cache directory.
 
-        return offsets
+        Returns
+        -------
+        Optional[GroupExport]
+            None if there is no export matching the current state of the snapshot and catalog files.
+        """
+        objtype = grp_type_str(objtype)
+        if path is None and objtype in self._groupexports:
+            return self._groupexports[objtype]
+        catalogpath = getattr(self.catalog, "path", self.catalog)
+        if not isinstance(catalogpath, (str, os.PathLike)):
+            path = None  # exports cannot be validated without catalog files
+        elif path is None:
+            path = get_groupexport_path(self.path, catalogpath)
+        if path is None or not os.path.isfile(get_groupexport_indexpath(path, objtype)):
+            # nothing exported; remembered, so that later selections do not look again
+            self._groupexports[objtype] = None
+            return None
+        export = GroupExport.read(path, objtype)
+        if export is not None and export.fingerprint != get_groupexport_fingerprint(self.path, catalogpath):
+            log.warning("Ignoring export '%s' of modified snapshot or catalog files.", path)
+            export = None
+        self._groupexports[objtype] = export
+        return export
 
     def grouped(
         self,
         fields: Union[str, da.Array, List[str], Dict[str, da.Array]] = "",
         parttype="PartType0",
         objtype="halo",
+        aligned=True,
     ):
         """
         Create a GroupAwareOperation object for applying operations to groups.
@@ -637,6 +918,8 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
             Particle type to operate on.
         objtype: str
             Type of object to operate on. Can be "halo" or "subhalo". Default: "halo"
+        aligned: bool
+            Whether to use the cached group-aligned view (see get_group_aligned_view) when all groups are processed.
 
         Returns
         -------
@@ -699,6 +982,7 @@ class ArepoSnapshot(SpatialCartesian3DMixin, GadgetStyleSnapshot):
             lengths,
             arrdict,
             inputfields=inputfields,
+            view=self.get_group_aligned_view(parttype=parttype, objtype=objtype) if aligned else None,
         )
         return gop
 
@@ -742,12 +1026,161 @@ class ArepoCatalog(ArepoSnapshot):
         return valid
 
 
+class GroupAlignedView:
+    """
+    Chunk plan for processing the groups of a particle type together with a cache of the particle
+    arrays sliced and rechunked into one chunk per planned range of groups.
+    """
+
+    def __init__(self, offsets, lengths, entry_nbytes_in, entry_nbytes_out=8, store=None, **kwargs):
+        """
+        Plan the chunks for the given groups.
+
+        Parameters
+        ----------
+        offsets: np.ndarray
+            Offset of each group in the particle arrays.
+        lengths: np.ndarray
+            Number of particles per group.
+        entry_nbytes_in: int
+            Number of input bytes per particle to plan the chunks for.
+        entry_nbytes_out: int
+            Number of output bytes per group to plan the chunks for.
+        store: Optional[str]
+            Path of the zarr store used by materialize().
+        kwargs:
+            Passed to map_group_operation_get_chunkedges.
+        """
+        self.offsets, self.lengths = _select_groups(offsets, lengths)
+        self.chunkedges, self.rngstarts, self.rngends = _plan_group_chunks(
+            self.offsets, self.lengths, entry_nbytes_in, entry_nbytes_out, **kwargs
+        )
+        self.store = store
+        self._arrs = dict()
+
+    @property
+    def chunks(self) -> tuple:
+        """Number of particles of each chunk of the aligned arrays."""
+        return tuple(int(n) for n in self.rngends - self.rngstarts)
+
+    def __contains__(self, arr):
+        arr = arr.magnitude if hasattr(arr, "magnitude") else arr
+        return getattr(arr, "name", None) in self._arrs
+
+    def fits(self, entry_nbytes_in, entry_nbytes_out, chunksize_bytes=None, nchunks_min=None) -> bool:
+        """
+        Whether the chunk plan can be used for an operation, i.e. whether its chunks stay within the
+        operation's memory limit. Otherwise, the operation needs its own chunk plan.
+
+        Parameters
+        ----------
+        entry_nbytes_in: int
+            Number of input bytes per particle of the operation.
+        entry_nbytes_out: int
+            Number of output bytes per group of the operation.
+        chunksize_bytes: Optional[int]
+            Maximum memory per chunk. Defaults to 16 times dask's "array.chunk-size".
+        nchunks_min: Optional[int]
+            Minimum number of chunks.
+
+        Returns
+        -------
+        bool
+        """
+        if chunksize_bytes is None:
+            chunksize_bytes = 16 * parse_humansize(dask.config.get("array.chunk-size"))
+        ngroups = np.diff(self.chunkedges, axis=1).ravel()
+        if nchunks_min is not None and ngroups.shape[0] < nchunks_min:
+            return False
+        nbytes = entry_nbytes_in * (self.rngends - self.rngstarts) + entry_nbytes_out * ngroups
+        return bool(np.all(nbytes < chunksize_bytes))
+
+    def align(self, arr):
+        """
+        Return the array sliced and rechunked into one chunk per planned range of groups.
+
+        Parameters
+        ----------
+        arr: da.Array
+            Particle array, optionally with units.
+
+        Returns
+        -------
+        da.Array
+            The aligned array without units.
+        """
+        mag = arr.magnitude if hasattr(arr, "magnitude") else arr
+        aligned = self._arrs.get(mag.name)
+        if aligned is None:
+            aligned = _get_group_aligned(mag, self.rngstarts, self.rngends)
+            self._arrs[mag.name] = aligned
+        return aligned
+
+    def persist(self, arrs) -> None:
+        """
+        Keep the aligned arrays in (distributed) memory.
+
+        Parameters
+        ----------
+        arrs: List[da.Array]
+            Particle arrays to align and persist.
+
+        Returns
+        -------
+        None
+        """
+        names = [(arr.magnitude if hasattr(arr, "magnitude") else arr).name for arr in arrs]
+        aligned = dask.persist(*[self.align(arr) for arr in arrs])
+        self._arrs.update(zip(names, aligned))
+
+    def materialize(self, arrs, path=None) -> None:
+        """
+        Write the particle ranges of the planned chunks to a zarr store and read aligned arrays from there.
+
+        Parameters
+        ----------
+        arrs: List[da.Array]
+            Particle arrays to materialize.
+        path: Optional[str]
+            Path of the zarr store. Default: the store passed at construction.
+
+        Returns
+        -------
+        None
+        """
+        if path is None:
+            path = self.store
+        if path is None:
+            raise ValueError("No zarr store to materialize the group-aligned arrays in.")
+        mags = [arr.magnitude if hasattr(arr, "magnitude") else arr for arr in arrs]
+        start, end = int(self.rngstarts[0]), int(self.rngends[-1])
+        tasks = []
+        for mag in mags:
+            # the particles are stored in regular chunks and only read in group-aligned chunks
+            src = mag[start:end]
+            src = src.rechunk((mag.chunksize[0],) + mag.shape[1:])
+            tasks.append(da.to_zarr(src, path, component=mag.name, overwrite=True, compute=False))
+        dask.compute(*tasks)
+        for mag in mags:
+            self._arrs[mag.name] = da.from_zarr(path, component=mag.name, chunks=(self.chunks,) + mag.shape[1:])
+
+    def clear(self) -> None:
+        """
+        Drop all cached aligned arrays.
+
+        Returns
+        -------
+        None
+        """
+        self._arrs = dict()
+
+
 class ChainOps:
     """
     Chain operations together.
     """
 
-    def __init__(self, *funcs):
+    def __init__(self, *funcs, jit=False, batch=False):
         """
         Initialize a ChainOps object.
 
@@ -755,18 +1188,22 @@ class ChainOps:
         ----------
         funcs: List[function]
             Functions to chain together.
+        jit: bool
+            Whether to compile the chain and the loop over groups with numba.
+        batch: bool
+            Whether the (single) function processes all groups of a chunk at once, see GroupAwareOperation.apply.
         """
         self.funcs = funcs
+        self.jit = jit
+        self.batch = batch
         self.kwargs = get_kwargs(funcs[-1])  # so we can pass info from kwargs to map_halo_operation
-        if self.kwargs.get("dtype") is None:
-            self.kwargs["dtype"] = float
 
-        def chained_call(*args):
+        def chained_call(*args, **kwargs):
             cf = None
             for i, f in enumerate(funcs):
                 # first chain element can be multiple fields. treat separately
                 if i == 0:
-                    cf = f(*args)
+                    cf = f(*args, **kwargs)
                 else:
                     cf = f(cf)
             return cf
@@ -792,6 +1229,10 @@ class GroupAwareOperation:
         "final",
         "inputfields",
         "opfuncs_custom",
+        "jit",
+        "batch",
+        "output_spec",
+        "view",
     )
 
     def __init__(
@@ -801,8 +1242,16 @@ class GroupAwareOperation:
         arrs: Dict[str, da.Array],
         ops=None,
         inputfields=None,
+        jit=False,
+        batch=False,
+        output_spec=None,
+        view=None,
     ):
         self.offsets = offsets
+        self.view = view
+        self.jit = jit
+        self.batch = batch
+        self.output_spec = output_spec
         self.lengths = lengths
         self.arrs = arrs
         self.opfuncs_custom = {}
@@ -813,7 +1262,7 @@ class GroupAwareOperation:
         else:
             self.ops = ops
 
-    def chain(self, add_op=None, final=False):
+    def chain(self, add_op=None, final=False, jit=False, batch=False):
         """
         Chain another operation to this one.
 
@@ -823,6 +1272,10 @@ class GroupAwareOperation:
             Operation to add. Can be a string (e.g. "min", "max", "sum") or a function.
         final: bool
             Whether this is the final operation in the chain.
+        jit: bool
+            Whether to compile the operation chain with numba.
+        batch: bool
+            Whether add_op is a batch function processing all groups of a chunk at once.
 
         Returns
         -------
@@ -830,8 +1283,13 @@ class GroupAwareOperation:
         """
         if self.final:
             raise ValueError("Cannot chain any additional operation.")
+        if batch and len(self.ops) > 0:
+            raise ValueError("Batch functions cannot be chained with other operations.")
         c = copy.copy(self)
-        c.final = final
+        c.final = final or batch
+        c.jit = self.jit or jit
+        c.batch = batch
+        c.output_spec = None  # only describes the output of the last operation
         c.opfuncs_custom = self.opfuncs_custom
         if add_op is not None:
             if isinstance(add_op, str):
@@ -884,7 +1342,7 @@ class GroupAwareOperation:
         """
         return self.chain(add_op="half", final=False)
 
-    def apply(self, func, final=False):
+    def apply(self, func, final=False, jit=False, batch=False, output_spec=None):
         """
         Apply a passed function.
 
@@ -894,12 +1352,124 @@ class GroupAwareOperation:
             Function to apply.
         final: bool
             Whether this is the final operation in the chain.
+        jit: bool
+            Whether to compile the operation chain and the loop over groups with numba. All functions of the
+            chain then need to be compilable in nopython mode and operate on plain arrays without units.
+        batch: bool
+            Whether func processes all groups of a chunk at once. It is then called as
+            func(*arrs, offsets=offsets, lengths=lengths) with the concatenated arrays of the chunk's groups
+            and the groups' offsets and lengths within these, and needs to return an array with the result
+            for each group along the first axis. Batch functions are final and cannot be chained.
+        output_spec: Optional[dict]
+            Output "shape", "dtype", "units" and/or "fill_value" per group. Specifying shape and units skips
+            their inference, which calls the function on the first particle of each input field.
 
         Returns
         -------
         GroupAwareOperation
         """
-        return self.chain(add_op=func, final=final)
+        if batch and jit:
+            raise ValueError("Batch functions cannot be compiled with jit=True.")
+        c = self.chain(add_op=func, final=final, jit=jit, batch=batch)
+        if output_spec is not None:
+            c.output_spec = dict(output_spec)
+        return c
+
+    def aggregate(self, aggs, nmax=None, idxlist=None, compute=True, gap_tolerance=None):
+        """
+        Evaluate several operations per group in a single pass over the particles.
+
+        Parameters
+        ----------
+        aggs: Dict[str, Union[str, callable, tuple]]
+            Operation for each output. Either a reduction name ("min", "max", "sum") applied to the single input
+            field, a function taking input fields by argument name (or by its "fieldnames" keyword argument),
+            or a tuple (fields, operation) or (fields, operation, output_spec) naming the input field(s) explicitly.
+            Operations already chained (e.g. half()) are applied before each operation.
+        nmax: Optional[int]
+            Maximum number of groups to process.
+        idxlist: Optional[np.ndarray]
+            List of group indices to process.
+        compute: bool
+            Whether to compute the results immediately or return dask objects to compute later.
+        gap_tolerance: Optional[int]
+            Maximum number of particles between groups in idxlist to read for processing them in the same task.
+
+        Returns
+        -------
+        dict
+            Result for each output.
+        """
+        if self.final:
+            raise ValueError("Cannot aggregate after a final operation.")
+        funcdict = dict()
+        funcdict.update(**self.opfuncs)
+        funcdict.update(**self.opfuncs_custom)
+        prefix = [funcdict[k] for k in self.ops]
+        aliases = dict()  # input field names as passed to grouped() for the keys of self.arrs
+        if self.inputfields is not None and len(self.inputfields) == len(self.arrs):
+            aliases = dict(zip(self.inputfields, self.arrs.keys()))
+        funcs, fieldnames, output_specs = dict(), dict(), dict()
+        for name, agg in aggs.items():
+            fields = None
+            if isinstance(agg, tuple):
+                if len(agg) == 3:
+                    output_specs[name] = dict(agg[2])
+                elif len(agg) != 2:
+                    raise ValueError("Expect (fields, operation[, output_spec]) for output '%s'." % name)
+                fields, agg = agg[0], agg[1]
+                fields = [fields] if isinstance(fields, str) else list(fields)
+                fields = [f if f in self.arrs else aliases.get(f, f) for f in fields]
+            if isinstance(agg, str):
+                if agg not in self.finalops:
+                    raise ValueError("Unknown aggregation '%s' for output '%s'." % (agg, name))
+                op = self.opfuncs[agg]
+            elif callable(agg):
+                op = agg
+            else:
+                raise ValueError("Unknown operation of type '%s' for output '%s'." % (type(agg), name))
+            if fields is None:
+                fields = self._get_aggregation_fields(op if len(prefix) == 0 else prefix[0], name)
+            for f in fields:
+                if f not in self.arrs:
+                    raise ValueError("Unknown field '%s' for output '%s'." % (f, name))
+            funcs[name] = ChainOps(*prefix, op, jit=self.jit)
+            fieldnames[name] = fields
+
+        res = map_group_aggregation(
+            funcs,
+            self.offsets,
+            self.lengths,
+            self.arrs,
+            fieldnames,
+            nmax=nmax,
+            idxlist=idxlist,
+            gap_tolerance=gap_tolerance,
+            output_specs=output_specs,
+            view=self.view,
+        )
+        if compute:
+            res = dask.compute(res)[0]
+        return res
+
+    def _get_aggregation_fields(self, func, name) -> List[str]:
+        """Determine the input fields of an operation passed to aggregate without explicit fields."""
+        if func in self.opfuncs.values():
+            fields = list(self.arrs.keys())
+            if len(fields) != 1:
+                raise ValueError("Specify the input field for output '%s' as (field, operation)." % name)
+            return fields
+        fields = get_kwargs(func).get("fieldnames", None)
+        if isinstance(fields, str):
+            return [fields]
+        if fields is not None:
+            return list(fields)
+        args = get_args(func)
+        if len(args) > 0 and all(a in self.arrs for a in args):
+            return args
+        if self.inputfields is not None and len(args) == len(self.inputfields):
+            return list(self.arrs.keys())
+        raise ValueError("Cannot determine input fields for output '%s'. Pass them as (fields, operation)." % name)
 
     def __copy__(self):
         # overwrite method so that copy holds a new ops list.
@@ -909,10 +1479,14 @@ class GroupAwareOperation:
             self.arrs,
             ops=list(self.ops),
             inputfields=self.inputfields,
+            jit=self.jit,
+            batch=self.batch,
+            output_spec=self.output_spec,
+            view=self.view,
         )
         return c
 
-    def evaluate(self, nmax=None, idxlist=None, compute=True):
+    def evaluate(self, nmax=None, idxlist=None, compute=True, gap_tolerance=None):
         """
         Evaluate the operation.
 
@@ -924,6 +1498,8 @@ class GroupAwareOperation:
             List of halo indices to process. If not provided, (and nmax not set) all halos are processed.
         compute: bool
             Whether to compute the result immediately or return a dask object to compute later.
+        gap_tolerance: Optional[int]
+            Maximum number of particles between halos in idxlist to read for processing them in the same task.
 
         Returns
         -------
@@ -936,7 +1512,7 @@ class GroupAwareOperation:
         funcdict.update(**self.opfuncs)
         funcdict.update(**self.opfuncs_custom)
 
-        func = ChainOps(*[funcdict[k] for k in self.ops])
+        func = ChainOps(*[funcdict[k] for k in self.ops], jit=self.jit, batch=self.batch)
 
         fieldnames = list(self.arrs.keys())
         if self.inputfields is None:
@@ -961,6 +1537,9 @@ class GroupAwareOperation:
             fieldnames=fieldnames,
             nmax=nmax,
             idxlist=idxlist,
+            gap_tolerance=gap_tolerance,
+            output_spec=self.output_spec,
+            view=self.view,
         )
         if compute:
             res = res.compute()
@@ -977,6 +1556,8 @@ def wrap_func_scalar(
     func_output_shape=(1,),
     func_output_dtype="float64",
     fill_value=0,
+    batch=False,
+    cast_output=False,
 ):
     """
     Wrapper for applying a function to each halo in the passed chunk.
@@ -991,6 +1572,10 @@ def wrap_func_scalar(
     func_output_shape
     func_output_dtype
     fill_value
+    batch: bool
+        Whether func processes all halos of the chunk at once, taking the offsets and lengths as keyword arguments.
+    cast_output: bool
+        Whether to cast the results to func_output_dtype.
 
     Returns
     -------
@@ -998,6 +1583,92 @@ def wrap_func_scalar(
     """
     offsets = offsets_in_chunks[block_id[0]]
     lengths = lengths_in_chunks[block_id[0]]
+    return apply_to_groups(
+        func,
+        offsets,
+        lengths,
+        *arrs,
+        func_output_shape=func_output_shape,
+        func_output_dtype=func_output_dtype,
+        fill_value=fill_value,
+        batch=batch,
+        cast_output=cast_output,
+    )
+
+
+def apply_to_groups(
+    func,
+    offsets,
+    lengths,
+    *arrs,
+    func_output_shape=(1,),
+    func_output_dtype="float64",
+    fill_value=0,
+    batch=False,
+    cast_output=False,
+):
+    """
+    Apply a function to each group of particles in the passed arrays.
+
+    Parameters
+    ----------
+    func: callable
+        Function to apply to the particles of each group.
+    offsets: np.ndarray
+        Offsets of the groups within the arrays.
+    lengths: np.ndarray
+        Number of particles of the groups.
+    arrs: np.ndarray
+        Input arrays.
+    func_output_shape: tuple
+        Output shape of func for a single group.
+    func_output_dtype: str or np.dtype
+        Output dtype.
+    fill_value
+        Result for empty groups.
+    batch: bool
+        Whether func processes all groups at once, taking the offsets and lengths as keyword arguments.
+    cast_output: bool
+        Whether to cast the results to func_output_dtype. Otherwise, the dtype of func's results is kept.
+
+    Returns
+    -------
+    np.ndarray
+        Result for each group.
+    """
+    shape = tuple(func_output_shape) if func_output_shape not in [(1,), ()] else ()
+    if batch:
+        res = np.asarray(func(*arrs, offsets=offsets, lengths=lengths))
+        if res.shape != (len(lengths),) + shape:
+            raise ValueError(
+                "Batch function returned results of shape %s for %i groups with output shape %s."
+                % (res.shape, len(lengths), shape)
+            )
+        if cast_output:
+            return res.astype(func_output_dtype)
+        if res.dtype != np.dtype(func_output_dtype):
+            raise ValueError(
+                "Batch function returned dtype '%s' instead of '%s'. Specify the dtype in the output_spec to cast."
+                % (res.dtype, np.dtype(func_output_dtype))
+            )
+        return res
+
+    ufunc = get_segmented_reduction(func)
+    if ufunc is not None and len(arrs) == 1:
+        res = reduce_segments(ufunc, arrs[0], offsets, lengths, fill_value=fill_value)
+        return res.astype(func_output_dtype) if cast_output else res
+    if getattr(func, "jit", False):
+        res = np.empty((len(lengths),) + shape, dtype=func_output_dtype)
+        arrs = [arr.magnitude if hasattr(arr, "magnitude") else arr for arr in arrs]
+        chain = get_jit_chain(func.funcs)
+        loop = _jit_loops.get(len(arrs))
+        if loop is not None:
+            loop(chain, np.asarray(offsets), np.asarray(lengths), res, fill_value, *arrs)
+            return res
+        for i, length in enumerate(lengths):  # too many inputs for the compiled loops
+            o = offsets[i]
+            res[i] = chain(*[arr[o : o + length] for arr in arrs]) if length > 0 else fill_value
+        return res
 
     res = []
     for i, length in enumerate(lengths):
@@ -1009,68 +1680,310 @@ def wrap_func_scalar(
             continue
         arrchunks = [arr[o : o + length] for arr in arrs]
         res.append(func(*arrchunks))
-    return np.array(res)
+    return np.array(res, dtype=func_output_dtype if cast_output else None)
 
 
-@jit(nopython=True)
-def get_hidx(gidx_start, gidx_count, celloffsets, index_unbound=None):
-    """Get halo index of a given cell
+_jit_chains = dict()
+_jit_chains_size = 128
+
+
+def _jit_function(func):
+    """Compile a single function with numba, wrapping functions numba can only call, such as np.sum."""
+    if is_jitted(func):
+        return func
+    if inspect.isfunction(func):
+        return jit(nopython=True)(func)
+
+    @jit(nopython=True)
+    def wrapped(*args):
+        return func(*args)
+
+    return wrapped
+
+
+def get_jit_chain(funcs):
+    """
+    Return a numba-compiled function calling the given functions one after another.
 
     Parameters
     ----------
-    gidx_start: integer
-        The first unique integer ID for the first particle
-    gidx_count: integer
-        The amount of halo indices we are querying after "gidx_start"
-    celloffsets : array
-        An array holding the starting cell offset for each halo. Needs to include the
-        offset after the last halo. The required shape is thus (Nhalo+1,).
-    index_unbound : integer, optional
-        The index to use for unbound particles. If None, the maximum integer value
-        of the dtype is used.
+    funcs: tuple
+        Functions to chain. The first takes the field arrays, the latter the previous result.
+
+    Returns
+    -------
+    numba.core.registry.CPUDispatcher
     """
-    dtype = np.int64
-    if index_unbound is None:
-        index_unbound = np.iinfo(dtype).max
-    res = index_unbound * np.ones(gidx_count, dtype=dtype)
-    # find initial celloffset
-    hidx_idx = np.searchsorted(celloffsets, gidx_start, side="right") - 1
-    if hidx_idx + 1 >= celloffsets.shape[0]:
-        # we are done. Already out of scope of lookup => all unbound gas.
-        return res
-    celloffset = celloffsets[hidx_idx + 1]
-    endid = celloffset - gidx_start
-    startid = 0
+    funcs = tuple(funcs)
+    chained = _jit_chains.pop(funcs, None)
+    if chained is None:
+        chained = _jit_function(funcs[0])
+        for f in funcs[1:]:
+            chained = _jit_compose(chained, _jit_function(f))
+    _jit_chains[funcs] = chained  # (re-)insert as most recently used
+    while len(_jit_chains) > _jit_chains_size:
+        _jit_chains.pop(next(iter(_jit_chains)))
+    return chained
 
-    # Now iterate through list.
-    while startid < gidx_count:
-        res[startid:endid] = hidx_idx
-        hidx_idx += 1
-        startid = endid
-        if hidx_idx >= celloffsets.shape[0] - 1:
-            break
-        count = celloffsets[hidx_idx + 1] - celloffsets[hidx_idx]
-        endid = startid + count
-    return res
 
+def _jit_compose(f, g):
+    @jit(nopython=True)
+    def composed(*args):
+        return g(f(*args))
 
-def get_hidx_daskwrap(gidx, halocelloffsets, index_unbound=None):
-    gidx_start = gidx[0]
-    gidx_count = gidx.shape[0]
-    return get_hidx(gidx_start, gidx_count, halocelloffsets, index_unbound=index_unbound)
+    return composed
 
 
-def get_haloquantity_daskwrap(gidx, halocelloffsets, valarr):
-    hidx = get_hidx_daskwrap(gidx, halocelloffsets)
-    dmax = np.iinfo(hidx.dtype).max
-    mask = ~((hidx == -1) | (hidx == dmax))
-    result = -1.0 * np.ones(hidx.shape, dtype=valarr.dtype)
-    result[mask] = valarr[hidx[mask]]
-    return result
+# numba cannot slice the arrays of a heterogeneous tuple in a loop, so there is one loop per number of inputs.
+# Each writes the result of func for each group into the preallocated array out.
 
 
-def compute_haloindex(gidx, halocelloffsets, *args, index_unbound=None):
-    """Computes the halo index for each particle with dask."""
+@jit(nopython=True)
+def _jit_loop1(func, offsets, lengths, out, fill_value, arr0):
+    for i in range(lengths.shape[0]):
+        o, n = offsets[i], lengths[i]
+        if n == 0:
+            out[i] = fill_value
+        else:
+            out[i] = func(arr0[o : o + n])
+
+
+@jit(nopython=True)
+def _jit_loop2(func, offsets, lengths, out, fill_value, arr0, arr1):
+    for i in range(lengths.shape[0]):
+        o, n = offsets[i], lengths[i]
+        if n == 0:
+            out[i] = fill_value
+        else:
+            out[i] = func(arr0[o : o + n], arr1[o : o + n])
+
+
+@jit(nopython=True)
+def _jit_loop3(func, offsets, lengths, out, fill_value, arr0, arr1, arr2):
+    for i in range(lengths.shape[0]):
+        o, n = offsets[i], lengths[i]
+        if n == 0:
+            out[i] = fill_value
+        else:
+            out[i] = func(arr0[o : o + n], arr1[o : o + n], arr2[o : o + n])
+
+
+@jit(nopython=True)
+def _jit_loop4(func, offsets, lengths, out, fill_value, arr0, arr1, arr2, arr3):
+    for i in range(lengths.shape[0]):
+        o, n = offsets[i], lengths[i]
+        if n == 0:
+            out[i] = fill_value
+        else:
+            out[i] = func(arr0[o : o + n], arr1[o : o + n], arr2[o : o + n], arr3[o : o + n])
+
+
+_jit_loops = {1: _jit_loop1, 2: _jit_loop2, 3: _jit_loop3, 4: _jit_loop4}
+
+
+_segmented_reductions = {np.sum: np.add, np.min: np.minimum, np.max: np.maximum}
+
+
+def get_segmented_reduction(func):
+    """
+    Return the ufunc for a segmented reduction equivalent to applying func to each group, if any.
+
+    Parameters
+    ----------
+    func: callable or ChainOps
+        Function applied to each group.
+
+    Returns
+    -------
+    Optional[np.ufunc]
+    """
+    if isinstance(func, ChainOps):
+        if len(func.funcs) != 1:
+            return None
+        func = func.funcs[0]
+    try:
+        return _segmented_reductions.get(func, None)
+    except TypeError:  # unhashable callable
+        return None
+
+
+def reduce_segments(ufunc, arr, offsets, lengths, fill_value=0):
+    """
+    Reduce contiguous segments of an array, equivalent to reducing arr[o:o+l] over all axes for each segment.
+
+    Parameters
+    ----------
+    ufunc: np.ufunc
+        Reduction ufunc, e.g. np.add, np.minimum or np.maximum.
+    arr: np.ndarray
+        Array holding the segments along the first axis.
+    offsets: np.ndarray
+        Start index of each segment.
+    lengths: np.ndarray
+        Length of each segment.
+    fill_value:
+        Result for empty segments.
+
+    Returns
+    -------
+    np.ndarray
+    """
+    if hasattr(arr, "magnitude"):
+        arr = arr.magnitude  # units are re-attached for the full output array
+    arr = np.asarray(arr)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    # same accumulator dtype as np.sum, e.g. int64 for int32
+    dtype = np.add.reduce(arr[:0].ravel()).dtype if ufunc is np.add else arr.dtype
+    mask = lengths > 0
+    starts = offsets[mask]
+    ends = starts + lengths[mask]
+    if starts.shape[0] == 0:
+        return np.full(lengths.shape[0], fill_value, dtype=dtype)
+    # interleave starts and ends, so that gaps between segments are reduced separately and discarded
+    idx = np.stack([starts, ends], axis=1).ravel()
+    if idx[-1] == arr.shape[0]:
+        idx = idx[:-1]
+    red = ufunc.reduceat(arr, idx, axis=0, dtype=dtype)[::2]
+    if red.ndim > 1:
+        red = ufunc.reduce(red.reshape(red.shape[0], -1), axis=1)
+    res = np.full(lengths.shape[0], fill_value, dtype=red.dtype)
+    res[mask] = red
+    return res
+
+
+@jit(nopython=True)
+def get_hidx(gidx_start, gidx_count, celloffsets, index_unbound=None):
+    """Get halo index of a given cell
+
+    Parameters
+    ----------
+    gidx_start: integer
+        The first unique integer ID for the first particle
+    gidx_count: integer
+        The amount of halo indices we are querying after "gidx_start"
+    celloffsets : array
+        An array holding the starting cell offset for each halo. Needs to include the
+        offset after the last halo. The required shape is thus (Nhalo+1,).
+    index_unbound : integer, optional
+        The index to use for unbound particles. If None, the maximum integer value
+        of the dtype is used.
+    """
+    dtype = np.int64
+    if index_unbound is None:
+        index_unbound = np.iinfo(dtype).max
+    res = index_unbound * np.ones(gidx_count, dtype=dtype)
+    # find initial celloffset
+    hidx_idx = np.searchsorted(celloffsets, gidx_start, side="right") - 1
+    if hidx_idx + 1 >= celloffsets.shape[0]:
+        # we are done. Already out of scope of lookup => all unbound gas.
+        return res
+    celloffset = celloffsets[hidx_idx + 1]
+    endid = celloffset - gidx_start
+    startid = 0
+
+    # Now iterate through list.
+    while startid < gidx_count:
+        res[startid:endid] = hidx_idx
+        hidx_idx += 1
+        startid = endid
+        if hidx_idx >= celloffsets.shape[0] - 1:
+            break
+        count = celloffsets[hidx_idx + 1] - celloffsets[hidx_idx]
+        endid = startid + count
+    return res
+
+
+def get_hidx_runs(gidx_start, gidx_count, celloffsets):
+    """
+    Get the halos overlapping a contiguous range of cells and the number of cells in each.
+
+    Parameters
+    ----------
+    gidx_start: integer
+        The first unique integer ID for the first particle
+    gidx_count: integer
+        The amount of halo indices we are querying after "gidx_start"
+    celloffsets : array
+        An array holding the starting cell offset for each halo. Needs to include the
+        offset after the last halo. The required shape is thus (Nhalo+1,).
+
+    Returns
+    -------
+    hidx_first: int
+        index of the first halo overlapping the range
+    counts: np.ndarray
+        number of cells of the range in each consecutive halo starting at hidx_first.
+        Cells beyond the sum of counts are unbound.
+    """
+    celloffsets = np.asarray(celloffsets)
+    gidx_end = gidx_start + gidx_count
+    # halos [i0, i1) overlap the range
+    i0 = max(int(np.searchsorted(celloffsets, gidx_start, side="right")) - 1, 0)
+    i1 = min(int(np.searchsorted(celloffsets, gidx_end, side="left")), celloffsets.shape[0] - 1)
+    if i1 <= i0:
+        return i0, np.zeros(0, dtype=np.int64)
+    edges = np.clip(celloffsets[i0 : i1 + 1], gidx_start, gidx_end)
+    return i0, np.diff(edges).astype(np.int64)
+
+
+def get_hidx_vectorized(gidx_start, gidx_count, celloffsets, index_unbound=None):
+    """
+    Get halo index of a contiguous range of cells. Vectorized equivalent of get_hidx.
+
+    Parameters
+    ----------
+    gidx_start: integer
+        The first unique integer ID for the first particle
+    gidx_count: integer
+        The amount of halo indices we are querying after "gidx_start"
+    celloffsets : array
+        An array holding the starting cell offset for each halo. Needs to include the
+        offset after the last halo. The required shape is thus (Nhalo+1,).
+    index_unbound : integer, optional
+        The index to use for unbound particles. If None, the maximum integer value
+        of the dtype is used.
+
+    Returns
+    -------
+    np.ndarray
+    """
+    dtype = np.int64
+    if index_unbound is None:
+        index_unbound = np.iinfo(dtype).max
+    i0, counts = get_hidx_runs(gidx_start, gidx_count, celloffsets)
+    res = np.empty(gidx_count, dtype=dtype)
+    nbound = int(counts.sum())
+    res[:nbound] = np.repeat(np.arange(i0, i0 + counts.shape[0], dtype=dtype), counts)
+    res[nbound:] = index_unbound
+    return res
+
+
+def get_hidx_daskwrap(gidx, halocelloffsets, index_unbound=None):
+    gidx_start = int(gidx[0]) if gidx.shape[0] > 0 else 0
+    gidx_count = gidx.shape[0]
+    return get_hidx_vectorized(gidx_start, gidx_count, halocelloffsets, index_unbound=index_unbound)
+
+
+def _get_haloquantity_dtype(dtype) -> np.dtype:
+    """Dtype of a halo quantity mapped to particles, which can hold -1 for particles outside of halos."""
+    # e.g. int16 for uint8, int64 for uint32 and float64 for uint64
+    return np.promote_types(dtype, np.int8)
+
+
+def get_haloquantity_daskwrap(gidx, halocelloffsets, valarr):
+    gidx_start = int(gidx[0]) if gidx.shape[0] > 0 else 0
+    i0, counts = get_hidx_runs(gidx_start, gidx.shape[0], halocelloffsets)
+    valarr = np.asarray(valarr)
+    result = np.empty(gidx.shape, dtype=_get_haloquantity_dtype(valarr.dtype))
+    nbound = int(counts.sum())
+    result[:nbound] = np.repeat(valarr[i0 : i0 + counts.shape[0]], counts)
+    result[nbound:] = -1
+    return result
+
+
+def compute_haloindex(gidx, halocelloffsets, *args, index_unbound=None):
+    """Computes the halo index for each particle with dask."""
     return da.map_blocks(
         get_hidx_daskwrap,
         gidx,
@@ -1090,7 +2003,7 @@ def compute_haloquantity(gidx, halocelloffsets, hvals, *args):
         gidx,
         halocelloffsets,
         hvals,
-        meta=np.array((), dtype=hvals.dtype),
+        meta=np.array((), dtype=_get_haloquantity_dtype(hvals.dtype)),
         output_units=units,
     )
     return res
@@ -1259,49 +2172,18 @@ def get_shcounts_shcells(SubhaloGrNr, hlength):
     shcounts: np.ndarray
         The number of subhalos per halo
     shnumber: np.ndarray
-        The index of the first subhalo per halo
+        The index of the first subhalo per halo, -1 for halos without subhalos (as "GroupFirstSub" in Arepo catalogs)
     """
-    shcounts = np.zeros(hlength, dtype=np.int32)  # number of subhalos per halo
-    shnumber = np.zeros(hlength, dtype=np.int32)  # index of first subhalo per halo
-    i = 0
-    hid_old = 0
-    while i < SubhaloGrNr.shape[0]:
+    shcounts = np.zeros(hlength, dtype=np.int64)  # number of subhalos per halo
+    shnumber = -np.ones(hlength, dtype=np.int64)  # index of first subhalo per halo
+    for i in range(SubhaloGrNr.shape[0]):
         hid = SubhaloGrNr[i]
-        if hid == hid_old:
-            shcounts[hid] += 1
-        else:
+        if shcounts[hid] == 0:
             shnumber[hid] = i
-            shcounts[hid] += 1
-            hid_old = hid
-        i += 1
+        shcounts[hid] += 1
     return shcounts, shnumber
 
 
-def memorycost_limiter(cost_memory, cost_cpu, list_chunkedges, cost_memory_max):
-    """If a chunk too memory expensive, split into equal cpu expense operations."""
-    list_chunkedges_new = []
-    for chunkedges in list_chunkedges:
-        slc = slice(*chunkedges)
-        totcost_mem = np.sum(cost_memory[slc])
-        list_chunkedges_new.append(chunkedges)
-        if totcost_mem > cost_memory_max:
-            sumcost = cost_cpu[slc].cumsum()
-            sumcost /= sumcost[-1]
-            idx = slc.start + np.argmin(np.abs(sumcost - 0.5))
-            if idx == chunkedges[0]:
-                idx += 1
-            elif idx == chunkedges[-1]:
-                idx -= 1
-            chunkedges1 = [chunkedges[0], idx]
-            chunkedges2 = [idx, chunkedges[1]]
-            if idx == chunkedges[0] or idx == chunkedges[1]:
-                raise ValueError("This should not happen.")
-            list_chunkedges_new.pop()
-            list_chunkedges_new += memorycost_limiter(cost_memory, cost_cpu, [chunkedges1], cost_memory_max)
-            list_chunkedges_new += memorycost_limiter(cost_memory, cost_cpu, [chunkedges2], cost_memory_max)
-    return list_chunkedges_new
-
-
 def map_group_operation_get_chunkedges(
     lengths,
     entry_nbytes_in,
@@ -1309,27 +2191,44 @@ def map_group_operation_get_chunkedges(
     cpucost_halo=1.0,
     nchunks_min=None,
     chunksize_bytes=None,
+    ntasks=None,
 ):
     """
     Compute the chunking of a halo operation.
 
+    Halos are partitioned into contiguous chunks of similar CPU cost (particles plus a fixed cost per halo)
+    in a single greedy pass over the cumulative costs. Chunks never exceed the memory limit, and halos more
+    expensive than the target cost per chunk are processed in dedicated chunks.
+
     Parameters
     ----------
     lengths: np.ndarray
         The number of particles per halo.
-    entry_nbytes_in
-    entry_nbytes_out
-    cpucost_halo
-    nchunks_min
-    chunksize_bytes
+    entry_nbytes_in: int
+        Number of input bytes per particle.
+    entry_nbytes_out: int
+        Number of output bytes per halo.
+    cpucost_halo: float
+        CPU cost of processing a halo relative to processing a particle.
+    nchunks_min: Optional[int]
+        Minimum number of chunks.
+    chunksize_bytes: Optional[int]
+        Maximum memory per chunk. Defaults to 16 times dask's "array.chunk-size".
+    ntasks: Optional[int]
+        Target number of chunks, e.g. to balance the work over the scheduler's workers.
+        Defaults to the number of workers of the current scheduler.
 
     Returns
     -------
-    None
+    np.ndarray
+        start and end halo index of each chunk, shape (nchunks, 2)
     """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    nhalos = lengths.shape[0]
+    if nhalos == 0:
+        return np.zeros((0, 2), dtype=np.int64)
     cpucost_particle = 1.0  # we only care about ratio, so keep particle cost fixed.
     cost = cpucost_particle * lengths + cpucost_halo
-    sumcost = cost.cumsum()
 
     # let's allow a maximal chunksize of 16 times the dask default setting for an individual array [here: multiple]
     if chunksize_bytes is None:
@@ -1342,25 +2241,355 @@ def map_group_operation_get_chunkedges(
             "chunksize_bytes." % (chunksize_bytes, np.max(cost_memory))
         )
 
-    nchunks = int(np.ceil(np.sum(cost_memory) / chunksize_bytes))
-    nchunks = int(np.ceil(1.3 * nchunks))  # fudge factor
-    if nchunks_min is not None:
-        nchunks = max(nchunks_min, nchunks)
-    targetcost = sumcost[-1] / nchunks  # chunk target cost = total cost / nchunks
+    if ntasks is None:
+        ntasks = get_nworkers()
+    nchunks = max(int(np.ceil(np.sum(cost_memory) / chunksize_bytes)), ntasks, nchunks_min or 1)
+    nchunks = min(nchunks, nhalos)
+    sumcost = np.concatenate([[0.0], np.cumsum(cost)])
+    summem = np.concatenate([[0], np.cumsum(cost_memory)])
+    targetcost = sumcost[-1] / nchunks
+    huge = np.flatnonzero(cost >= targetcost)  # halos getting a dedicated chunk
+    # chunks cut by the memory limit add to the chunk count, but keep the cost per chunk bounded
+    edges = _partition_prefixsums(sumcost, summem, targetcost, chunksize_bytes, huge)
+    return np.stack([edges[:-1], edges[1:]], axis=1)
+
+
+def _partition_prefixsums(sumcost, summem, maxcost, maxmem, isolate):
+    """
+    Greedily partition items into contiguous chunks with bounded cost and memory given their prefix sums.
+
+    Parameters
+    ----------
+    sumcost: np.ndarray
+        Prefix sum of the cost per item, starting with 0.
+    summem: np.ndarray
+        Prefix sum of the memory per item, starting with 0.
+    maxcost: float
+        Maximum cost per chunk, exceeded only by chunks of a single item.
+    maxmem: int
+        Maximum memory per chunk.
+    isolate: np.ndarray
+        Sorted indices of items to put into dedicated chunks.
+
+    Returns
+    -------
+    np.ndarray
+        chunk edges
+    """
+    n = sumcost.shape[0] - 1
+    edges = [0]
+    start = 0
+    while start < n:
+        end = int(np.searchsorted(sumcost, sumcost[start] + maxcost, side="right")) - 1
+        end = min(end, int(np.searchsorted(summem, summem[start] + maxmem, side="right")) - 1)
+        h = isolate[np.searchsorted(isolate, start) :][:1]
+        if h.shape[0] > 0:
+            end = start + 1 if h[0] == start else min(end, int(h[0]))
+        end = min(max(end, start + 1), n)
+        edges.append(end)
+        start = end
+    return np.array(edges, dtype=np.int64)
+
+
+_signature_cache = dict()
+_signature_cache_size = 1024
+
+
+def _get_signature_key(func, inputs, batch=False):
+    """Key for the signature cache from the function(s) and the dtype, shape and units of the inputs."""
+    funcs = func.funcs if isinstance(func, ChainOps) else (func,)
+    key = [tuple(funcs), batch]
+    for arr in inputs:
+        units = getattr(arr, "units", None)
+        mag = arr.magnitude if hasattr(arr, "magnitude") else arr
+        registry = id(getattr(units, "_REGISTRY", None))
+        key.append((str(mag.dtype), tuple(mag.shape[1:]), str(units), registry))
+    key = tuple(key)
+    try:
+        hash(key)
+    except TypeError:  # unhashable callable
+        return None
+    return key
+
+
+def clear_signature_cache():
+    """
+    Clear the cache of inferred output shapes and units of group operations.
+
+    Returns
+    -------
+    None
+    """
+    _signature_cache.clear()
+
 
-    arr = np.diff(sumcost % targetcost)  # find whenever exceeding modulo target cost
-    idx = [0] + list(np.where(arr < 0)[0] + 1)
-    if idx[-1] != sumcost.shape[0]:
-        idx.append(sumcost.shape[0])
-    list_chunkedges = []
-    for i in range(len(idx) - 1):
-        list_chunkedges.append([idx[i], idx[i + 1]])
+def infer_signature(func, inputs, batch=False):
+    """
+    Infer output shape, units and dtype of a function applied to groups by calling it on the first entry of each input.
+
+    Parameters
+    ----------
+    func: callable
+        Function applied to each group.
+    inputs: list
+        Input (dask) arrays.
+    batch: bool
+        Whether func processes all groups of a chunk at once, see map_group_operation.
 
-    list_chunkedges = np.asarray(memorycost_limiter(cost_memory, cost, list_chunkedges, chunksize_bytes))
+    Returns
+    -------
+    tuple
+        shape, units (or None) and dtype (or None) of the output for a single group
+    """
+    arrs = [arr[:1].compute() for arr in inputs]
+    infer_func = func
+    if batch:
 
-    # make sure we did not lose any halos.
-    assert np.all(~(list_chunkedges.flatten()[2:-1:2] - list_chunkedges.flatten()[1:-1:2]).astype(bool))
-    return list_chunkedges
+        def infer_func(*args):
+            return func(*args, offsets=np.zeros(1, dtype=np.int64), lengths=np.ones(1, dtype=np.int64))[0]
+
+    units = None
+    dummyres = None
+    try:
+        dummyres = infer_func(*arrs)
+    except Exception as e:  # noqa
+        log.warning("Exception during shape/unit inference: %s." % str(e))
+    if dummyres is not None and hasattr(dummyres, "units"):
+        units = dummyres.units
+    if dummyres is None:
+        units_present = any([hasattr(arr, "units") for arr in arrs])
+        if units_present:
+            log.warning("Exception during unit inference. Assuming no units.")
+        # due to https://github.com/hgrecco/pint/issues/1037 innocent np.array operations on unit scalars can fail.
+        # we can still attempt to infer shape by removing units prior to calling func.
+        arrs = [arr.magnitude if hasattr(arr, "magnitude") else arr for arr in arrs]
+        try:
+            dummyres = infer_func(*arrs)
+        except Exception:  # noqa
+            # no more logging needed here
+            pass
+    dtype = None
+    if dummyres is None:
+        log.warning("Exception during shape inference. Using shape (1,).")
+        shape = ()
+    elif np.isscalar(dummyres):
+        shape = (1,)
+    else:
+        shape = dummyres.shape
+    if dummyres is not None:
+        dtype = np.asarray(getattr(dummyres, "magnitude", dummyres)).dtype
+    return shape, units, dtype
+
+
+def _resolve_output_spec(func, inputs, output_spec=None, batch=False):
+    """
+    Determine output shape, dtype, units and fill value of a function applied to groups.
+
+    Parameters
+    ----------
+    func: callable
+        Function applied to each group. Its keyword arguments "shape", "dtype", "units" and "fill_value" are used.
+    inputs: list
+        Input (dask) arrays.
+    output_spec: Optional[dict]
+        Output specification overriding the keyword arguments of func.
+    batch: bool
+        Whether func processes all groups of a chunk at once.
+
+    Returns
+    -------
+    tuple
+        shape, dtype, units, fill_value and whether the dtype was given explicitly. Otherwise, the dtype
+        is inferred (float64 if inference fails).
+    """
+    dfltkwargs = func.kwargs if isinstance(func, ChainOps) else get_kwargs(func)
+    spec = {k: dfltkwargs[k] for k in ["units", "shape", "dtype", "fill_value"] if k in dfltkwargs}
+    if output_spec is not None:
+        unknown = set(output_spec) - {"units", "shape", "dtype", "fill_value"}
+        if len(unknown) > 0:
+            raise ValueError("Unknown output_spec keys: %s" % ", ".join(sorted(unknown)))
+        spec.update(**output_spec)
+    units = spec.get("units", None)
+    shape = spec.get("shape", None)
+    dtype = spec.get("dtype", None)
+    explicit_dtype = dtype is not None
+    fill_value = spec.get("fill_value", 0)
+    if isinstance(shape, int):
+        shape = (shape,)
+
+    # shape/units inference
+    infer_shape = shape is None or (isinstance(shape, str) and shape == "auto")
+    infer_units = units is None
+    if infer_shape or infer_units or not explicit_dtype:
+        key = _get_signature_key(func, inputs, batch=batch)
+        signature = _signature_cache.pop(key, None) if key is not None else None
+        if signature is None:
+            if infer_shape:
+                log.debug("No shape specified. Attempting to determine shape of func output.")
+            if infer_units:
+                log.debug("No units specified. Attempting to determine units of func output.")
+            if not explicit_dtype:
+                log.debug("No dtype specified. Attempting to determine dtype of func output.")
+            signature = infer_signature(func, inputs, batch=batch)
+        if key is not None:
+            _signature_cache[key] = signature  # (re-)insert as most recently used
+            while len(_signature_cache) > _signature_cache_size:
+                _signature_cache.pop(next(iter(_signature_cache)))
+        if infer_shape:
+            shape = signature[0]
+            log.debug("Shape inference: %s." % str(shape))
+        if infer_units:
+            units = signature[1]
+        if not explicit_dtype:
+            dtype = signature[2] if signature[2] is not None else np.dtype("float64")
+    return shape, dtype, units, fill_value, explicit_dtype
+
+
+def _select_groups(offsets, lengths, nmax=None, idxlist=None):
+    """
+    Select the groups to process.
+
+    Parameters
+    ----------
+    offsets: np.ndarray
+        Offset of each group in the particle catalog.
+    lengths: np.ndarray
+        Number of particles per group.
+    nmax: Optional[int]
+        Only select the first nmax groups.
+    idxlist: Optional[np.ndarray]
+        Only select the groups with these (sorted, unique) indices.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        offsets (with an additional entry for the end of the last group) and lengths of the selected groups
+    """
+    if idxlist is not None and nmax is not None:
+        raise ValueError("Cannot specify both idxlist and nmax.")
+
+    if nmax is not None:
+        lengths = lengths[:nmax]
+        offsets = offsets[:nmax]
+
+    if idxlist is not None:
+        # make sure idxlist is sorted and unique
+        if not np.all(np.diff(idxlist) > 0):
+            raise ValueError("idxlist must be sorted and unique.")
+        # make sure idxlist is within range
+        if np.min(idxlist) < 0 or np.max(idxlist) >= lengths.shape[0]:
+            raise ValueError(
+                "idxlist elements must be in [%i, %i), but covers range [%i, %i]."
+                % (0, lengths.shape[0], np.min(idxlist), np.max(idxlist))
+            )
+        offsets = offsets[idxlist]
+        lengths = lengths[idxlist]
+
+    if len(lengths) == len(offsets):
+        # the offsets array here is one longer here, holding the total number of particles in the last halo.
+        offsets = np.concatenate([offsets, [offsets[-1] + lengths[-1]]])
+    return offsets, lengths
+
+
+def _get_io_fields(cntr: FieldContainer, grp=None) -> List[str]:
+    """
+    Names of the fields of a container that are stored on disk.
+
+    Parameters
+    ----------
+    cntr: FieldContainer
+    grp: Optional[h5py.Group]
+        Group of the container in the (cache) file. If not given, all fields not derived from other fields.
+
+    Returns
+    -------
+    List[str]
+    """
+    if grp is not None:
+        return [k for k, v in grp.items() if isinstance(v, h5py.Dataset) and k in cntr]
+    recipes = cntr._fieldrecipes
+    return [
+        k for k in cntr.keys(withgroups=False) if k not in recipes or getattr(recipes[k], "type", None) == FieldType.IO
+    ]
+
+
+def _get_entry_nbytes(arrs) -> int:
+    """Number of bytes per particle for the given input fields."""
+    nbytes = 0
+    for arr in arrs:
+        arr = arr.magnitude if hasattr(arr, "magnitude") else arr
+        nbytes += np.dtype(arr.dtype).itemsize * int(np.prod(arr.shape[1:]))
+    return nbytes
+
+
+def _plan_group_chunks(
+    offsets,
+    lengths,
+    entry_nbytes_in,
+    entry_nbytes_out,
+    selection=False,
+    gap_tolerance=None,
+    **kwargs,
+):
+    """
+    Plan the chunks of groups processed together and the particle range read for each.
+
+    Parameters
+    ----------
+    offsets: np.ndarray
+        Offsets of the groups as returned by _select_groups.
+    lengths: np.ndarray
+        Lengths of the groups.
+    entry_nbytes_in: int
+        Number of input bytes per particle.
+    entry_nbytes_out: int
+        Number of output bytes per group.
+    selection: bool
+        Whether the groups are a selection (idxlist), so that particles between them might be skipped.
+    gap_tolerance: Optional[int]
+        Only for selections: the maximum number of particles between groups read to process them together.
+    kwargs:
+        Passed to map_group_operation_get_chunkedges.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        chunk edges (in group indices) and the start and end of the particle range read for each chunk
+    """
+    # list_chunkedges refers to bounds of index intervals to be processed together
+    # if idxlist is specified, then these indices do not have to refer to group indices,
+    # and particles between the selected groups are only read if the gap is small.
+    ends = offsets[:-1] + lengths
+    gaps = offsets[1:-1] - ends[:-1]
+    cuts = np.zeros(0, dtype=np.int64)
+    lengths_read = lengths
+    if selection:
+        if gap_tolerance is None:
+            gap_tolerance = 2**20 // max(int(entry_nbytes_in), 1)  # ~1 MiB of input data
+        cuts = np.flatnonzero(gaps > gap_tolerance) + 1
+        lengths_read = lengths + np.append(np.where(gaps > gap_tolerance, 0, gaps), 0)
+    list_chunkedges = map_group_operation_get_chunkedges(lengths_read, entry_nbytes_in, entry_nbytes_out, **kwargs)
+    if cuts.shape[0] > 0:
+        edges = np.union1d(list_chunkedges.ravel(), cuts)
+        list_chunkedges = np.stack([edges[:-1], edges[1:]], axis=1)
+
+    # the particle range read for each chunk
+    rngstarts = offsets[list_chunkedges[:, 0]]
+    rngends = ends[list_chunkedges[:, 1] - 1]
+    return list_chunkedges, rngstarts, rngends
+
+
+def _get_group_aligned(arr, rngstarts, rngends):
+    """Slice the particle ranges from an array and rechunk it into one chunk per range, dropping units."""
+    if np.all(rngstarts[1:] == rngends[:-1]):
+        arr = arr[rngstarts[0] : rngends[-1]]
+    else:
+        arr = take_ranges(arr, rngstarts, rngends)
+    arr = arr.magnitude if hasattr(arr, "magnitude") else arr
+    arrchunks = (tuple(int(n) for n in rngends - rngstarts),)
+    if len(arr.shape) > 1:
+        arrchunks = arrchunks + (arr.shape[1:],)
+    return arr.rechunk(chunks=arrchunks)
 
 
 def map_group_operation(
@@ -1371,15 +2600,23 @@ def map_group_operation(
     cpucost_halo=1e4,
     nchunks_min: Optional[int] = None,
     chunksize_bytes: Optional[int] = None,
-    entry_nbytes_in: Optional[int] = 4,
+    entry_nbytes_in: Optional[int] = None,
     fieldnames: Optional[List[str]] = None,
     nmax: Optional[int] = None,
     idxlist: Optional[np.ndarray] = None,
+    batch: bool = False,
+    ntasks: Optional[int] = None,
+    gap_tolerance: Optional[int] = None,
+    output_spec: Optional[dict] = None,
+    view: Optional[GroupAlignedView] = None,
 ) -> da.Array:
     """
     Map a function to all halos in a halo catalog.
     Parameters
     ----------
+    batch: bool
+        Whether func processes all halos of a chunk at once. It is called as func(*arrs, offsets=..., lengths=...)
+        with the offsets and lengths of the halos within the passed arrays and returns one result per halo.
     idxlist: Optional[np.ndarray]
         Only process the halos with these indices.
     nmax: Optional[int]
@@ -1392,10 +2629,22 @@ def map_group_operation(
     arrdict
     cpucost_halo
     nchunks_min: Optional[int]
-        Lower bound on the number of halos per chunk.
+        Lower bound on the number of chunks.
     chunksize_bytes
-    entry_nbytes_in
+    entry_nbytes_in: Optional[int]
+        Number of input bytes per particle. Determined from the dtypes of the input fields if not given.
     fieldnames
+    ntasks: Optional[int]
+        Target number of chunks. Defaults to the number of workers of the current scheduler.
+    gap_tolerance: Optional[int]
+        Only for idxlist: the maximum number of particles between selected halos that are read in order to
+        process these halos in the same chunk. Larger gaps are skipped. Defaults to about 1 MiB of input data.
+    output_spec: Optional[dict]
+        Output "shape", "dtype", "units" and "fill_value" for each halo, overriding the keyword arguments of func.
+        Shape and units are inferred by calling func on a single particle if not specified.
+    view: Optional[GroupAlignedView]
+        Group-aligned view of the passed groups to take the chunks and aligned arrays from. Only used if all
+        groups are processed.
 
     Returns
     -------
@@ -1403,118 +2652,44 @@ def map_group_operation(
     """
     if isinstance(func, ChainOps):
         dfltkwargs = func.kwargs
+        batch = batch or func.batch
     else:
         dfltkwargs = get_kwargs(func)
     if fieldnames is None:
         fieldnames = dfltkwargs.get("fieldnames", None)
     if fieldnames is None:
-        fieldnames = get_args(func)
-    units = dfltkwargs.get("units", None)
-    shape = dfltkwargs.get("shape", None)
-    dtype = dfltkwargs.get("dtype", "float64")
-    fill_value = dfltkwargs.get("fill_value", 0)
-
-    if idxlist is not None and nmax is not None:
-        raise ValueError("Cannot specify both idxlist and nmax.")
-
-    lengths_all = lengths
-    offsets_all = offsets
-    if len(lengths) == len(offsets):
-        # the offsets array here is one longer here, holding the total number of particles in the last halo.
-        offsets_all = np.concatenate([offsets_all, [offsets_all[-1] + lengths[-1]]])
-
-    if nmax is not None:
-        lengths = lengths[:nmax]
-        offsets = offsets[:nmax]
-
-    if idxlist is not None:
-        # make sure idxlist is sorted and unique
-        if not np.all(np.diff(idxlist) > 0):
-            raise ValueError("idxlist must be sorted and unique.")
-        # make sure idxlist is within range
-        if np.min(idxlist) < 0 or np.max(idxlist) >= lengths.shape[0]:
-            raise ValueError(
-                "idxlist elements must be in [%i, %i), but covers range [%i, %i]."
-                % (0, lengths.shape[0], np.min(idxlist), np.max(idxlist))
-            )
-        offsets = offsets[idxlist]
-        lengths = lengths[idxlist]
-
-    if len(lengths) == len(offsets):
-        # the offsets array here is one longer here, holding the total number of particles in the last halo.
-        offsets = np.concatenate([offsets, [offsets[-1] + lengths[-1]]])
-
-    # shape/units inference
-    infer_shape = shape is None or (isinstance(shape, str) and shape == "auto")
-    infer_units = units is None
-    infer = infer_shape or infer_units
-    if infer:
-        # attempt to determine shape.
-        if infer_shape:
-            log.debug("No shape specified. Attempting to determine shape of func output.")
-        if infer_units:
-            log.debug("No units specified. Attempting to determine units of func output.")
-        arrs = [arrdict[f][:1].compute() for f in fieldnames]
-        # remove units if present
-        # arrs = [arr.magnitude if hasattr(arr, "magnitude") else arr for arr in arrs]
-        # arrs = [arr.magnitude for arr in arrs]
-        dummyres = None
-        try:
-            dummyres = func(*arrs)
-        except Exception as e:  # noqa
-            log.warning("Exception during shape/unit inference: %s." % str(e))
-        if dummyres is not None:
-            if infer_units and hasattr(dummyres, "units"):
-                units = dummyres.units
-            log.debug("Shape inference: %s." % str(shape))
-        if infer_units and dummyres is None:
-            units_present = any([hasattr(arr, "units") for arr in arrs])
-            if units_present:
-                log.warning("Exception during unit inference. Assuming no units.")
-        if dummyres is None and infer_shape:
-            # due to https://github.com/hgrecco/pint/issues/1037 innocent np.array operations on unit scalars can fail.
-            # we can still attempt to infer shape by removing units prior to calling func.
-            arrs = [arr.magnitude if hasattr(arr, "magnitude") else arr for arr in arrs]
-            try:
-                dummyres = func(*arrs)
-            except Exception as e:  # noqa
-                # no more logging needed here
-                pass
-        if dummyres is not None and infer_shape:
-            if np.isscalar(dummyres):
-                shape = (1,)
-            else:
-                shape = dummyres.shape
-        if infer_shape and dummyres is None and shape is None:
-            log.warning("Exception during shape inference. Using shape (1,).")
-            shape = ()
-    # unit inference
-
-    # Determine chunkedges automatically
-    # TODO: very messy and inefficient routine. improve some time.
-    # TODO: Set entry_bytes_out
-    nbytes_dtype_out = 4  # TODO: hardcode 4 byte output dtype as estimate for now
-    entry_nbytes_out = nbytes_dtype_out * np.prod(shape)
-
-    # list_chunkedges refers to bounds of index intervals to be processed together
-    # if idxlist is specified, then these indices do not have to refer to group indices.
-    # if idxlist is given, we enforce that particle data is contiguous
-    # by putting each idx from idxlist into its own chunk.
-    # in the future, we should optimize this
-    if idxlist is not None:
-        list_chunkedges = [[idx, idx + 1] for idx in np.arange(len(idxlist))]
+        fieldnames = [k for k in get_args(func) if not (batch and k in ["offsets", "lengths"])]
+    shape, dtype, units, fill_value, explicit_dtype = _resolve_output_spec(
+        func, [arrdict[f] for f in fieldnames], output_spec=output_spec, batch=batch
+    )
+    offsets, lengths = _select_groups(offsets, lengths, nmax=nmax, idxlist=idxlist)
+
+    if entry_nbytes_in is None:
+        entry_nbytes_in = _get_entry_nbytes([arrdict[f] for f in fieldnames])
+    entry_nbytes_out = np.dtype(dtype if dtype is not None else "float64").itemsize * int(np.prod(shape))
+    use_view = view is not None and nmax is None and idxlist is None
+    if use_view and not view.fits(
+        entry_nbytes_in, entry_nbytes_out, chunksize_bytes=chunksize_bytes, nchunks_min=nchunks_min
+    ):
+        log.debug("Chunks of the group-aligned view exceed the memory limit of the operation, re-planning.")
+        use_view = False
+    if use_view:
+        list_chunkedges, rngstarts, rngends = view.chunkedges, view.rngstarts, view.rngends
+        align = view.align
     else:
-        list_chunkedges = map_group_operation_get_chunkedges(
+        list_chunkedges, rngstarts, rngends = _plan_group_chunks(
+            offsets,
             lengths,
             entry_nbytes_in,
             entry_nbytes_out,
+            selection=idxlist is not None,
+            gap_tolerance=gap_tolerance,
             cpucost_halo=cpucost_halo,
             nchunks_min=nchunks_min,
             chunksize_bytes=chunksize_bytes,
+            ntasks=ntasks,
         )
-
-    minentry = offsets[0]
-    maxentry = offsets[-1]  # the last particle that needs to be processed
+        align = functools.partial(_get_group_aligned, rngstarts=rngstarts, rngends=rngends)
 
     # chunks specify the number of groups in each chunk
     chunks = [tuple(np.diff(list_chunkedges, axis=1).flatten())]
@@ -1524,33 +2699,13 @@ def map_group_operation(
         chunks += [(s,) for s in shape]
         new_axis = np.arange(1, len(shape) + 1).tolist()
 
-    # slcoffsets = [offsets[chunkedge[0]] for chunkedge in list_chunkedges]
-    # the actual length of relevant data in each chunk
-    slclengths = [offsets[chunkedge[1]] - offsets[chunkedge[0]] for chunkedge in list_chunkedges]
-    if idxlist is not None:
-        # the chunk length to be fed into map_blocks
-        tmplist = np.concatenate([idxlist, [len(lengths_all)]])
-        slclengths_map = [
-            offsets_all[tmplist[chunkedge[1]]] - offsets_all[tmplist[chunkedge[0]]] for chunkedge in list_chunkedges
-        ]
-        slcoffsets_map = [offsets_all[tmplist[chunkedge[0]]] for chunkedge in list_chunkedges]
-        slclengths_map[0] = slcoffsets_map[0]
-        slcoffsets_map[0] = 0
-    else:
-        slclengths_map = slclengths
-
     slcs = [slice(chunkedge[0], chunkedge[1]) for chunkedge in list_chunkedges]
     offsets_in_chunks = [offsets[slc] - offsets[slc.start] for slc in slcs]
     lengths_in_chunks = [lengths[slc] for slc in slcs]
     d_oic = delayed(offsets_in_chunks)
     d_hic = delayed(lengths_in_chunks)
 
-    arrs = [arrdict[f][minentry:maxentry] for f in fieldnames]
-    for i, arr in enumerate(arrs):
-        arrchunks = ((tuple(slclengths)),)
-        if len(arr.shape) > 1:
-            arrchunks = arrchunks + (arr.shape[1:],)
-        arrs[i] = arr.rechunk(chunks=arrchunks)
+    arrs = [align(arrdict[f]) for f in fieldnames]
     arrdims = np.array([len(arr.shape) for arr in arrs])
 
     assert np.all(arrdims == arrdims[0])  # Cannot handle different input dims for now
@@ -1575,7 +2730,182 @@ def map_group_operation(
         func_output_shape=shape,
         func_output_dtype=dtype,
         fill_value=fill_value,
+        batch=batch,
+        cast_output=explicit_dtype,
         output_units=units,
     )
 
     return calc
+
+
+def wrap_funcs_aggregate(offsets, lengths, *arrs, funcs=None, argindices=None, out_dtype=None, fill_values=None):
+    """
+    Wrapper for applying several functions to each halo in the passed chunk, filling a structured array.
+
+    Parameters
+    ----------
+    offsets: np.ndarray
+        Offsets of the halos within the chunk.
+    lengths: np.ndarray
+        Number of particles of the halos.
+    arrs: np.ndarray
+        Input arrays of the chunk.
+    funcs: Dict[str, callable]
+        Function for each output field.
+    argindices: Dict[str, List[int]]
+        Indices of the input arrays passed to the function of each output field.
+    out_dtype: np.dtype
+        Structured dtype of the result.
+    fill_values: Dict[str, object]
+        Result of each output field for empty halos.
+
+    Returns
+    -------
+    np.ndarray
+    """
+    res = np.empty(lengths.shape[0], dtype=out_dtype)
+    for name, func in funcs.items():
+        dtype = out_dtype[name]
+        res[name] = apply_to_groups(
+            func,
+            offsets,
+            lengths,
+            *[arrs[i] for i in argindices[name]],
+            func_output_shape=dtype.shape if dtype.shape != () else (1,),
+            func_output_dtype=dtype.base,
+            fill_value=fill_values[name],
+        )
+    return res
+
+
+def map_group_aggregation(
+    funcs: Dict[str, callable],
+    offsets,
+    lengths,
+    arrdict,
+    fieldnames: Dict[str, List[str]],
+    cpucost_halo=1e4,
+    nchunks_min: Optional[int] = None,
+    chunksize_bytes: Optional[int] = None,
+    nmax: Optional[int] = None,
+    idxlist: Optional[np.ndarray] = None,
+    ntasks: Optional[int] = None,
+    gap_tolerance: Optional[int] = None,
+    output_specs: Optional[Dict[str, dict]] = None,
+    view: Optional[GroupAlignedView] = None,
+) -> Dict[str, da.Array]:
+    """
+    Map several functions to all halos in a halo catalog in a single pass over the particles.
+    Each input field is read and rechunked once and all functions are evaluated in the same task per chunk.
+
+    Parameters
+    ----------
+    funcs: Dict[str, callable]
+        Function to apply to each halo for each output.
+    offsets: np.ndarray
+        Offset of each group in the particle catalog.
+    lengths: np.ndarray
+        Number of particles per halo.
+    arrdict
+        Input fields.
+    fieldnames: Dict[str, List[str]]
+        Names of the input fields passed to the function of each output.
+    cpucost_halo
+    nchunks_min: Optional[int]
+        Lower bound on the number of chunks.
+    chunksize_bytes
+    nmax: Optional[int]
+        Only process the first nmax halos.
+    idxlist: Optional[np.ndarray]
+        Only process the halos with these indices.
+    ntasks: Optional[int]
+        Target number of chunks. Defaults to the number of workers of the current scheduler.
+    gap_tolerance: Optional[int]
+        Only for idxlist, see map_group_operation.
+    output_specs: Optional[Dict[str, dict]]
+        Output specification for (some of) the outputs, see map_group_operation.
+    view: Optional[GroupAlignedView]
+        Group-aligned view of the passed groups, see map_group_operation.
+
+    Returns
+    -------
+    Dict[str, da.Array]
+        Result for each output. The arrays share the same tasks, so they should be computed together.
+    """
+    if output_specs is None:
+        output_specs = dict()
+    funcs = {name: func if isinstance(func, ChainOps) else ChainOps(func) for name, func in funcs.items()}
+    inputs = list(dict.fromkeys(f for name in funcs for f in fieldnames[name]))
+    argindices = {name: [inputs.index(f) for f in fieldnames[name]] for name in funcs}
+    specs = dict()
+    for name, func in funcs.items():
+        spec = _resolve_output_spec(func, [arrdict[f] for f in fieldnames[name]], output_spec=output_specs.get(name))
+        specs[name] = spec[:4]  # results are cast into the structured output array in any case
+    out_dtype = np.dtype([
+        (name, dtype, tuple(shape) if shape not in [(1,), ()] else ()) for name, (shape, dtype, _, _) in specs.items()
+    ])
+
+    offsets, lengths = _select_groups(offsets, lengths, nmax=nmax, idxlist=idxlist)
+    entry_nbytes_in = _get_entry_nbytes([arrdict[f] for f in inputs])
+    use_view = view is not None and nmax is None and idxlist is None
+    if use_view and not view.fits(
+        entry_nbytes_in, out_dtype.itemsize, chunksize_bytes=chunksize_bytes, nchunks_min=nchunks_min
+    ):
+        log.debug("Chunks of the group-aligned view exceed the memory limit of the aggregation, re-planning.")
+        use_view = False
+    if use_view:
+        list_chunkedges, rngstarts, rngends = view.chunkedges, view.rngstarts, view.rngends
+        align = view.align
+    else:
+        list_chunkedges, rngstarts, rngends = _plan_group_chunks(
+            offsets,
+            lengths,
+            entry_nbytes_in,
+            out_dtype.itemsize,
+            selection=idxlist is not None,
+            gap_tolerance=gap_tolerance,
+            cpucost_halo=cpucost_halo,
+            nchunks_min=nchunks_min,
+            chunksize_bytes=chunksize_bytes,
+            ntasks=ntasks,
+        )
+        align = functools.partial(_get_group_aligned, rngstarts=rngstarts, rngends=rngends)
+    groupchunks = tuple(int(n) for n in np.diff(list_chunkedges, axis=1).ravel())
+    # offsets of the halos relative to the particle range read for their chunk
+    offsets_in_chunks = offsets[:-1] - np.repeat(rngstarts, groupchunks)
+    args = [
+        da.from_array(offsets_in_chunks, chunks=(groupchunks,)),
+        "i",
+        da.from_array(lengths, chunks=(groupchunks,)),
+        "i",
+    ]
+    ndims = 0
+    for f in inputs:
+        arr = arrdict[f]
+        arr = arr.magnitude if hasattr(arr, "magnitude") else arr
+        # trailing axes get unique indices, so that fields of different shapes can be combined
+        index = ("i",) + tuple("j%i" % k for k in range(ndims, ndims + arr.ndim - 1))
+        ndims += arr.ndim - 1
+        args += [align(arr), index]
+
+    calc = da.blockwise(
+        wrap_funcs_aggregate,
+        "i",
+        *args,
+        funcs=funcs,
+        argindices=argindices,
+        out_dtype=out_dtype,
+        fill_values={name: spec[3] for name, spec in specs.items()},
+        dtype=out_dtype,
+        meta=np.empty((0,), dtype=out_dtype),
+        concatenate=True,
+        align_arrays=False,
+        adjust_chunks={"i": groupchunks},
+    )
+
+    res = dict()
+    for name, (_, _, units, _) in specs.items():
+        res[name] = calc[name]
+        if units is not None:
+            res[name] = res[name] * units
+    return res
@@ -0,0 +1,279 @@
+"""
+Exported particle data of halos and subhalos in Arepo snapshots.
+
+The particles of each exported halo or subhalo are written into their own compact HDF5 file. An index file
+lists the exported objects, their particle numbers and fields, and a fingerprint of the snapshot and catalog
+files. Selections of exported objects can then be served from these files instead of the snapshot.
+"""
+
+import hashlib
+import logging
+import os
+from typing import Optional
+
+import dask.array as da
+import h5py
+import numpy as np
+
+from scida.helpers_hdf5 import get_filestats
+from scida.io.filehandles import HDF5DatasetReference
+from scida.misc import get_pathfiles, return_cachefile_path
+
+log = logging.getLogger(__name__)
+
+_version = 1
+
+
+def get_groupexport_fingerprint(snappath, catalogpath) -> str:
+    """
+    Return a fingerprint of the state of the snapshot and catalog files.
+
+    Parameters
+    ----------
+    snappath: str
+        Path to the snapshot.
+    catalogpath: str
+        Path to the group catalog.
+
+    Returns
+    -------
+    str
+    """
+    sha = hashlib.sha256()
+    sha.update(str(_version).encode())
+    for path in [snappath, catalogpath]:
+        files = get_pathfiles(path)
+        mtimes, sizes = get_filestats(files)
+        sha.update(os.path.realpath(path).encode())
+        sha.update("".join(files).encode())
+        sha.update(mtimes.tobytes())
+        sha.update(sizes.tobytes())
+    return sha.hexdigest()[:32]
+
+
+def get_groupexport_path(snappath, catalogpath) -> Optional[str]:
+    """
+    Return the default directory of exported halos/subhalos for a snapshot and its catalog.
+
+    Parameters
+    ----------
+    snappath: str
+        Path to the snapshot.
+    catalogpath: str
+        Path to the group catalog.
+
+    Returns
+    -------
+    Optional[str]
+        Path in the cache directory, None if there is no cache directory. The directory is not created.
+    """
+    sha = hashlib.sha256()
+    sha.update(os.path.realpath(snappath).encode())
+    sha.update(os.path.realpath(catalogpath).encode())
+    return return_cachefile_path(os.path.join("groupexports", sha.hexdigest()[:32]), create=False)
+
+
+def get_groupexport_indexpath(path, objtype) -> str:
+    """
+    Return the path of the index file of exported halos or subhalos.
+
+    Parameters
+    ----------
+    path: str
+        Directory holding the exported files.
+    objtype: str
+        "halo" or "subhalo".
+
+    Returns
+    -------
+    str
+    """
+    return os.path.join(path, "index_%s.hdf5" % objtype)
+
+
+def write_groupfile(fn, arrs, attrs=None) -> None:
+    """
+    Write the particle data of a halo or subhalo to a HDF5 file.
+
+    Parameters
+    ----------
+    fn: str
+        Path of the file.
+    arrs: dict
+        Maps dataset paths, e.g. "PartType0/Masses", to arrays.
+    attrs: Optional[dict]
+        Attributes of the file's root group.
+
+    Returns
+    -------
+    None
+    """
+    tmppath = "%s.%i.tmp" % (fn, os.getpid())
+    with h5py.File(tmppath, "w") as hf:
+        for k, v in (attrs or {}).items():
+            hf.attrs[k] = v
+        for k, arr in arrs.items():
+            hf.create_dataset(k, data=np.asarray(arr))
+    os.replace(tmppath, fn)  # other processes never see partially written files
+
+
+class GroupExport:
+    """
+    Index of the halos or subhalos exported to per-object files in a directory.
+    """
+
+    def __init__(self, path, objtype, fingerprint, ids=None, lengths=None, fields=None):
+        """
+        Initialize the index.
+
+        Parameters
+        ----------
+        path: str
+            Directory holding the exported files.
+        objtype: str
+            "halo" or "subhalo".
+        fingerprint: str
+            Fingerprint of the snapshot and catalog files, see get_groupexport_fingerprint.
+        ids: Optional[np.ndarray]
+            Sorted indices of the exported objects.
+        lengths: Optional[np.ndarray]
+            Number of particles of each type in the exported objects, shape (N, 6).
+        fields: Optional[dict]
+            Exported fields for each particle type.
+        """
+        self.path = path
+        self.objtype = objtype
+        self.fingerprint = fingerprint
+        self.ids = np.zeros(0, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        self.lengths = np.zeros((0, 6), dtype=np.int64) if lengths is None else np.asarray(lengths, dtype=np.int64)
+        self.fields = dict() if fields is None else fields
+
+    @property
+    def indexpath(self) -> str:
+        """Path of the index file."""
+        return get_groupexport_indexpath(self.path, self.objtype)
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def __contains__(self, idx):
+        return bool(np.all(np.isin(idx, self.ids)))
+
+    def __repr__(self):
+        return "GroupExport(path='%s', objtype='%s', n=%i)" % (self.path, self.objtype, len(self))
+
+    def get_filename(self, idx) -> str:
+        """
+        Return the path of the file of an exported object.
+
+        Parameters
+        ----------
+        idx: int
+            Halo or subhalo index.
+
+        Returns
+        -------
+        str
+        """
+        return os.path.join(self.path, "%s_%i.hdf5" % (self.objtype, idx))
+
+    def add(self, ids, lengths) -> None:
+        """
+        Add exported objects to the index.
+
+        Parameters
+        ----------
+        ids: np.ndarray
+            Halo or subhalo indices.
+        lengths: np.ndarray
+            Number of particles of each type in the objects, shape (N, 6).
+
+        Returns
+        -------
+        None
+        """
+        ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        lengths = np.concatenate([self.lengths, np.asarray(lengths, dtype=np.int64).reshape(-1, 6)])
+        self.ids, first = np.unique(ids, return_index=True)
+        self.lengths = lengths[first]
+
+    def get_array(self, idx, parttype, field, shape, dtype) -> da.Array:
+        """
+        Return a field of an exported object.
+
+        Parameters
+        ----------
+        idx: int
+            Halo or subhalo index.
+        parttype: str
+            Particle type.
+        field: str
+            Field name.
+        shape: tuple
+            Shape of a field's entry beyond the first axis.
+        dtype: np.dtype
+            Data type of the field.
+
+        Returns
+        -------
+        da.Array
+        """
+        pos = int(np.searchsorted(self.ids, idx))
+        n = int(self.lengths[pos, int(parttype[-1])])
+        ref = HDF5DatasetReference(self.get_filename(idx), "/%s/%s" % (parttype, field), (n, *shape), dtype)
+        return da.from_array(ref, chunks=-1)
+
+    def write_index(self) -> None:
+        """
+        Write the index file.
+
+        Returns
+        -------
+        None
+        """
+        tmppath = "%s.%i.tmp" % (self.indexpath, os.getpid())
+        with h5py.File(tmppath, "w") as hf:
+            hf.attrs["version"] = _version
+            hf.attrs["objtype"] = self.objtype
+            hf.attrs["fingerprint"] = self.fingerprint
+            hf.create_dataset("ids", data=self.ids)
+            hf.create_dataset("LenType", data=self.lengths)
+            grp = hf.create_group("fields")
+            for p, fields in self.fields.items():
+                grp.attrs[p] = np.array(fields, dtype=h5py.string_dtype())
+        os.replace(tmppath, self.indexpath)
+
+    @classmethod
+    def read(cls, path, objtype) -> Optional["GroupExport"]:
+        """
+        Read the index of exported objects in a directory.
+
+        Parameters
+        ----------
+        path: str
+            Directory holding the exported files.
+        objtype: str
+            "halo" or "subhalo".
+
+        Returns
+        -------
+        Optional[GroupExport]
+            The index or None if it does not exist or cannot be read.
+        """
+        if path is None:
+            return None
+        indexpath = get_groupexport_indexpath(path, objtype)
+        if not os.path.exists(indexpath):
+            return None
+        try:
+            with h5py.File(indexpath, "r") as hf:
+                if hf.attrs.get("version", -1) != _version:
+                    return None
+                fields = {
+                    p: [f.decode() if isinstance(f, bytes) else str(f) for f in v]
+                    for p, v in hf["fields"].attrs.items()
+                }
+                return cls(path, objtype, str(hf.attrs["fingerprint"]), hf["ids"][()], hf["LenType"][()], fields)
+        except OSError as e:
+            log.warning("Could not read group export index '%s': %s", indexpath, e)
+            return None
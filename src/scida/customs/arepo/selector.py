@@ -4,13 +4,144 @@ Selector for ArepoSnapshot
 
 from typing import TYPE_CHECKING, Optional
 
+import dask.array as da
+import numpy as np
+
 from scida.customs.arepo.helpers import grp_type_str
+from scida.fields import FieldContainer
 from scida.interface import Selector
+from scida.misc import coalesce_ranges, take_ranges
 
 if TYPE_CHECKING:
     from scida.customs.arepo.snapshot import ArepoSnapshot
 
 
+def _get_exported_field(export, ids, parttype, field, arr):
+    """
+    Return a field of exported halos/subhalos, concatenated in the order of the given indices.
+
+    Parameters
+    ----------
+    export: GroupExport
+        The export holding the halos/subhalos.
+    ids: np.ndarray
+        Halo or subhalo indices.
+    parttype: str
+        Particle type.
+    field: str
+        Field name.
+    arr: Union[da.Array, pint.Quantity]
+        The field of the full snapshot, used for the shape, data type and units.
+
+    Returns
+    -------
+    Union[da.Array, pint.Quantity]
+    """
+    mag = getattr(arr, "magnitude", arr)
+    arrs = [export.get_array(idx, parttype, field, mag.shape[1:], mag.dtype) for idx in ids]
+    res = arrs[0] if len(arrs) == 1 else da.concatenate(arrs, axis=0)
+    if hasattr(arr, "units"):
+        res = res * arr.units
+    return res
+
+
+class GroupSelection:
+    """
+    Particle data of several halos or subhalos.
+    The particles of each type are concatenated in the order of the selected groups. Indexing with a
+    string returns the concatenated data, indexing with an integer the data of the group at that position.
+    """
+
+    def __init__(self, data: FieldContainer, ids, objtype, offsets, lengths) -> None:
+        """
+        Initialize the selection.
+
+        Parameters
+        ----------
+        data: FieldContainer
+            Concatenated particle data of the selected groups.
+        ids: np.ndarray
+            Halo or subhalo indices of the selected groups.
+        objtype: str
+            "halo" or "subhalo".
+        offsets: dict
+            Offsets of the groups in the concatenated data for each particle type.
+        lengths: dict
+            Number of particles of the groups for each particle type.
+        """
+        self.data = data
+        self.ids = ids
+        self.objtype = objtype
+        self.offsets = offsets
+        self.lengths = lengths
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        return self.group(key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.group(i)
+
+    def keys(self):
+        """Keys of the concatenated data."""
+        return self.data.keys()
+
+    def group(self, i) -> FieldContainer:
+        """
+        Return the particle data of the group at the given position of the selection.
+
+        Parameters
+        ----------
+        i: int
+            Position of the group in the selection.
+
+        Returns
+        -------
+        FieldContainer
+        """
+        if i < -len(self) or i >= len(self):
+            raise IndexError("Selection holds %i groups." % len(self))
+        res = self.data.copy_skeleton()
+        for p in self.data:
+            if p not in self.offsets:
+                for k, v in self.data[p].items():
+                    res[p][k] = v
+                continue
+            o, n = int(self.offsets[p][i]), int(self.lengths[p][i])
+            for k, v in self.data[p].items():
+                res[p][k] = v[o : o + n]
+        return res
+
+    def get_group(self, idx) -> FieldContainer:
+        """
+        Return the particle data of a selected group by its halo or subhalo index.
+
+        Parameters
+        ----------
+        idx: int
+            Halo or subhalo index.
+
+        Returns
+        -------
+        FieldContainer
+        """
+        pos = np.flatnonzero(self.ids == idx)
+        if pos.shape[0] == 0:
+            raise KeyError("%s %i is not part of the selection." % (self.objtype, idx))
+        return self.group(int(pos[0]))
+
+    def __repr__(self):
+        return "GroupSelection(objtype='%s', ngroups=%i)" % (self.objtype, len(self))
+
+
 class ArepoSelector(Selector):
     """Selector for ArepoSnapshot.
     Can select for haloID, subhaloID, and unbound particles."""
@@ -47,6 +178,8 @@ class ArepoSelector(Selector):
         if subhalo_id_local is not None:
             if halo_id is None:
                 raise ValueError("Cannot select for localSubhaloID without haloID.")
+            if np.ndim(halo_id) > 0:
+                raise ValueError("Cannot select for localSubhaloID with multiple haloIDs.")
             # compute subhalo_id from subhalo_id_local
             shid_of_first_sh = snap.data["Group"]["GroupFirstSub"]
             nshs = int(snap.data["Group"]["GroupNsubs"][halo_id].compute())
@@ -56,7 +189,9 @@ class ArepoSelector(Selector):
 
         idx = subhalo_id if subhalo_id is not None else halo_id
         objtype = "subhalo" if subhalo_id is not None else "halo"
-        if idx is not None:
+        if idx is not None and np.ndim(idx) > 0:
+            self.select_groups(snap, idx, objtype=objtype)
+        elif idx is not None:
             self.select_group(snap, idx, objtype=objtype)
         elif unbound is True:
             self.select_unbound(snap)
@@ -105,16 +240,16 @@ class ArepoSelector(Selector):
         -------
         None
         """
-        # TODO: test whether works for multiple groups via idx list
         objtype = grp_type_str(objtype)
         if objtype == "halo":
-            lengths = self.data_backup["Group"]["GroupLenType"][idx, :].compute()
-            offsets = self.data_backup["Group"]["GroupOffsetsType"][idx, :].compute()
+            grpoffsets, grplengths = snap.get_grouptables()
+            offsets, lengths = grpoffsets[idx], grplengths[idx]
         elif objtype == "subhalo":
-            lengths = {i: snap.get_subhalolengths(i)[idx] for i in range(6)}
-            offsets = {i: snap.get_subhalooffsets(i)[idx] for i in range(6)}
+            shoffsets, shlengths = snap.get_subhalotables()
+            offsets, lengths = shoffsets[idx], shlengths[idx]
         else:
             raise ValueError("Unknown object type: %s" % objtype)
+        export = self._get_export(snap, [idx], objtype)
 
         for p in self.data_backup:
             splt = p.split("PartType")
@@ -129,6 +264,82 @@ class ArepoSelector(Selector):
                     offset = offset.magnitude
                 if hasattr(length, "magnitude"):
                     length = length.magnitude
+                exported = export.fields.get(p, []) if export is not None else []
                 for k, v in self.data_backup[p].items():
-                    self.data[p][k] = v[offset : offset + length]
+                    if k in exported:
+                        self.data[p][k] = _get_exported_field(export, [idx], p, k, v)
+                    else:
+                        self.data[p][k] = v[offset : offset + length]
         snap.data = self.data
+
+    def select_groups(self, snap, ids, objtype="halo"):
+        """
+        Select particles of several groups/subhalos.
+        Contiguous groups are read as one range, and the particles of the selected groups are concatenated.
+
+        Parameters
+        ----------
+        snap: ArepoSnapshot
+        ids: np.ndarray
+            Halo or subhalo indices.
+        objtype: str
+
+        Returns
+        -------
+        None
+        """
+        objtype = grp_type_str(objtype)
+        ids = np.asarray(ids, dtype=np.int64).ravel()
+        if objtype == "halo":
+            offsets, lengths = snap.get_grouptables()
+        elif objtype == "subhalo":
+            offsets, lengths = snap.get_subhalotables()
+        else:
+            raise ValueError("Unknown object type: %s" % objtype)
+        if ids.shape[0] > 0 and (ids.min() < 0 or ids.max() >= lengths.shape[0]):
+            raise ValueError("%s indices must be in [0, %i)." % (objtype, lengths.shape[0]))
+        offsets, lengths = offsets[ids], lengths[ids]
+        export = self._get_export(snap, ids, objtype)
+
+        seloffsets, sellengths = dict(), dict()
+        for p in self.data_backup:
+            splt = p.split("PartType")
+            if len(splt) == 1:
+                for k, v in self.data_backup[p].items():
+                    self.data[p][k] = v
+                continue
+            pnum = int(splt[1])
+            starts, ends = coalesce_ranges(offsets[:, pnum], lengths[:, pnum])
+            sellengths[p] = lengths[:, pnum]
+            seloffsets[p] = np.concatenate([[0], np.cumsum(sellengths[p])[:-1]]).astype(np.int64)
+            exported = export.fields.get(p, []) if export is not None else []
+            for k, v in self.data_backup[p].items():
+                if k in exported:
+                    self.data[p][k] = _get_exported_field(export, ids, p, k, v)
+                else:
+                    self.data[p][k] = take_ranges(v, starts, ends)
+        snap.data = GroupSelection(self.data, ids, objtype, seloffsets, sellengths)
+
+    @staticmethod
+    def _get_export(snap, ids, objtype):
+        """
+        Return the export of halos/subhalos holding all given indices, see ArepoSnapshot.export_groups().
+
+        Parameters
+        ----------
+        snap: ArepoSnapshot
+        ids: Union[List[int], np.ndarray]
+            Halo or subhalo indices.
+        objtype: str
+
+        Returns
+        -------
+        Optional[GroupExport]
+            None if there is no export or it does not hold all indices.
+        """
+        if len(ids) == 0 or not hasattr(snap, "get_group_export"):
+            return None
+        export = snap.get_group_export(objtype)
+        if export is None or ids not in export:
+            return None
+        return export
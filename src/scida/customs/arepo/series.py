@@ -37,6 +37,24 @@ class ArepoSimulation(GadgetStyleSimulation):
         arg_dict = dict(gpaths="catalog")
         super().__init__(path, prefix_dict=prefix_dict, arg_dict=arg_dict, lazy=lazy, **interface_kwargs)
 
+    @classmethod
+    def check_fingerprint(cls, fingerprint: dict) -> bool:
+        """
+        Prune paths that cannot be valid for this simulation class.
+
+        Parameters
+        ----------
+        fingerprint: dict
+            Fingerprint of the path, see scida.discovertypes.get_fingerprint.
+
+        Returns
+        -------
+        bool
+        """
+        if not super().check_fingerprint(fingerprint):
+            return False
+        return fingerprint["isdir"] and "gizmo_parameters.txt" not in fingerprint["entries"]
+
     @classmethod
     def validate_path(cls, path, *args, **kwargs) -> CandidateStatus:
         """
@@ -90,6 +90,28 @@ class GadgetStyleSnapshot(Dataset):
             return "groups"  # "groups" over "fof_subhalo_tab"
         return prfxs[0]
 
+    @classmethod
+    def check_fingerprint(cls, fingerprint: dict) -> bool:
+        """
+        Prune paths that cannot be valid for this interface.
+
+        Parameters
+        ----------
+        fingerprint: dict
+            Fingerprint of the path, see scida.discovertypes.get_fingerprint.
+
+        Returns
+        -------
+        bool
+        """
+        if not super().check_fingerprint(fingerprint):
+            return False
+        if fingerprint["suffix"] not in ["hdf5", "zarr"] and "hdf5" not in fingerprint["suffixes"]:
+            return False
+        if fingerprint["attrs"] is not None and "/Header" not in fingerprint["attrs"]:
+            return False
+        return True
+
     @classmethod
     def validate_path(cls, path: Union[str, os.PathLike], *args, expect_grp=False, **kwargs) -> CandidateStatus:
         """
@@ -30,6 +30,24 @@ class GizmoSimulation(GadgetStyleSimulation):
             **interface_kwargs,
         )
 
+    @classmethod
+    def check_fingerprint(cls, fingerprint: dict) -> bool:
+        """
+        Prune paths that cannot be valid for this simulation class.
+
+        Parameters
+        ----------
+        fingerprint: dict
+            Fingerprint of the path, see scida.discovertypes.get_fingerprint.
+
+        Returns
+        -------
+        bool
+        """
+        if not super().check_fingerprint(fingerprint):
+            return False
+        return fingerprint["isdir"] and "gizmo_parameters.txt" in fingerprint["entries"]
+
     @classmethod
     def validate_path(cls, path, *args, **kwargs) -> CandidateStatus:
         """
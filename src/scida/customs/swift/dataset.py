@@ -27,6 +27,24 @@ class SwiftSnapshot(GadgetStyleSnapshot):
 
         super().__init__(path, chunksize=chunksize, virtualcache=virtualcache, **kwargs)
 
+    @classmethod
+    def check_fingerprint(cls, fingerprint: dict) -> bool:
+        """
+        Prune paths that cannot be valid for this dataset class.
+
+        Parameters
+        ----------
+        fingerprint: dict
+            Fingerprint of the path, see scida.discovertypes.get_fingerprint.
+
+        Returns
+        -------
+        bool
+        """
+        if not super().check_fingerprint(fingerprint):
+            return False
+        return fingerprint["attrs"] is None or "/Code" in fingerprint["attrs"]
+
     @classmethod
     def validate_path(cls, path: Union[str, os.PathLike], *args, **kwargs) -> CandidateStatus:
         """
@@ -29,6 +29,24 @@ class SwiftSimulation(GadgetStyleSimulation):
         subpath_dict = dict(paths="snapshots")
         super().__init__(path, subpath_dict=subpath_dict, lazy=lazy, **interface_kwargs)
 
+    @classmethod
+    def check_fingerprint(cls, fingerprint: dict) -> bool:
+        """
+        Prune paths that cannot be valid for this simulation class.
+
+        Parameters
+        ----------
+        fingerprint: dict
+            Fingerprint of the path, see scida.discovertypes.get_fingerprint.
+
+        Returns
+        -------
+        bool
+        """
+        if not super().check_fingerprint(fingerprint):
+            return False
+        return fingerprint["isdir"] and "Code" in fingerprint["entries"]
+
     @classmethod
     def validate_path(cls, path, *args, **kwargs) -> CandidateStatus:
         """
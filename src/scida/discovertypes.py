@@ -2,17 +2,20 @@
 Functionality to determine the dataset or dataseries type of a given path.
 """
 
+import json
 import logging
 import os
+import re
 from collections import Counter
 from enum import Enum
 from functools import reduce
 from inspect import getmro
 from operator import add, itemgetter
 
-from scida.config import get_simulationconfig
+from scida.config import get_config_flag, get_simulationconfig
+from scida.helpers_misc import hash_path
 from scida.io import load_metadata
-from scida.misc import check_config_for_dataset
+from scida.misc import check_config_for_dataset, return_cachefile_path
 from scida.registries import (
     dataseries_type_registry,
     dataset_type_registry,
@@ -54,6 +57,133 @@ class CandidateStatus(Enum):
     YES = 2  # yes, this is a candidate
 
 
+def get_fingerprint(path) -> dict:
+    """
+    Compute a cheap fingerprint of a path to prune candidate types before their full validation.
+
+    Parameters
+    ----------
+    path: str or os.PathLike
+        Path to dataset or dataseries.
+
+    Returns
+    -------
+    dict
+        "isdir": whether the path is a directory,
+        "suffix": suffix of the path,
+        "entries": names of directory entries (empty for files),
+        "suffixes": suffixes of directory entries,
+        "prefixes": file prefixes of directory entries (without trailing snapshot/chunk numbers),
+        "attrs": top-level attribute groups of the metadata, None if not available,
+        "header": attributes in "/Header", None if not available.
+    """
+    path = str(path).rstrip("/")
+    isdir = os.path.isdir(path)
+    entries = sorted(os.listdir(path)) if isdir else []
+    suffix = path.split(".")[-1] if "." in os.path.basename(path) else ""
+    fp = dict(
+        isdir=isdir,
+        suffix=suffix,
+        entries=set(entries),
+        suffixes={f.split(".")[-1] for f in entries},
+        prefixes={re.sub(r"[_.\d]+$", "", f.split(".")[0]) for f in entries},
+        attrs=None,
+        header=None,
+    )
+    if suffix in ["hdf5", "h5", "zarr"] or (isdir and "hdf5" in fp["suffixes"]):
+        try:
+            metadata_raw = load_metadata(path, fileprefix=None)
+        except Exception as e:
+            log.debug("Could not load metadata for fingerprint of '%s': %s", path, e)
+        else:
+            fp["attrs"] = set(metadata_raw.keys())
+            fp["header"] = set(metadata_raw.get("/Header", {}).keys())
+    return fp
+
+
+def _get_registry_hash(reg) -> str:
+    """
+    Hash the names and definitions of the classes in a registry.
+
+    Parameters
+    ----------
+    reg: dict
+        Registry of classes.
+
+    Returns
+    -------
+    str
+    """
+    return hash_path(";".join("%s:%s.%s" % (k, v.__module__, v.__qualname__) for k, v in sorted(reg.items())))
+
+
+def _get_entry_stats(path, depth=1, prefix=""):
+    """
+    Collect the names, modification times and sizes of the entries of a directory.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory.
+    depth: int
+        Number of directory levels to descend into.
+    prefix: str
+        Prefix for the names of the entries.
+
+    Returns
+    -------
+    List[tuple]
+        (name, mtime in ns, size) for each entry.
+    """
+    stats = []
+    with os.scandir(path) as it:
+        for e in it:
+            est = e.stat()
+            name = prefix + e.name
+            stats.append((name, est.st_mtime_ns, est.st_size))
+            if depth > 1 and e.is_dir():
+                stats += _get_entry_stats(e.path, depth=depth - 1, prefix=name + "/")
+    return stats
+
+
+def _get_discoverycache_path(path, reg, **kwargs):
+    """
+    Path of the on-disk memo of the type discovery for the given path, registry and arguments.
+    The memo is invalidated by changes to the modification time or size of the path, its directory
+    entries or the entries of its subdirectories.
+
+    Parameters
+    ----------
+    path: str or os.PathLike
+        Path to dataset or dataseries.
+    reg: dict
+        Registry of classes tested.
+    kwargs: dict
+        Arguments of the discovery.
+
+    Returns
+    -------
+    Optional[str]
+        None if no memo can be used.
+    """
+    if not get_config_flag("persist_discovery_cache"):
+        return None
+    simple = (str, int, float, bool, type(None))
+    for v in kwargs.values():
+        if not isinstance(v, simple) and not (isinstance(v, (list, tuple)) and all(isinstance(e, simple) for e in v)):
+            return None  # cannot reliably key on these arguments
+    try:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        stats = [(path, st.st_mtime_ns, st.st_size)]
+        if os.path.isdir(path):
+            stats += _get_entry_stats(path, depth=2)
+    except OSError:
+        return None
+    key = repr((sorted(stats), sorted(kwargs.items()), _get_registry_hash(reg)))
+    return return_cachefile_path(os.path.join("discovery", hash_path(key) + ".json"))
+
+
 def _determine_mixins(path=None, metadata_raw=None):
     """
     Determine mixins for a given path or metadata_raw.
@@ -166,21 +296,44 @@ def _determine_type(
         List of classes that are candidates.
 
     """
-    available_dtypes: list[str] = []
-    dtypes_status: list[CandidateStatus] = []
     reg = {}
     if test_datasets:
         reg.update(**dataset_type_registry)
     if test_dataseries:
         reg.update(**dataseries_type_registry)
 
+    memopath = _get_discoverycache_path(path, reg, strict=strict, catch_exception=catch_exception, **kwargs)
+    if memopath is not None and os.path.isfile(memopath):
+        try:
+            with open(memopath) as f:
+                names = json.load(f)
+            if len(names) > 0 and all(k in reg for k in names):
+                return names, [reg[k] for k in names]
+        except (OSError, ValueError) as e:
+            log.debug("Could not read type discovery memo '%s': %s", memopath, e)
+
+    # prune candidates by the fingerprint before running the more expensive validation
+    fingerprint = get_fingerprint(path)
+    candidates = {}
     for k, dtype in reg.items():
+        try:
+            if dtype.check_fingerprint(fingerprint):
+                candidates[k] = dtype
+        except Exception as e:
+            log.debug("Exception raised during check_fingerprint of tested type '%s': %s", k, e)
+            candidates[k] = dtype
+
+    available_dtypes: list[str] = []
+    dtypes_status: list[CandidateStatus] = []
+    validation_failed = False  # do not memoize results depending on swallowed exceptions
+    for k, dtype in candidates.items():
         valid = CandidateStatus.NO
 
         if catch_exception:
             try:
                 valid = is_valid_candidate(dtype.validate_path(path, **kwargs))
             except Exception as e:
+                validation_failed = True
                 log.debug("Exception raised during validate_path of tested type '%s': %s", k, e)
         else:
             valid = is_valid_candidate(dtype.validate_path(path, **kwargs))
@@ -216,4 +369,10 @@ def _determine_type(
                 raise ValueError("Ambiguous data type. Available types:", available_dtypes)
             else:
                 log.info("Note: Multiple dataset candidates: %s", available_dtypes)
+    if memopath is not None and not validation_failed:
+        try:
+            with open(memopath, "w") as f:
+                json.dump(available_dtypes, f)
+        except OSError as e:
+            log.debug("Could not write type discovery memo '%s': %s", memopath, e)
     return available_dtypes, [reg[k] for k in available_dtypes]
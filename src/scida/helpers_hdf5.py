@@ -2,18 +2,28 @@
 Helper functions for hdf5 and zarr file processing.
 """
 
+import copy
 import logging
-from collections import OrderedDict
-from concurrent.futures import ProcessPoolExecutor
+import os
+import pickle
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
+import dask
 import h5py
 import numpy as np
 import zarr
+from tqdm import tqdm
 
-from scida.config import get_config
+from scida.config import get_config, get_config_flag
+from scida.helpers_misc import hash_path, parse_humansize
+from scida.misc import return_cachefile_path
 
 log = logging.getLogger(__name__)
 
+# process-wide cache of walked hdf5 files, see walk_hdf5file
+_metadata_cache = dict()
+
 
 def get_dtype(obj):
     """
@@ -108,10 +118,103 @@ def walk_zarrfile(fn, tree, get_attrs=True):
     return tree
 
 
-def walk_hdf5file(fn, tree, get_attrs=True):
+def clear_metadata_cache():
+    """
+    Clear the in-memory cache of walked hdf5 files.
+
+    Returns
+    -------
+    None
+    """
+    _metadata_cache.clear()
+
+
+def _get_metadatacache_path(key):
+    """
+    Path of the persisted metadata cache entry for the given key.
+
+    Parameters
+    ----------
+    key: tuple
+        cache key as created in walk_hdf5file
+
+    Returns
+    -------
+    Optional[str]
+    """
+    if not get_config_flag("persist_metadata_cache"):
+        return None
+    return return_cachefile_path(os.path.join("metadata", hash_path(repr(key)) + ".pkl"))
+
+
+def _get_cached_tree(key):
+    """
+    Look up a walked hdf5 file in memory and on disk.
+
+    Parameters
+    ----------
+    key: tuple
+        cache key as created in walk_hdf5file
+
+    Returns
+    -------
+    Optional[dict]
+        cached tree (not to be modified) or None
+    """
+    tree = _metadata_cache.pop(key, None)
+    if tree is None:
+        fp = _get_metadatacache_path(key)
+        if fp is None or not os.path.isfile(fp):
+            return None
+        try:
+            with open(fp, "rb") as f:
+                cachedkey, tree = pickle.load(f)
+        except Exception as ex:  # corrupt/incompatible cache entries are simply ignored
+            log.debug("Could not read metadata cache '%s': %s", fp, ex)
+            return None
+        if cachedkey != key:
+            return None
+    _metadata_cache[key] = tree  # (re-)insert as most recently used
+    return tree
+
+
+def _set_cached_tree(key, tree):
+    """
+    Store a walked hdf5 file in memory and, if enabled, on disk.
+
+    Parameters
+    ----------
+    key: tuple
+        cache key as created in walk_hdf5file
+    tree: dict
+        tree to store (not to be modified afterwards)
+
+    Returns
+    -------
+    None
+    """
+    maxsize = int(get_config().get("metadata_cache_size", 256))
+    _metadata_cache[key] = tree
+    while len(_metadata_cache) > max(maxsize, 0):
+        _metadata_cache.pop(next(iter(_metadata_cache)))
+    fp = _get_metadatacache_path(key)
+    if fp is None:
+        return
+    try:
+        tmpfp = "%s.%i.tmp" % (fp, os.getpid())
+        with open(tmpfp, "wb") as f:
+            pickle.dump((key, tree), f)
+        os.replace(tmpfp, fp)
+    except OSError as ex:
+        log.debug("Could not write metadata cache '%s': %s", fp, ex)
+
+
+def walk_hdf5file(fn, tree, get_attrs=True, use_cache=True):
     """
     Walks through a hdf5 file and fills the tree dictionary with
     information about the datasets and groups.
+    Results are cached per process by path, modification time and size of the file,
+    and optionally persisted to the cache directory (config option "persist_metadata_cache").
 
     Parameters
     ----------
@@ -121,203 +224,1002 @@ def walk_hdf5file(fn, tree, get_attrs=True):
         dictionary to fill recursively
     get_attrs: bool
         whether to get attributes of each object
+    use_cache: bool
+        whether to use the metadata cache
 
     Returns
     -------
     tree: dict
         filled dictionary
     """
+    key = None
+    if use_cache:
+        st = os.stat(fn)
+        key = (os.path.realpath(fn), st.st_mtime_ns, st.st_size, get_attrs)
+        cached = _get_cached_tree(key)
+        if cached is not None:
+            tree.update(_copy_tree(cached))
+            return tree
     with h5py.File(fn, "r") as hf:
         walk_group(hf, tree, get_attrs=get_attrs)
+    if key is not None:
+        _set_cached_tree(key, _copy_tree(tree))
     return tree
 
 
-def create_mergedhdf5file(fn, files, max_workers=None, virtual=True, groupwise_shape=False):
+def _copy_tree(tree):
     """
-    Creates a virtual hdf5 file from list of given files. Virtual by default.
+    Copy a tree as returned by walk_hdf5file such that modifications do not propagate.
+    Attributes are copied deeply, the immutable shapes and dtypes of datasets are shared.
+
+    Parameters
+    ----------
+    tree: dict
+        tree to copy
+
+    Returns
+    -------
+    dict
+    """
+    return dict(
+        attrs=copy.deepcopy(tree["attrs"]),
+        groups=list(tree["groups"]),
+        datasets=[list(d) for d in tree["datasets"]],
+    )
+
+
+def walk_hdf5files(files, max_workers=None):
+    """
+    Walks through a list of hdf5 files in parallel.
 
     Parameters
     ----------
-    fn: str
-        file to write to
     files: list
-        files to merge
+        file paths to walk through
     max_workers: int
         parallel workers to process files
-    virtual: bool
-        whether to create linked ("virtual") dataset on disk (otherwise copy)
-    groupwise_shape: bool
-        whether to require shapes to be the same within a group
 
     Returns
     -------
-    None
+    list
+        filled tree dictionary for each file
     """
     if max_workers is None:
         # read from config
         config = get_config()
         max_workers = config.get("nthreads", 16)
-    # first obtain all datasets and groups
     trees = [{} for i in range(len(files))]
-
+    if len(files) <= 1 or max_workers <= 1:
+        # not worth spinning up a process pool
+        return list(map(walk_hdf5file, files, trees))
     with ProcessPoolExecutor(max_workers=max_workers) as executor:
         result = executor.map(walk_hdf5file, files, trees)
-    result = list(result)
+    return list(result)
 
-    groups = {item for r in result for item in r["groups"]}
-    datasets = {item[0] for r in result for item in r["datasets"]}
 
-    def todct(lst):
-        """helper func"""
-        return {item[0]: (item[1], item[2]) for item in lst["datasets"]}
+def get_filestats(files):
+    """
+    Get modification time and size of given files, used to detect changes to chunk files.
 
-    dcts = [todct(lst) for lst in result]
-    shapes = OrderedDict((d, {}) for d in datasets)
+    Parameters
+    ----------
+    files: list
+        file paths
 
-    def shps(i, k, s):
-        """helper func"""
-        return shapes[k].update({i: s[0]}) if s is not None else None
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        modification times (in ns) and sizes (in bytes)
+    """
+    stats = [os.stat(fn) for fn in files]
+    mtimes = np.array([st.st_mtime_ns for st in stats], dtype=np.int64)
+    sizes = np.array([st.st_size for st in stats], dtype=np.int64)
+    return mtimes, sizes
 
-    [shps(i, k, dct.get(k)) for k in datasets for i, dct in enumerate(dcts)]
-    dtypes = {}
 
-    def dtps(k, s):
-        """helper func"""
-        return dtypes.update({k: s[1]}) if s is not None else None
+def get_shapetable(trees):
+    """
+    Reduce the walk results of multiple files into a table of dataset lengths.
 
-    [dtps(k, dct.get(k)) for k in datasets for i, dct in enumerate(dcts)]
+    Parameters
+    ----------
+    trees: list
+        tree dictionaries as filled by walk_hdf5file for each file
 
-    # get shapes of the respective chunks
-    chunks = {}
-    for field in sorted(shapes.keys()):
-        chunks[field] = [[k, shapes[field][k][0]] for k in shapes[field]]
-    groupchunks = {}
+    Returns
+    -------
+    names: np.ndarray
+        sorted dataset paths
+    lengths: np.ndarray
+        (nfiles, ndatasets) array holding the length of each dataset's first axis in each file,
+        -1 if the dataset is not present in a file
+    extrashapes: dict
+        shape beyond the first axis for each dataset
+    dtypes: dict
+        dtype for each dataset
+    """
+    records = [(i, *item) for i, tree in enumerate(trees) for item in tree["datasets"] if len(item[1]) > 0]
+    nfiles = len(trees)
+    if len(records) == 0:
+        return np.array([], dtype=str), np.zeros((nfiles, 0), dtype=np.int64), {}, {}
+    fidx = np.fromiter((r[0] for r in records), dtype=np.int64, count=len(records))
+    names, didx = np.unique(np.array([r[1] for r in records]), return_inverse=True)
+    lengths = np.full((nfiles, names.shape[0]), -1, dtype=np.int64)
+    lengths[fidx, didx] = np.fromiter((r[2][0] for r in records), dtype=np.int64, count=len(records))
+    # shape and dtype are taken from the first file holding the respective dataset
+    first = np.unique(didx, return_index=True)[1]
+    extrashapes = {names[didx[i]]: tuple(records[i][2][1:]) for i in first}
+    dtypes = {names[didx[i]]: records[i][3] for i in first}
+    return names, lengths, extrashapes, dtypes
 
-    # assert that all datasets in a given group have the same chunks.
+
+def _get_groupfields(groups, names):
+    """
+    Map each group onto the datasets it holds directly.
+
+    Parameters
+    ----------
+    groups: set
+        group paths
+    names: np.ndarray
+        dataset paths
+
+    Returns
+    -------
+    dict
+        group path to list of column indices into names; the root group is mapped to "".
+    """
+    parents = [name.rsplit("/", 1)[0] for name in names]
+    columns = {}
+    for i, parent in enumerate(parents):
+        columns.setdefault(parent, []).append(i)
+    groupfields = {}
     for group in sorted(groups):
         if group == "/":
             group = ""  # this is needed to have consistent levels for 0th level
-        groupfields = [f for f in shapes.keys() if f.startswith(group)]
-        groupfields = [f for f in groupfields if f.count("/") - 1 == group.count("/")]
-        groupfields = sorted(groupfields)
-        if len(groupfields) == 0:
+        groupfields[group] = columns.get(group, [])
+    return groupfields
+
+
+def _get_chunktable(lengths):
+    """
+    Convert a column of the lengths table into the chunk table stored in the '_chunks' group.
+
+    Parameters
+    ----------
+    lengths: np.ndarray
+        length of a dataset in each file, -1 if not present
+
+    Returns
+    -------
+    np.ndarray
+        (n, 2) array of file index and length for each file holding the dataset
+    """
+    idx = np.nonzero(lengths >= 0)[0]
+    return np.stack([idx, lengths[idx]], axis=1)
+
+
+def _attrs_equal(attrval0, attrvallist):
+    """
+    Check whether all attribute values are equal to the first one.
+
+    Parameters
+    ----------
+    attrval0: object
+        reference value
+    attrvallist: list
+        values to compare
+
+    Returns
+    -------
+    bool
+    """
+    if isinstance(attrval0, np.ndarray):
+        return all(np.array_equal(attrval0, v) for v in attrvallist)
+    if isinstance(attrval0, np.floating):
+        # for floats we do not require binary equality
+        # (we had some incident...)
+        return bool(np.allclose(attrval0, attrvallist))
+    return len({attrval0, *attrvallist}) == 1
+
+
+def _merge_attrs(trees, datasets):
+    """
+    Merge attributes of multiple files. Attributes with different values across
+    files are stacked along a new first axis.
+
+    Parameters
+    ----------
+    trees: list
+        tree dictionaries as filled by walk_hdf5file for each file
+    datasets: set
+        dataset paths
+
+    Returns
+    -------
+    attrs_same: dict
+        attributes that are identical across files
+    attrs_differ: dict
+        attributes that differ across files
+    """
+    # find attributes that change across data sets
+    attrs_key_lists = [list(v["attrs"].keys()) for v in trees]  # attribute paths for each file
+    attrspaths_all = set().union(*attrs_key_lists)
+    attrspaths_intersec = set(attrspaths_all).intersection(*attrs_key_lists)
+    attrspath_diff = attrspaths_all.difference(attrspaths_intersec)
+    # if difference only stems from missing datasets (and their assoc. attrs); thats fine
+    if attrspaths_all != attrspaths_intersec and not attrspath_diff.issubset(datasets):
+        raise NotImplementedError("Some attribute paths not present in each partial data file.")
+    # check for common key+values across all files
+    attrs_same = {}
+    attrs_differ = {}
+    for apath in sorted(attrspaths_all):
+        attrs_same[apath] = {}
+        attrs_differ[apath] = {}
+        attrdicts = [tree["attrs"][apath] for tree in trees if apath in tree["attrs"]]
+        attrsnames = set().union(*attrdicts)
+        for k in attrsnames:
+            # we ignore apaths and k existing in some files.
+            attrvallist = [dct[k] for dct in attrdicts if k in dct]
+            attrval0 = attrvallist[0]
+            if _attrs_equal(attrval0, attrvallist[1:]):
+                attrs_same[apath][k] = attrval0
+                continue
+            log.debug("%s: %s has different values.", apath, k)
+            if isinstance(attrval0, np.ndarray):
+                attrs_differ[apath][k] = np.stack(attrvallist)
+            else:
+                attrs_differ[apath][k] = np.array(attrvallist)
+    return attrs_same, attrs_differ
+
+
+def _create_virtual_dataset(hf, field, files, lengths, extrashape, dtype):
+    """
+    Create a virtual dataset concatenating the given field of all files holding it.
+
+    Parameters
+    ----------
+    hf: h5py.File
+        file to create the virtual dataset in
+    field: str
+        dataset path
+    files: list
+        all chunk files
+    lengths: np.ndarray
+        length of the dataset in each file, -1 if not present
+    extrashape: tuple
+        shape beyond the first axis
+    dtype: np.dtype
+        dtype of the dataset
+
+    Returns
+    -------
+    None
+    """
+    idx = np.nonzero(lengths >= 0)[0]
+    offsets = np.concatenate([[0], np.cumsum(lengths[idx])])
+    newshape = (int(offsets[-1]), *extrashape)
+    layout = h5py.VirtualLayout(shape=newshape, dtype=dtype)
+    for i, k in enumerate(idx):
+        shape = (int(lengths[k]), *extrashape)
+        vsource = h5py.VirtualSource(files[k], name=field, shape=shape, dtype=dtype)
+        layout[offsets[i] : offsets[i + 1]] = vsource
+    hf.create_virtual_dataset(field, layout)
+
+
+def _read_hyperslab(fl, field, start, stop):
+    """
+    Read rows [start, stop) of a dataset in a chunk file.
+
+    Parameters
+    ----------
+    fl: str
+        chunk file to read from
+    field: str
+        dataset path
+    start: int
+        first row
+    stop: int
+        last row (exclusive)
+
+    Returns
+    -------
+    np.ndarray
+    """
+    with h5py.File(fl, "r") as hf:
+        return hf[field][start:stop]
+
+
+def _get_copytasks(hf, files, fields, lengths, offsets, blockbytes):
+    """
+    Split the copy of chunk file datasets into a merged file into blocks of bounded size.
+
+    Parameters
+    ----------
+    hf: h5py.File
+        merged file to write to
+    files: list
+        chunk files to read from
+    fields: list
+        dataset paths, one for each column of lengths
+    lengths: np.ndarray
+        (nfiles, nfields) lengths of the datasets in each file, negative/zero entries are skipped
+    offsets: np.ndarray
+        (nfiles, nfields) offsets of the datasets in the merged file
+    blockbytes: int
+        target size of a block in bytes
+
+    Returns
+    -------
+    list
+        tuples (file, field, start, stop, offset, nbytes)
+    """
+    tasks = []
+    for j, field in enumerate(fields):
+        ds = hf[field]
+        rowbytes = ds.dtype.itemsize * int(np.prod(ds.shape[1:], dtype=np.int64))
+        blockrows = max(1, blockbytes // max(rowbytes, 1))
+        for k in np.nonzero(lengths[:, j] > 0)[0]:
+            n = int(lengths[k, j])
+            for start in range(0, n, blockrows):
+                stop = min(start + blockrows, n)
+                tasks.append((files[k], field, start, stop, int(offsets[k, j]) + start, (stop - start) * rowbytes))
+    return tasks
+
+
+def copy_datasets(hf, files, fields, lengths, offsets, max_workers=None, max_inflight=None, progress=False):
+    """
+    Copy datasets of chunk files into a merged file.
+    Reads are distributed over a process pool while the calling process is the single writer.
+    Reads are split into blocks and the number of bytes read but not yet written is bounded.
+
+    Parameters
+    ----------
+    hf: h5py.File
+        merged file to write to, needs to hold the target datasets already
+    files: list
+        chunk files to read from
+    fields: list
+        dataset paths, one for each column of lengths
+    lengths: np.ndarray
+        (nfiles, nfields) lengths of the datasets in each file, negative/zero entries are skipped
+    offsets: np.ndarray
+        (nfiles, nfields) offsets of the datasets in the merged file
+    max_workers: int
+        parallel workers to read files
+    max_inflight: Union[int, str]
+        maximum number of bytes read but not written yet, e.g. "1GiB"
+    progress: bool
+        whether to show a progress bar
+
+    Returns
+    -------
+    None
+    """
+    config = get_config()
+    if max_workers is None:
+        max_workers = config.get("nthreads", 16)
+    if max_inflight is None:
+        max_inflight = config.get("cache_copy_inflight", "1GiB")
+    if isinstance(max_inflight, str):
+        max_inflight = parse_humansize(max_inflight)
+    max_workers = max(1, int(max_workers))
+    # keep a few blocks per worker in flight, so that workers do not idle while we write
+    blockbytes = max(max_inflight // (4 * max_workers), 1024**2)
+    tasks = _get_copytasks(hf, files, fields, lengths, offsets, blockbytes)
+    totbytes = sum(t[-1] for t in tasks)
+    if len(tasks) == 0:
+        return
+
+    tstart = time.perf_counter()
+    pbar = tqdm(total=totbytes, unit="B", unit_scale=True, disable=not progress)
+
+    def write(task, arr):
+        field, offset = task[1], task[4]
+        hf[field][offset : offset + arr.shape[0]] = arr
+        pbar.update(task[-1])
+
+    if max_workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            write(task, _read_hyperslab(*task[:4]))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+            inflight = 0
+            queue = iter(tasks)
+            task = next(queue, None)
+            while task is not None or len(pending) > 0:
+                # always allow at least one block in flight, even if larger than the limit
+                while task is not None and (inflight + task[-1] <= max_inflight or len(pending) == 0):
+                    pending[executor.submit(_read_hyperslab, *task[:4])] = task
+                    inflight += task[-1]
+                    task = next(queue, None)
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    t = pending.pop(fut)
+                    write(t, fut.result())
+                    inflight -= t[-1]
+    pbar.close()
+    dt = time.perf_counter() - tstart
+    log.info("Copied %.1f MiB in %.1fs (%.1f MiB/s).", totbytes / 1024**2, dt, totbytes / 1024**2 / max(dt, 1e-9))
+
+
+def _write_filestats(hf, files, attrs_differ):
+    """
+    Save the bookkeeping needed to incrementally update a merged file.
+
+    Parameters
+    ----------
+    hf: h5py.File
+        merged file
+    files: list
+        chunk files
+    attrs_differ: dict
+        attributes that differ across files
+
+    Returns
+    -------
+    None
+    """
+    mtimes, sizes = get_filestats(files)
+    grp = hf.require_group("_files")
+    grp.attrs["paths"] = np.array([str(f) for f in files], dtype=h5py.string_dtype())
+    grp.attrs["mtime_ns"] = mtimes
+    grp.attrs["size"] = sizes
+    differ = [(apath, k) for apath, dct in attrs_differ.items() for k in dct]
+    grp.attrs["attrs_differ_paths"] = np.array([d[0] for d in differ], dtype=h5py.string_dtype())
+    grp.attrs["attrs_differ_keys"] = np.array([d[1] for d in differ], dtype=h5py.string_dtype())
+
+
+def get_zonemap_fields(names, dtypes, spec) -> list:
+    """
+    Select the datasets to record zone maps for.
+
+    Parameters
+    ----------
+    names: np.ndarray
+        dataset paths
+    dtypes: dict
+        dtype for each dataset
+    spec: Union[bool, str, list]
+        False/None for none, True for "Coordinates", "all" for all numeric datasets, or dataset names
+        (e.g. "Masses") or paths (e.g. "/PartType0/Masses"), as list or comma-separated string.
+
+    Returns
+    -------
+    list
+        selected dataset paths
+    """
+    if isinstance(spec, str):
+        if spec.lower() in ["", "0", "false", "no", "off"]:
+            spec = False
+        elif spec.lower() in ["1", "true", "yes", "on"]:
+            spec = True
+        elif spec.lower() != "all":
+            spec = [s.strip() for s in spec.split(",")]
+    if spec is None or spec is False:
+        return []
+    if spec is True:
+        spec = ["Coordinates"]
+    fields = []
+    for name in names:
+        name = str(name)
+        dtype = np.dtype(dtypes[name]) if dtypes[name] is not None else None
+        if dtype is None or dtype.kind not in "iuf":
             continue
-        arr0 = chunks[groupfields[0]]
-        for field in groupfields[1:]:
-            arr = np.array(chunks[field])
-            if groupwise_shape and not np.array_equal(arr0, arr):
+        if spec == "all" or name in spec or name.rpartition("/")[2] in spec:
+            fields.append(name)
+    return fields
+
+
+def _read_minmax(fl, field, blockrows=2**20):
+    """
+    Get the minimum and maximum of a dataset in a chunk file along the first axis.
+
+    Parameters
+    ----------
+    fl: str
+        chunk file to read from
+    field: str
+        dataset path
+    blockrows: int
+        number of rows to read at once
+
+    Returns
+    -------
+    np.ndarray
+        minimum and maximum stacked along the first axis
+    """
+    with h5py.File(fl, "r") as hf:
+        ds = hf[field]
+        mins, maxs = [], []
+        for start in range(0, ds.shape[0], blockrows):
+            arr = ds[start : start + blockrows]
+            mins.append(np.nanmin(arr, axis=0) if arr.dtype.kind == "f" else arr.min(axis=0))
+            maxs.append(np.nanmax(arr, axis=0) if arr.dtype.kind == "f" else arr.max(axis=0))
+    return np.stack([np.min(mins, axis=0), np.max(maxs, axis=0)])
+
+
+def write_zonemaps(hf, files, names, lengths, fields, fileindices=None, max_workers=None):
+    """
+    Record the minimum and maximum of datasets in each chunk file ("zone maps") in a merged file.
+    They are stored as attributes of the '_zonemaps' group with shape (nfiles, 2, ...).
+
+    Parameters
+    ----------
+    hf: h5py.File
+        merged file
+    files: list
+        chunk files
+    names: np.ndarray
+        dataset paths, one for each column of lengths
+    lengths: np.ndarray
+        (nfiles, ndatasets) length of the datasets in each file, -1 if not present
+    fields: list
+        dataset paths to record zone maps for
+    fileindices: Optional[np.ndarray]
+        only (re-)compute the entries of these files
+    max_workers: int
+        parallel workers to read files
+
+    Returns
+    -------
+    None
+    """
+    if max_workers is None:
+        max_workers = get_config().get("nthreads", 16)
+    names = [str(n) for n in names]
+    grp = hf.require_group("_zonemaps")
+    tables = dict()
+    tasks = []
+    for field in fields:
+        j = names.index(field)
+        fidx = np.arange(len(files))
+        if field in grp.attrs and fileindices is not None:
+            tables[field] = grp.attrs[field]
+            fidx = np.asarray(fileindices)
+        else:
+            tables[field] = np.zeros((len(files), 2, *hf[field].shape[1:]), dtype=hf[field].dtype)
+        tasks += [(k, field) for k in fidx if lengths[k, j] > 0]
+    args = ([files[k] for k, _ in tasks], [field for _, field in tasks])
+    if max_workers <= 1 or len(tasks) <= 1:
+        results = list(map(_read_minmax, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_read_minmax, *args))
+    for (k, field), res in zip(tasks, results):
+        tables[field][k] = res
+    for field, table in tables.items():
+        grp.attrs[field] = table
+
+
+def add_zonemaps(fn, files, spec, max_workers=None) -> None:
+    """
+    Add zone maps to a merged file as written by create_mergedhdf5file for datasets that lack them.
+
+    Parameters
+    ----------
+    fn: str
+        merged file
+    files: list
+        files that were merged
+    spec: Union[bool, str, list]
+        datasets to record zone maps for, see get_zonemap_fields
+    max_workers: int
+        parallel workers to read files
+
+    Returns
+    -------
+    None
+    """
+    files = [str(f) for f in files]
+    with h5py.File(fn, "r") as hf:
+        state = _read_cachestate(hf)
+        if state is None or state["paths"] != files:
+            return
+        names = state["names"]
+        fields = get_zonemap_fields(names, {str(n): hf[str(n)].dtype for n in names}, spec)
+        existing = hf["_zonemaps"].attrs.keys() if "_zonemaps" in hf else []
+        fields = [f for f in fields if f not in existing]
+    if len(fields) == 0:
+        return
+    log.info("Adding zone maps for %i datasets to '%s'.", len(fields), fn)
+    try:
+        hf = h5py.File(fn, "r+")
+    except OSError as e:  # e.g. still opened by another dataset instance
+        log.warning("Cannot add zone maps to '%s': %s", fn, e)
+        return
+    with hf:
+        write_zonemaps(hf, files, names, state["lengths"], fields, max_workers=max_workers)
+
+
+def get_zonemaps(hf) -> dict:
+    """
+    Get the zone maps of the datasets in a merged file as written by write_zonemaps.
+
+    Parameters
+    ----------
+    hf: h5py.File
+        merged file
+
+    Returns
+    -------
+    dict
+        maps dataset paths to dictionaries with the first ("start") and last ("end", exclusive) row of each
+        chunk file in the merged dataset and the minimum ("min") and maximum ("max") of the rows.
+        Empty if the file holds no zone maps.
+    """
+    if "_zonemaps" not in hf:
+        return dict()
+    state = _read_cachestate(hf)
+    if state is None:
+        return dict()
+    names = [str(n) for n in state["names"]]
+    zonemaps = dict()
+    for field, table in hf["_zonemaps"].attrs.items():
+        if field not in names:
+            continue
+        lengths = state["lengths"][:, names.index(field)]
+        idx = np.nonzero(lengths > 0)[0]
+        ends = np.cumsum(lengths[idx])
+        zonemaps[field] = dict(start=ends - lengths[idx], end=ends, min=table[idx, 0], max=table[idx, 1])
+    return zonemaps
+
+
+def create_mergedhdf5file(
+    fn,
+    files,
+    max_workers=None,
+    virtual=True,
+    groupwise_shape=False,
+    max_inflight=None,
+    progress=False,
+    zonemaps=None,
+):
+    """
+    Creates a virtual hdf5 file from list of given files. Virtual by default.
+
+    Parameters
+    ----------
+    fn: str
+        file to write to
+    files: list
+        files to merge
+    max_workers: int
+        parallel workers to process files
+    virtual: bool
+        whether to create linked ("virtual") dataset on disk (otherwise copy)
+    groupwise_shape: bool
+        whether to require shapes to be the same within a group
+    max_inflight: Union[int, str]
+        maximum number of bytes read but not written yet when copying, see copy_datasets
+    progress: bool
+        whether to show a progress bar when copying
+    zonemaps: Union[bool, str, list]
+        datasets to record the minimum and maximum in each chunk file for, see get_zonemap_fields
+
+    Returns
+    -------
+    None
+    """
+    files = [str(f) for f in files]
+    # first obtain all datasets and groups
+    result = walk_hdf5files(files, max_workers=max_workers)
+    groups = {item for r in result for item in r["groups"]}
+    names, lengths, extrashapes, dtypes = get_shapetable(result)
+    groupfields = _get_groupfields(groups, names)
+
+    # assert that all datasets in a given group have the same chunks.
+    if groupwise_shape:
+        for cols in groupfields.values():
+            if len(cols) > 1 and not np.all(lengths[:, cols] == lengths[:, cols[:1]]):
                 raise ValueError("Requiring same shape (see 'groupwise_shape' flag)")
-            # then save the chunking information for this group
-            groupchunks[field] = arr0
+
+    attrs_same, attrs_differ = _merge_attrs(result, set(names))
 
     # next fill merger file
     with h5py.File(fn, "w", libver="latest") as hf:
         # create groups
-        for group in sorted(groups):
-            if group == "/":
-                group = ""
-            else:
+        for group in groupfields:
+            if group != "":
                 hf.create_group(group)
-            groupfields = [
-                field for field in shapes.keys() if field.startswith(group) and field.count("/") - 1 == group.count("/")
-            ]
-            if len(groupfields) == 0:
+        for cols in groupfields.values():
+            if len(cols) == 0:
                 continue
-
             # fill fields
             if virtual:
                 # for virtual datasets, iterate over all fields and concat each file to virtual dataset
-                for field in groupfields:
-                    totentries = np.array([k[1] for k in chunks[field]]).sum()
-                    newshape = (totentries,) + shapes[field][next(iter(shapes[field]))][1:]
-
-                    # create virtual sources
-                    vsources = [
-                        h5py.VirtualSource(
-                            files[k],
-                            name=field,
-                            shape=shapes[field][k],
-                            dtype=dtypes[field],
-                        )
-                        for k in shapes[field]
-                    ]
-                    layout = h5py.VirtualLayout(shape=tuple(newshape), dtype=dtypes[field])
-
-                    # fill virtual dataset
-                    offset = 0
-                    for vsource in vsources:
-                        length = vsource.shape[0]
-                        layout[offset : offset + length] = vsource
-                        offset += length
-                    assert newshape[0] == offset  # make sure we filled the array up fully.
-                    hf.create_virtual_dataset(field, layout)
-            else:  # copied dataset. For performance, we iterate differently: Loop over each file's fields
-                for field in groupfields:
-                    totentries = np.array([k[1] for k in chunks[field]]).sum()
-                    extrashapes = shapes[field][next(iter(shapes[field]))][1:]
-                    newshape = (totentries,) + extrashapes  # noqa: RUF005
-                    hf.create_dataset(field, shape=newshape, dtype=dtypes[field])
-                counters = dict.fromkeys(groupfields, 0)
-                for k, fl in enumerate(files):
-                    with h5py.File(fl) as hf_load:
-                        for field in groupfields:
-                            n = shapes[field].get(k, [0, 0])[0]
-                            if n == 0:
-                                continue
-                            offset = counters[field]
-                            hf[field][offset : offset + n] = hf_load[field]
-                            counters[field] = offset + n
+                for j in cols:
+                    field = names[j]
+                    _create_virtual_dataset(hf, field, files, lengths[:, j], extrashapes[field], dtypes[field])
+            else:  # copied dataset, filled below
+                for j in cols:
+                    field = names[j]
+                    totentries = int(np.sum(lengths[:, j], where=lengths[:, j] > 0))
+                    hf.create_dataset(field, shape=(totentries, *extrashapes[field]), dtype=dtypes[field])
+        if not virtual:
+            cols = [j for c in groupfields.values() for j in c]
+            clipped = np.clip(lengths[:, cols], 0, None)
+            offsets = np.cumsum(clipped, axis=0) - clipped
+            fields = [names[j] for j in cols]
+            copy_datasets(
+                hf, files, fields, clipped, offsets, max_workers, max_inflight=max_inflight, progress=progress
+            )
 
         # save information regarding chunks
         grp = hf.create_group("_chunks")
-        for k, v in groupchunks.items():
-            grp.attrs[k] = v
+        for cols in groupfields.values():
+            for j in cols:
+                grp.attrs[names[j]] = _get_chunktable(lengths[:, j])
+
+        zfields = get_zonemap_fields(names, dtypes, zonemaps)
+        if len(zfields) > 0:
+            write_zonemaps(hf, files, names, lengths, zfields, max_workers=max_workers)
 
         # write the attributes
-        # find attributes that change across data sets
-        attrs_key_lists = [list(v["attrs"].keys()) for v in result]  # attribute paths for each file
-        attrspaths_all = set().union(*attrs_key_lists)
-        attrspaths_intersec = set(attrspaths_all).intersection(*attrs_key_lists)
-        attrspath_diff = attrspaths_all.difference(attrspaths_intersec)
-        # if difference only stems from missing datasets (and their assoc. attrs); thats fine
-        if attrspaths_all != attrspaths_intersec and not attrspath_diff.issubset(datasets):
-            raise NotImplementedError("Some attribute paths not present in each partial data file.")
-        # check for common key+values across all files
-        attrs_same = {}
-        attrs_differ = {}
+        for apath, dct in attrs_same.items():
+            for k, v in dct.items():
+                hf[apath].attrs[k] = v
+        for apath, dct in attrs_differ.items():
+            for k, v in dct.items():
+                hf[apath].attrs[k] = v
+
+        _write_filestats(hf, files, attrs_differ)
+
+
+def _read_cachestate(hf):
+    """
+    Read the bookkeeping of a merged file as written by create_mergedhdf5file.
+
+    Parameters
+    ----------
+    hf: h5py.File
+        merged file
+
+    Returns
+    -------
+    Optional[dict]
+        None if the file does not hold the required bookkeeping.
+    """
+    if "_files" not in hf or "_chunks" not in hf:
+        return None
+    fattrs = hf["_files"].attrs
+
+    def tostr(v):
+        """helper func"""
+        return v.decode() if isinstance(v, bytes) else str(v)
+
+    apaths, akeys = fattrs["attrs_differ_paths"], fattrs["attrs_differ_keys"]
+    state = dict(
+        paths=[tostr(p) for p in fattrs["paths"]],
+        mtime_ns=fattrs["mtime_ns"],
+        size=fattrs["size"],
+        attrs_differ={(tostr(a), tostr(k)) for a, k in zip(apaths, akeys, strict=True)},
+    )
+    nfiles = len(state["paths"])
+    names = sorted(hf["_chunks"].attrs.keys())
+    lengths = np.full((nfiles, len(names)), -1, dtype=np.int64)
+    for j, name in enumerate(names):
+        chunks = hf["_chunks"].attrs[name]
+        if len(chunks) > 0:
+            lengths[chunks[:, 0], j] = chunks[:, 1]
+    state["names"] = np.array(names, dtype=str)
+    state["lengths"] = lengths
+    return state
+
+
+def get_chunksources(hf):
+    """
+    Get the source file ranges of the datasets in a merged file as written by create_mergedhdf5file.
+
+    Parameters
+    ----------
+    hf: h5py.File
+        merged file
+
+    Returns
+    -------
+    Optional[dict]
+        maps dataset paths to lists of (source file, length) in the order of concatenation;
+        None if the file does not hold the required bookkeeping.
+    """
+    state = _read_cachestate(hf)
+    if state is None:
+        return None
+    paths = state["paths"]
+    sources = dict()
+    for j, name in enumerate(state["names"]):
+        lengths = state["lengths"][:, j]
+        sources[str(name)] = [(paths[k], int(lengths[k])) for k in np.nonzero(lengths > 0)[0]]
+    return sources
+
 
+def get_filealigned_chunks(lengths, rowbytes, target=None):
+    """
+    Chunk sizes along the first axis of a concatenation of files, aligned with the file boundaries.
+    Consecutive small files are coalesced and large files are split so that chunks approach the target size.
+
+    Parameters
+    ----------
+    lengths: array_like
+        number of rows in each file (files with no rows are skipped)
+    rowbytes: int
+        bytes per row
+    target: Optional[Union[int, str]]
+        target chunk size in bytes, e.g. "128MiB". Defaults to dask's "array.chunk-size".
+
+    Returns
+    -------
+    tuple
+        chunk sizes summing up to the total number of rows
+    """
+    if target is None:
+        target = dask.config.get("array.chunk-size")
+    if isinstance(target, str):
+        target = parse_humansize(target)
+    targetrows = max(1, int(target) // max(int(rowbytes), 1))
+    chunks = []
+    current = 0
+    for n in np.asarray(lengths, dtype=np.int64):
+        if n <= 0:
+            continue
+        if current > 0 and current + n > targetrows:
+            chunks.append(current)
+            current = 0
+        if n > targetrows:
+            # split into near-equal pieces within this file
+            npieces = -(-n // targetrows)
+            q, r = divmod(int(n), int(npieces))
+            chunks += [q + 1] * r + [q] * (npieces - r)
+        else:
+            current += n
+    if current > 0 or len(chunks) == 0:
+        chunks.append(current)
+    return tuple(int(c) for c in chunks)
+
+
+def _stack_attr(old, val, k, nfiles, stacked=False):
+    """
+    Set the attribute value of the k-th file in an attribute stacked across files.
+
+    Parameters
+    ----------
+    old: object
+        current attribute value
+    val: object
+        new value for k-th file
+    k: int
+        file index
+    nfiles: int
+        number of files
+    stacked: bool
+        whether the current attribute value is already stacked across files
+
+    Returns
+    -------
+    np.ndarray
+    """
+    vals = list(old) if stacked else [old] * nfiles
+    vals[k] = val
+    if isinstance(val, np.ndarray):
+        return np.stack(vals)
+    return np.array(vals)
+
+
+def update_mergedhdf5file(fn, files, max_workers=None):
+    """
+    Bring a hdf5 file created by create_mergedhdf5file up to date with its chunk files.
+    Only chunk files that changed in modification time or size are walked again, and
+    only datasets whose shapes changed have their virtual layouts rewritten.
+
+    Parameters
+    ----------
+    fn: str
+        merged file to update
+    files: list
+        files that were merged
+    max_workers: int
+        parallel workers to process files
+
+    Returns
+    -------
+    Optional[bool]
+        True if the file is up to date (after a potential update), False if it needs
+        to be recreated, None if the file does not allow checking for changes.
+    """
+    files = [str(f) for f in files]
+    try:
+        with h5py.File(fn, "r") as hf:
+            state = _read_cachestate(hf)
+    except OSError:
+        return None
+    if state is None:
+        return None
+    if state["paths"] != files:
+        log.info("Chunk files of '%s' have been added or removed.", fn)
+        return False
+    mtimes, sizes = get_filestats(files)
+    changed = np.nonzero((mtimes != state["mtime_ns"]) | (sizes != state["size"]))[0]
+    if changed.size == 0:
+        return True
+    log.info("%i of %i chunk files changed, updating '%s'.", changed.size, len(files), fn)
+
+    trees = walk_hdf5files([files[k] for k in changed], max_workers=max_workers)
+    names_new, lengths_new, extrashapes, dtypes = get_shapetable(trees)
+    names = state["names"]
+    if not set(names_new).issubset(names):
+        return False  # new datasets, requires full rebuild
+    cols = np.searchsorted(names, names_new)
+    lengths = state["lengths"].copy()
+    lengths[changed] = -1
+    lengths[np.ix_(changed, cols)] = lengths_new
+    modified = np.nonzero(np.any(lengths != state["lengths"], axis=0))[0]
+
+    try:
+        hf = h5py.File(fn, "r+")
+    except OSError as e:  # e.g. still opened read-only by an earlier dataset
+        log.warning("Cannot update '%s' in place (%s), recreating it.", fn, e)
+        return False
+    with hf:
+        # first check whether we can update incrementally, before touching the file
+        for j in modified:
+            field = names[j]
+            if not hf[field].is_virtual:
+                return False  # shapes of copied datasets changed; requires full rebuild
+        for field in names_new:
+            if extrashapes[field] != hf[field].shape[1:] or dtypes[field] != get_dtype(hf[field]):
+                return False
+        attrs_updates = []
+        attrs_differ = set(state["attrs_differ"])
         nfiles = len(files)
+        for i, k in enumerate(changed):
+            for apath, dct in trees[i]["attrs"].items():
+                if apath not in hf:
+                    return False
+                for key, val in dct.items():
+                    if key not in hf[apath].attrs:
+                        return False
+                    old = hf[apath].attrs[key]
+                    if (apath, key) in state["attrs_differ"]:
+                        if np.shape(old)[:1] != (nfiles,) or np.shape(val) != np.shape(old)[1:]:
+                            return False  # stacked values cannot be mapped onto files
+                        attrs_updates.append((apath, key, k, val))
+                    elif (apath, key) in attrs_differ:
+                        attrs_updates.append((apath, key, k, val))
+                    elif not _attrs_equal(old, [val]):
+                        if apath in names and np.any(lengths[:, np.searchsorted(names, apath)] < 0):
+                            return False  # not every file holds this attribute
+                        attrs_updates.append((apath, key, k, val))
+                        attrs_differ.add((apath, key))
 
-        for apath in sorted(attrspaths_all):
-            attrs_same[apath] = {}
-            attrs_differ[apath] = {}
-            attrsnames = set().union(*[result[i]["attrs"][apath] for i in range(nfiles) if apath in result[i]["attrs"]])
-            for k in attrsnames:
-                # we ignore apaths and k existing in some files.
-                attrvallist = [
-                    result[i]["attrs"][apath][k]
-                    for i in range(nfiles)
-                    if apath in result[i]["attrs"] and k in result[i]["attrs"][apath]
-                ]
-                attrval0 = attrvallist[0]
-                if isinstance(attrval0, np.ndarray):
-                    if not (np.all([np.array_equal(attrval0, v) for v in attrvallist])):
-                        log.debug("%s: %s has different values.", apath, k)
-                        attrs_differ[apath][k] = np.stack(attrvallist)
-                        continue
-                else:
-                    same = len(set(attrvallist)) == 1
-                    if isinstance(attrval0, np.floating):
-                        # for floats we do not require binary equality
-                        # (we had some incident...)
-                        same = np.allclose(attrval0, attrvallist)
-                    if not same:
-                        log.debug("%s: %s has different values.", apath, k)
-                        attrs_differ[apath][k] = np.array(attrvallist)
-                        continue
-                attrs_same[apath][k] = attrval0
-        for apath in attrspaths_all:
-            for k, v in attrs_same.get(apath, {}).items():
-                hf[apath].attrs[k] = v
-            for k, v in attrs_differ.get(apath, {}).items():
-                hf[apath].attrs[k] = v
+        # rewrite layouts of modified virtual datasets
+        for j in modified:
+            field = names[j]
+            extrashape, dtype = hf[field].shape[1:], hf[field].dtype
+            del hf[field]
+            _create_virtual_dataset(hf, field, files, lengths[:, j], extrashape, dtype)
+            hf["_chunks"].attrs[field] = _get_chunktable(lengths[:, j])
+
+        # copied datasets with unchanged shapes are refreshed in place
+        cols = [j for j, f in enumerate(names) if f in hf and not hf[f].is_virtual]
+        clipped = np.clip(lengths[:, cols], 0, None)
+        offsets = np.cumsum(clipped, axis=0) - clipped
+        unchanged = np.ones(len(files), dtype=bool)
+        unchanged[changed] = False
+        clipped[unchanged] = 0  # only copy from changed files
+        copy_datasets(hf, files, [names[j] for j in cols], clipped, offsets, max_workers=max_workers)
+
+        if "_zonemaps" in hf:
+            zfields = [f for f in names if f in hf["_zonemaps"].attrs]
+            write_zonemaps(hf, files, names, lengths, zfields, fileindices=changed, max_workers=max_workers)
+
+        stacked = set(state["attrs_differ"])
+        for apath, key, k, val in attrs_updates:
+            hf[apath].attrs[key] = _stack_attr(hf[apath].attrs[key], val, k, nfiles, stacked=(apath, key) in stacked)
+            stacked.add((apath, key))
+
+        differ = {}
+        for apath, key in attrs_differ:
+            differ.setdefault(apath, {})[key] = None
+        _write_filestats(hf, files, differ)
+    return True
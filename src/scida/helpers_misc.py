@@ -2,9 +2,11 @@ import hashlib
 import inspect
 import io
 import logging
+import os
 import re
 import types
 
+import dask
 import dask.array as da
 import numpy as np
 
@@ -110,6 +112,27 @@ def get_args(func):
     return [k for k, v in signature.parameters.items() if v.default is inspect.Parameter.empty]
 
 
+def get_nworkers() -> int:
+    """
+    Get the number of workers (threads/processes) of the current dask scheduler.
+
+    Returns
+    -------
+    int
+    """
+    try:
+        from distributed import get_client
+
+        client = get_client()
+        return max(1, sum(client.nthreads().values()))
+    except (ImportError, ValueError):
+        pass  # no distributed scheduler
+    nworkers = dask.config.get("num_workers", None)
+    if nworkers is None:
+        nworkers = os.cpu_count() or 1
+    return int(nworkers)
+
+
 def computedecorator(func):
     """
     Decorator introducing compute keyword to evalute dask array returns.
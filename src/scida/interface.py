@@ -10,11 +10,13 @@ from typing import Dict, List, Optional, Union
 
 import dask
 import dask.array as da
+import h5py
 import numpy as np
 import zarr
 
 import scida.io
 from scida.fields import FieldContainer
+from scida.helpers_hdf5 import get_zonemaps
 from scida.helpers_misc import make_serializable, sprint
 from scida.interfaces.mixins import UnitMixin
 from scida.misc import check_config_for_dataset
@@ -50,7 +52,7 @@ class BaseDataset(metaclass=MixinMeta):
         path: str
             Path to the dataset.
         chunksize: int or str
-            Chunksize for dask arrays.
+            Chunksize for dask arrays. "files" aligns chunks with the files of multi-file data sets.
         virtualcache: bool
             Whether to use virtual caching.
         overwrite_cache: bool
@@ -84,6 +86,7 @@ class BaseDataset(metaclass=MixinMeta):
 
         loadkwargs = dict(
             overwrite_cache=self.overwrite_cache,
+            chunksize=chunksize,
             fileprefix=fileprefix,
             virtualcache=virtualcache,
             derivedfields_kwargs=dict(snap=self),
@@ -92,6 +95,8 @@ class BaseDataset(metaclass=MixinMeta):
         )
         if "choose_prefix" in kwargs:
             loadkwargs["choose_prefix"] = kwargs["choose_prefix"]
+        if "directread" in kwargs:
+            loadkwargs["directread"] = kwargs["directread"]
 
         res = scida.io.load(path, **loadkwargs)
         self.data = res[0]
@@ -205,6 +210,24 @@ class BaseDataset(metaclass=MixinMeta):
             return  # do not register classes with Mixins
         dataset_type_registry[cls.__name__] = cls
 
+    @classmethod
+    def check_fingerprint(cls, fingerprint: dict) -> bool:
+        """
+        Cheap check whether a path can be valid for this dataset class based on its fingerprint,
+        see scida.discovertypes.get_fingerprint. Returning False skips the full validate_path.
+        Subclasses may only prune paths that validate_path would reject.
+
+        Parameters
+        ----------
+        fingerprint: dict
+            Fingerprint of the path.
+
+        Returns
+        -------
+        bool
+        """
+        return True
+
     @classmethod
     @abc.abstractmethod
     def validate_path(cls, path, *args, **kwargs):
@@ -258,6 +281,21 @@ class BaseDataset(metaclass=MixinMeta):
         """
         return self.data
 
+    def get_zonemaps(self) -> Dict[str, dict]:
+        """
+        Return the minimum and maximum of fields in each chunk file, if recorded in the cache file
+        (config option "cache_zonemaps").
+
+        Returns
+        -------
+        dict
+            maps field paths (e.g. "/PartType0/Coordinates") to the row ranges ("start", "end")
+            of the chunk files and their minimum ("min") and maximum ("max").
+        """
+        if not isinstance(self.file, h5py.File) or not self.file.id.valid:
+            return dict()
+        return get_zonemaps(self.file)
+
     def save(
         self,
         fname,
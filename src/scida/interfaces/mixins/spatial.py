@@ -1,9 +1,16 @@
 import logging
 
+import dask
+import dask.array as da
 import numpy as np
+import pint
 
+from scida.config import get_config, get_config_flag
+from scida.fields import FieldContainer
+from scida.helpers_misc import parse_humansize
 from scida.interfaces.mixins.base import Mixin
-from scida.misc import rectangular_cutout_mask
+from scida.misc import box_overlaps_bounds, rectangular_cutout_mask, take_ranges
+from scida.spatialindex import BlockTree, BoxBinning, GridIndex, get_spatialindex_path
 
 log = logging.getLogger(__name__)
 
@@ -36,6 +43,8 @@ class SpatialCartesian3DMixin(Spatial3DMixin):
         if not hasattr(self, "hints"):
             self.hints = {}
         super().__init__(*args, **kwargs)
+        self._spatialindices = dict()
+        self._blocktrees = dict()
         # TODO: determine whether periodic?
         self.pbc = True
         # TODO: Dynamically determine location of boxsize
@@ -90,6 +99,30 @@ class SpatialCartesian3DMixin(Spatial3DMixin):
             return self.data[parttype][k]
         return None
 
+    def _get_boxsize(self, parttype="PartType0") -> np.ndarray:
+        """
+        Get the box size in the units of the coordinates of a given particle type.
+
+        Parameters
+        ----------
+        parttype: str
+            Particle type.
+
+        Returns
+        -------
+        np.ndarray
+            Box size along each axis.
+        """
+        units = getattr(self.get_coords(parttype=parttype), "units", None)
+        if units is None:
+            return self.boxsize
+        try:
+            # the header's box size is given in code units
+            return units._REGISTRY.Quantity(self.boxsize, "code_length").to(units).magnitude
+        except (pint.errors.UndefinedUnitError, pint.errors.DimensionalityError) as e:
+            log.warning("Cannot convert box size to units '%s' of coordinates: %s", units, e)
+            return self.boxsize
+
     def rectangular_cutout_mask(self, center, width, parttype="PartType0"):
         """
         Get a rectangular cutout mask for a given particle type.
@@ -105,20 +138,486 @@ class SpatialCartesian3DMixin(Spatial3DMixin):
         da.Array
         """
         coords = self.get_coords(parttype=parttype)
-        return rectangular_cutout_mask(center, width, coords, pbc=self.pbc, boxsize=self.boxsize)
+        units = getattr(coords, "units", None)
+        center, width = [_to_magnitude(v, units) for v in (center, width)]
+        coords = getattr(coords, "magnitude", coords)
+        boxsize = self._get_boxsize(parttype=parttype)
+        zones = self.get_coordinate_zones(parttype=parttype)
+        if zones is None:
+            return rectangular_cutout_mask(center, width, coords, pbc=self.pbc, boxsize=boxsize)
+        # the mask is only evaluated for runs of chunk files whose bounds can overlap with the cutout
+        keep = box_overlaps_bounds(center, width, zones["min"], zones["max"], boxsize=boxsize if self.pbc else None)
+        runs = np.flatnonzero(np.diff(keep.astype(np.int8))) + 1
+        runstarts = np.concatenate([[0], runs])
+        runends = np.concatenate([runs, [keep.shape[0]]])
+        parts = []
+        for i0, i1 in zip(runstarts, runends):
+            start, end = int(zones["start"][i0]), int(zones["end"][i1 - 1])
+            if keep[i0]:
+                parts.append(rectangular_cutout_mask(center, width, coords[start:end], pbc=self.pbc, boxsize=boxsize))
+            else:
+                parts.append(da.zeros(end - start, dtype=bool))
+        log.debug("Cutout mask skips %i of %i chunk files.", np.sum(~keep), keep.shape[0])
+        return da.concatenate(parts)
+
+    def get_coordinate_zones(self, parttype="PartType0"):
+        """
+        Get the minimum and maximum coordinates of a given particle type in each chunk file,
+        if recorded in the cache file (config option "cache_zonemaps").
 
-    def rectangular_cutout(self, center, width, parttype="PartType0"):
+        Parameters
+        ----------
+        parttype: str
+            Particle type.
+
+        Returns
+        -------
+        Optional[dict]
+            row ranges ("start", "end") of the chunk files and their minimum ("min") and maximum ("max")
+            coordinates in the units of the coordinates. None if not available.
+        """
+        coords = self.get_coords(parttype=parttype)
+        if coords is None:
+            return None
+        if hasattr(coords, "units") and self.withunits not in [True, "code"]:
+            return None  # zone maps hold the values as stored, i.e. in code units
+        name = "/%s/%s" % (parttype, self.hints["CoordinatesName"][parttype])
+        zones = self.get_zonemaps().get(name, None)
+        if zones is None or zones["end"].shape[0] == 0 or zones["end"][-1] != coords.shape[0]:
+            return None
+        return zones
+
+    def get_spatial_index(self, parttype="PartType0", ngrid=None, blocksize=None, overwrite=False) -> GridIndex:
+        """
+        Get the coarse spatial index of the coordinates of a given particle type.
+        The index is built in one pass over the coordinates and stored in the cache directory
+        (config option "persist_spatial_index"), so that later loads of the dataset can reuse it.
+
+        Parameters
+        ----------
+        parttype: str
+            Particle type.
+        ngrid: Optional[int]
+            Number of grid cells along each axis. Default: config option "spatial_index_ngrid" or 16.
+        blocksize: Optional[int]
+            Number of particles per block. Default: config option "spatial_index_blocksize" or 2**20.
+        overwrite: bool
+            Whether to rebuild the index even if it exists.
+
+        Returns
+        -------
+        GridIndex
+        """
+        if ngrid is None:
+            ngrid = get_config().get("spatial_index_ngrid", None)
+        if blocksize is None:
+            blocksize = get_config().get("spatial_index_blocksize", None)
+        key = (parttype, ngrid, blocksize)
+        if key in self._spatialindices and not overwrite:
+            return self._spatialindices[key]
+        coords = self.get_coords(parttype=parttype)
+        if coords is None:
+            raise ValueError("No coordinates found for particle type '%s'." % parttype)
+        units = getattr(coords, "units", None)
+        coords = getattr(coords, "magnitude", coords)
+        path = None
+        if get_config_flag("persist_spatial_index", default=True) and getattr(self, "path", None) is not None:
+            name = "%s/%s" % (parttype, self.hints["CoordinatesName"][parttype])
+            path = get_spatialindex_path(
+                self.path,
+                name,
+                coords.shape,
+                ngrid=ngrid,
+                blocksize=blocksize,
+                units=None if units is None else str(units),
+            )
+        index = None if overwrite else GridIndex.read(path)
+        if index is None:
+            boxsize = self._get_boxsize(parttype=parttype) if self.pbc else None
+            index = GridIndex.build(coords, boxsize=boxsize, ngrid=ngrid, blocksize=blocksize)
+            if path is not None:
+                log.info("Writing spatial index to '%s'.", path)
+                index.write(path)
+        self._spatialindices[key] = index
+        return index
+
+    def rectangular_cutout(self, center, width, parttype="PartType0") -> FieldContainer:
         """
         Get a rectangular cutout for a given particle type.
+        Only the particle blocks that can hold particles within the cutout according to the
+        spatial index are read, see get_spatial_index().
 
         Parameters
         ----------
         center: np.ndarray
+            Center of the cutout. Assumed to be in the units of the coordinates if given without units.
         width: np.ndarray
+            Width of the cutout along each axis.
+        parttype: str
+            Particle type.
+
+        Returns
+        -------
+        FieldContainer
+            Fields of the particle type restricted to the particles within the cutout.
+        """
+        index = self.get_spatial_index(parttype=parttype)
+        coords = self.get_coords(parttype=parttype)
+        units = getattr(coords, "units", None)
+        center, width = [_to_magnitude(v, units) for v in (center, width)]
+        starts, ends = index.get_ranges(index.query_box(center, width))
+        subcoords = np.asarray(take_ranges(getattr(coords, "magnitude", coords), starts, ends).compute())
+        mask = rectangular_cutout_mask(
+            center, width, subcoords, pbc=index.periodic, boxsize=self._get_boxsize(parttype=parttype), backend="numpy"
+        )
+        sel = np.flatnonzero(mask)
+        log.debug("Cutout reads %i of %i particles in %i ranges.", subcoords.shape[0], coords.shape[0], len(starts))
+        return self._get_cutout(parttype, starts, ends, sel)
+
+    def rectangular_cutouts(self, centers, widths, parttype="PartType0") -> "BatchedCutouts":
+        """
+        Get rectangular cutouts around many centers for a given particle type in a single pass.
+        Each particle block that can hold particles within any cutout according to the spatial index is read once,
+        and its particles are assigned to all cutouts containing them.
+
+        Parameters
+        ----------
+        centers: np.ndarray
+            Centers of the cutouts, shape (N, 3). Assumed to be in the units of the coordinates if given without units.
+        widths: np.ndarray
+            Widths of the cutouts, shape (N, 3) or broadcastable to it.
+        parttype: str
+            Particle type.
+
+        Returns
+        -------
+        BatchedCutouts
+        """
+        index = self.get_spatial_index(parttype=parttype)
+        coords = self.get_coords(parttype=parttype)
+        units = getattr(coords, "units", None)
+        coords = getattr(coords, "magnitude", coords)
+        centers = _to_magnitude(centers, units).reshape(-1, 3)
+        widths = np.broadcast_to(_to_magnitude(widths, units), centers.shape)
+        blocks = [index.query_box(c, w) for c, w in zip(centers, widths)]
+        blocks = np.unique(np.concatenate(blocks)) if len(blocks) > 0 else np.zeros(0, dtype=np.int64)
+        if index.periodic:
+            boxsize = self._get_boxsize(parttype=parttype)
+            binning = BoxBinning(centers, widths, np.zeros(3), boxsize, boxsize=boxsize)
+        else:
+            binning = BoxBinning(centers, widths, index.origin, index.cellsize * index.ngrid)
+        edges = index.blockedges
+        tasks = [dask.delayed(binning.assign)(coords[edges[b] : edges[b + 1]]) for b in blocks]
+        results = dask.compute(*tasks)
+        log.debug("Batched cutouts read %i of %i blocks.", len(blocks), index.nblocks)
+        boxes = np.concatenate([np.zeros(0, dtype=np.int64)] + [r[0] for r in results])
+        parts = np.concatenate([np.zeros(0, dtype=np.int64)] + [r[1] + edges[b] for b, r in zip(blocks, results)])
+        order = np.lexsort((parts, boxes))
+        lengths = np.bincount(boxes, minlength=centers.shape[0]).astype(np.int64)
+        offsets = np.cumsum(lengths) - lengths
+        return BatchedCutouts(self, parttype, parts[order], offsets, lengths)
+
+    def _get_cutout(self, parttype, starts, ends, sel) -> FieldContainer:
+        """
+        Container of the fields of a particle type restricted to the given particles.
+
+        Parameters
+        ----------
+        parttype: str
+            Particle type.
+        starts: np.ndarray
+            Start of the particle ranges to read.
+        ends: np.ndarray
+            End of the particle ranges to read.
+        sel: np.ndarray
+            Indices of the selected particles within the concatenation of the ranges.
+
+        Returns
+        -------
+        FieldContainer
+        """
+        cntr = self.data[parttype]
+        npart = self.get_coords(parttype=parttype).shape[0]
+        result = FieldContainer(withunits=cntr.withunits, ureg=cntr.get_ureg(), name=cntr.name)
+        for k in cntr.keys(withgroups=False, withrecipes=False):
+            v = cntr[k]
+            if getattr(v, "shape", (None,))[0] != npart:
+                continue
+            result[k] = take_ranges(v, starts, ends)[sel]
+        for k in cntr.keys(withgroups=False, withfields=False):
+            if k in result.keys(withgroups=False):
+                continue
+
+            # fields not instantiated yet are only read from the selected ranges upon access
+            def func(container, k=k, **kwargs):
+                return take_ranges(cntr[k], starts, ends)[sel]
+
+            result.register_field(name=k, description="Cutout of '%s'." % k)(func)
+        return result
+
+    def _get_block_trees(self, parttype, blocks) -> list:
+        """
+        Get the cell lists of blocks of the spatial index, building missing ones from their coordinates.
+        The most recently used cell lists are kept up to a total size (config option "spatial_tree_cache_size"),
+        but at least those of the requested blocks.
+
+        Parameters
+        ----------
+        parttype: str
+            Particle type.
+        blocks: np.ndarray
+            Indices of the blocks.
+
+        Returns
+        -------
+        list[BlockTree]
+        """
+        index = self.get_spatial_index(parttype=parttype)
+        coords = self.get_coords(parttype=parttype)
+        coords = getattr(coords, "magnitude", coords)
+        boxsize = self._get_boxsize(parttype=parttype) if index.periodic else None
+        missing = [b for b in blocks if (parttype, b) not in self._blocktrees]
+        if len(missing) > 0:
+            arrs = dask.compute(*[coords[index.blockedges[b] : index.blockedges[b + 1]] for b in missing])
+            for b, arr in zip(missing, arrs):
+                self._blocktrees[(parttype, b)] = BlockTree(arr, boxsize=boxsize)
+        trees = []
+        for b in blocks:
+            tree = self._blocktrees.pop((parttype, b))
+            self._blocktrees[(parttype, b)] = tree  # (re-)insert as most recently used
+            trees.append(tree)
+        maxbytes = get_config().get("spatial_tree_cache_size", "512MiB")
+        if isinstance(maxbytes, str):
+            maxbytes = parse_humansize(maxbytes)
+        nbytes = sum(tree.nbytes for tree in self._blocktrees.values())
+        while nbytes > maxbytes and len(self._blocktrees) > len(blocks):
+            nbytes -= self._blocktrees.pop(next(iter(self._blocktrees))).nbytes
+        return trees
+
+    def query_sphere(self, center, radius, rmin=None, parttype="PartType0"):
+        """
+        Get the particles of a given type within a sphere or spherical shell, taking periodic boundaries into account.
+        Only the particle blocks that can hold particles within the sphere according to the spatial index are read,
+        see get_spatial_index().
+
+        Parameters
+        ----------
+        center: np.ndarray
+            Center of the sphere. Assumed to be in the units of the coordinates if given without units.
+        radius: float
+            Outer radius (exclusive).
+        rmin: Optional[float]
+            Inner radius (inclusive).
+        parttype: str
+            Particle type.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            sorted particle indices and their distances to the center
+        """
+        index = self.get_spatial_index(parttype=parttype)
+        units = getattr(self.get_coords(parttype=parttype), "units", None)
+        center, radius = [_to_magnitude(v, units) for v in (center, radius)]
+        if rmin is not None:
+            rmin = _to_magnitude(rmin, units)
+        blocks = index.query_sphere(center, radius)
+        idxs, dists = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+        for b, tree in zip(blocks, self._get_block_trees(parttype, blocks)):
+            idx, dist = tree.query_ball(center, radius, rmin=rmin)
+            idxs.append(idx + index.blockedges[b])
+            dists.append(dist)
+        return np.concatenate(idxs), np.concatenate(dists)
+
+    def nearest_neighbors(self, center, k=1, parttype="PartType0"):
+        """
+        Get the k particles of a given type nearest to a center, taking periodic boundaries into account.
+
+        Parameters
+        ----------
+        center: np.ndarray
+            Center. Assumed to be in the units of the coordinates if given without units.
+        k: int
+            Number of neighbors.
+        parttype: str
+            Particle type.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            particle indices and their distances to the center, sorted by distance
+        """
+        index = self.get_spatial_index(parttype=parttype)
+        coords = self.get_coords(parttype=parttype)
+        units = getattr(coords, "units", None)
+        center = _to_magnitude(center, units)
+        npart = coords.shape[0]
+        k = min(int(k), npart)
+        if index.periodic:
+            extent = np.asarray(self._get_boxsize(parttype=parttype), dtype=np.float64)
+            rmax = np.sqrt(3) * np.max(extent) / 2.0 * (1.0 + 1e-9)
+        else:
+            lower, upper = np.nanmin(index.bboxes[:, 0], axis=0), np.nanmax(index.bboxes[:, 1], axis=0)
+            extent = np.maximum(upper - lower, 1e-30)
+            rmax = np.sqrt(np.sum(np.maximum(np.abs(center - lower), np.abs(center - upper)) ** 2)) * (1.0 + 1e-9)
+        # start from the radius expected to hold k particles on average, grow until k particles are found
+        radius = min(np.cbrt(3.0 * k * np.prod(extent) / (4.0 * np.pi * max(npart, 1))), rmax)
+        while True:
+            idx, dist = self.query_sphere(center, radius, parttype=parttype)
+            if idx.shape[0] >= k or radius >= rmax:
+                break
+            radius = min(2.0 * radius, rmax)
+        order = np.argsort(dist, kind="stable")[:k]
+        dist = dist[order]
+        if units is not None:
+            dist = dist * units
+        return idx[order], dist
+
+    def _get_indices_cutout(self, parttype, indices) -> FieldContainer:
+        """
+        Container of the fields of a particle type restricted to the given sorted particle indices.
+
+        Parameters
+        ----------
+        parttype: str
+            Particle type.
+        indices: np.ndarray
+            Sorted particle indices.
+
+        Returns
+        -------
+        FieldContainer
+        """
+        index = self.get_spatial_index(parttype=parttype)
+        blocks = np.unique(np.searchsorted(index.blockedges, indices, side="right") - 1)
+        starts, ends = index.get_ranges(blocks)
+        r = np.searchsorted(starts, indices, side="right") - 1
+        offsets = np.cumsum(ends - starts) - (ends - starts)
+        return self._get_cutout(parttype, starts, ends, indices - starts[r] + offsets[r])
+
+    def spherical_cutout(self, center, radius, parttype="PartType0") -> FieldContainer:
+        """
+        Get a spherical cutout for a given particle type, see query_sphere().
+
+        Parameters
+        ----------
+        center: np.ndarray
+            Center of the sphere. Assumed to be in the units of the coordinates if given without units.
+        radius: float
+            Radius of the sphere.
+        parttype: str
+            Particle type.
+
+        Returns
+        -------
+        FieldContainer
+            Fields of the particle type restricted to the particles within the sphere.
+        """
+        indices, _ = self.query_sphere(center, radius, parttype=parttype)
+        return self._get_indices_cutout(parttype, indices)
+
+    def shell_cutout(self, center, rmin, rmax, parttype="PartType0") -> FieldContainer:
+        """
+        Get a cutout of a spherical shell for a given particle type, see query_sphere().
+
+        Parameters
+        ----------
+        center: np.ndarray
+            Center of the shell. Assumed to be in the units of the coordinates if given without units.
+        rmin: float
+            Inner radius (inclusive).
+        rmax: float
+            Outer radius (exclusive).
         parttype: str
+            Particle type.
+
+        Returns
+        -------
+        FieldContainer
+            Fields of the particle type restricted to the particles within the shell.
+        """
+        indices, _ = self.query_sphere(center, rmax, rmin=rmin, parttype=parttype)
+        return self._get_indices_cutout(parttype, indices)
+
+
+class BatchedCutouts:
+    """
+    Particles of a particle type within many regions, stored as concatenated particle indices per region.
+    """
+
+    def __init__(self, dataset, parttype, indices, offsets, lengths):
+        """
+        Initialize the cutouts.
+
+        Parameters
+        ----------
+        dataset: SpatialCartesian3DMixin
+            The dataset the particles belong to.
+        parttype: str
+            Particle type.
+        indices: np.ndarray
+            Sorted particle indices of each region, concatenated.
+        offsets: np.ndarray
+            Offset of each region in indices.
+        lengths: np.ndarray
+            Number of particles in each region.
+        """
+        self.dataset = dataset
+        self.parttype = parttype
+        self.indices = indices
+        self.offsets = offsets
+        self.lengths = lengths
+
+    def __len__(self):
+        return self.offsets.shape[0]
+
+    def __getitem__(self, i) -> np.ndarray:
+        return self.indices[self.offsets[i] : self.offsets[i] + self.lengths[i]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return "BatchedCutouts(parttype='%s', n=%i, nparticles=%i)" % (self.parttype, len(self), self.indices.shape[0])
+
+    def get_cutout(self, i) -> FieldContainer:
+        """
+        Get the fields of the particles within the i-th region.
+
+        Parameters
+        ----------
+        i: int
+            Index of the region.
+
+        Returns
+        -------
+        FieldContainer
+        """
+        return self.dataset._get_indices_cutout(self.parttype, self[i])
+
+    def get_field(self, name):
+        """
+        Get a field for the particles of all regions, concatenated in the order of indices.
+        Per-region reductions can use the offsets, e.g. np.add.reduceat.
+
+        Parameters
+        ----------
+        name: str
+            Name of the field.
 
         Returns
         -------
         da.Array
         """
-        raise NotImplementedError
+        unique, inverse = np.unique(self.indices, return_inverse=True)
+        return self.dataset._get_indices_cutout(self.parttype, unique)[name][inverse]
+
+
+def _to_magnitude(value, units):
+    """Return the magnitude of a value in the given units; values without units are returned as array."""
+    if hasattr(value, "units"):
+        if units is not None:
+            value = value.to(units)
+        value = value.magnitude
+    return np.asarray(value, dtype=np.float64)
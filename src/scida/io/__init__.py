@@ -20,3 +20,12 @@ from scida.io._base import (
 from scida.io._base import (
     walk_hdf5file as walk_hdf5file,
 )
+from scida.io.filehandles import (
+    FileHandlePool as FileHandlePool,
+)
+from scida.io.filehandles import (
+    HDF5DatasetReference as HDF5DatasetReference,
+)
+from scida.io.filehandles import (
+    get_filehandle_pool as get_filehandle_pool,
+)
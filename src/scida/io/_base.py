@@ -3,6 +3,7 @@ Basic IO functionality for scida.
 """
 
 import abc
+import bisect
 import logging
 import os
 import pathlib
@@ -16,9 +17,19 @@ import h5py
 import numpy as np
 import zarr
 
-from scida.config import get_config
-from scida.fields import FieldContainer, walk_container
-from scida.helpers_hdf5 import create_mergedhdf5file, walk_hdf5file, walk_zarrfile
+from scida.config import get_config, get_config_flag
+from scida.fields import DerivedFieldRecipe, FieldContainer, walk_container
+from scida.helpers_hdf5 import (
+    add_zonemaps,
+    create_mergedhdf5file,
+    get_chunksources,
+    get_dtype,
+    get_filealigned_chunks,
+    update_mergedhdf5file,
+    walk_hdf5file,
+    walk_zarrfile,
+)
+from scida.io.filehandles import HDF5DatasetReference
 from scida.io.fits import fitsrecords_to_daskarrays
 from scida.misc import get_container_from_path, return_hdf5cachepath
 
@@ -197,11 +208,12 @@ class HDF5Loader(Loader):
             Tuple of data and metadata.
 
         """
+        kwargs.pop("directread", None)  # only supported for chunked files
         self.location = self.path
         tree = {}
         walk_hdf5file(self.location, tree=tree)
         file = h5py.File(self.location, "r")
-        data, metadata = load_datadict_old(self.path, file, token=token, chunksize=chunksize, **kwargs)
+        data, metadata = load_datadict_old(self.path, file, token=token, chunksize=chunksize, tree=tree, **kwargs)
         self.file = file
         return data, metadata
 
@@ -281,12 +293,13 @@ class ZarrLoader(Loader):
         tuple
             Tuple of data and metadata.
         """
+        kwargs.pop("directread", None)  # only supported for chunked files
         self.location = self.path
         tree = {}
         walk_zarrfile(self.location, tree=tree)
         self.file = zarr.open(self.location)
         data, metadata = load_datadict_old(
-            self.path, self.file, token=token, chunksize=chunksize, filetype="zarr", **kwargs
+            self.path, self.file, token=token, chunksize=chunksize, filetype="zarr", tree=tree, **kwargs
         )
         return data, metadata
 
@@ -365,6 +378,7 @@ class ChunkedHDF5Loader(Loader):
         token="",
         chunksize="auto",
         virtualcache=False,
+        directread=False,
         **kwargs,
     ):
         """
@@ -381,9 +395,11 @@ class ChunkedHDF5Loader(Loader):
         token: str
             Token to be used for dask arrays.
         chunksize: str
-            Chunksize for dask arrays.
+            Chunksize for dask arrays. "files" aligns chunks with the chunk files.
         virtualcache: bool
             Whether to use virtual caching.
+        directread: bool
+            Whether to read fields directly from the chunk files rather than through the cache file.
         kwargs: dict
             Additional keyword arguments.
 
@@ -405,6 +421,9 @@ class ChunkedHDF5Loader(Loader):
         elif overwrite_cache:
             # 3. cachefile exists, but overwrite=True
             create = True
+        elif not self.update_cachefile(cachefp, fileprefix=fileprefix, choose_prefix=choose_prefix):
+            # 4. cachefile exists, but chunk files changed in a way we cannot update incrementally
+            create = True
 
         if create:
             print_cachefile_creation = kwargs.get("print_cachefile_creation", True)
@@ -416,13 +435,17 @@ class ChunkedHDF5Loader(Loader):
             )
 
         try:
-            data, metadata = self.load_cachefile(cachefp, token=token, chunksize=chunksize, **kwargs)
+            data, metadata = self.load_cachefile(
+                cachefp, token=token, chunksize=chunksize, directread=directread, **kwargs
+            )
         except InvalidCacheError:
             # if we get an error, we try to create a new cache file (once)
             log.info("Invalid cache file, attempting to create new one.")
             os.remove(cachefp)
             self.create_cachefile(fileprefix=fileprefix, virtualcache=virtualcache)
-            data, metadata = self.load_cachefile(cachefp, token=token, chunksize=chunksize, **kwargs)
+            data, metadata = self.load_cachefile(
+                cachefp, token=token, chunksize=chunksize, directread=directread, **kwargs
+            )
         return data, metadata
 
     def get_chunkedfiles(self, fileprefix: Optional[str] = "", choose_prefix=False) -> list:
@@ -474,17 +497,48 @@ class ChunkedHDF5Loader(Loader):
             self.location = self.tempfile.name
             log.warning("No caching directory specified. Initial file read will remain slow.")
 
+        # write under a temporary name, so that datasets still holding the old cache file are not affected
+        tmppath = "%s.%i.tmp" % (cachefp, os.getpid())
         try:
-            create_mergedhdf5file(cachefp, files, virtual=virtualcache)
+            zonemaps = config.get("cache_zonemaps", False)
+            create_mergedhdf5file(tmppath, files, virtual=virtualcache, progress=print_msg, zonemaps=zonemaps)
+            with h5py.File(tmppath, "r+") as hf:
+                hf.attrs["_cachingcomplete"] = True  # mark that caching complete
         except Exception as ex:
-            if os.path.exists(cachefp):
-                os.remove(cachefp)  # remove failed attempt at merging file
+            if os.path.exists(tmppath):
+                os.remove(tmppath)  # remove failed attempt at merging file
             raise ex
+        os.replace(tmppath, cachefp)
 
-        with h5py.File(cachefp, "r+") as hf:
-            hf.attrs["_cachingcomplete"] = True  # mark that caching complete
+    def update_cachefile(self, location, fileprefix="", choose_prefix=False):
+        """
+        Update the cache file for chunk files that changed since its creation.
+
+        Parameters
+        ----------
+        location: str
+            Location of cache file.
+        fileprefix: str
+            Prefix of files to be loaded. If None, we take the first prefix.
+        choose_prefix: bool
+            Whether to choose the prefix if multiple are available.
 
-    def load_cachefile(self, location, token="", chunksize="auto", **kwargs):
+        Returns
+        -------
+        bool
+            False if the cache file needs to be recreated, True otherwise.
+        """
+        try:
+            files = self.get_chunkedfiles(fileprefix, choose_prefix=choose_prefix)
+        except ValueError:
+            return True  # cannot check against chunk files, keep cache file
+        uptodate = update_mergedhdf5file(location, files)
+        if uptodate:
+            add_zonemaps(location, files, get_config().get("cache_zonemaps", False))
+        # older cache files do not hold the information to check for changes
+        return uptodate is None or uptodate
+
+    def load_cachefile(self, location, token="", chunksize="auto", directread=False, **kwargs):
         """
         Load data from cache file.
 
@@ -496,6 +550,8 @@ class ChunkedHDF5Loader(Loader):
             Token to be used for dask arrays.
         chunksize: str
             Chunksize for dask arrays.
+        directread: bool
+            Whether to read fields directly from the chunk files rather than through the cache file.
         kwargs: dict
             Additional keyword arguments.
 
@@ -519,10 +575,56 @@ class ChunkedHDF5Loader(Loader):
         if not cache_valid:
             raise InvalidCacheError("Cache file '%s' is not valid. Delete file and try again." % location)
 
-        datadict = load_datadict_old(location, self.file, token=token, chunksize=chunksize, **kwargs)
+        sources = None
+        if directread:
+            sources = get_chunksources(hf)
+            if sources is None:
+                log.warning("Cache file '%s' does not hold the chunk file table, direct reads disabled.", location)
+
+        datadict = load_datadict_old(location, self.file, token=token, chunksize=chunksize, sources=sources, **kwargs)
         return datadict
 
 
+def _get_datagroups(tree, groups_load=None):
+    """
+    Index the datasets of a walked file by the group containing them.
+
+    Parameters
+    ----------
+    tree: dict
+        Tree as returned by walk_hdf5file/walk_zarrfile.
+    groups_load: list
+        List of groups to load. If None, load all groups.
+
+    Returns
+    -------
+    datagroups: list
+        Names of groups holding datasets (directly or nested).
+    table: dict
+        Maps group names ("" for root) to lists of (index, path, fieldname) of its non-scalar datasets.
+    """
+    dsnames = sorted(dt[0] for dt in tree["datasets"])
+    datagroups = []
+    for grp in tree["groups"]:
+        # groups with any dataset name starting with the group name
+        j = bisect.bisect_left(dsnames, grp)
+        if j < len(dsnames) and dsnames[j].startswith(grp):
+            datagroups.append(grp)
+    if groups_load is not None:
+        datagroups = sorted([grp for grp in datagroups if grp in groups_load])
+
+    table = {grp: [] for grp in datagroups}
+    for i, dataset in enumerate(tree["datasets"]):
+        if len(dataset[1]) == 0:
+            continue  # ignore scalars
+        fpath, _, fieldname = dataset[0].rpartition("/")
+        if fpath == "":
+            table.setdefault("", [])
+        if fpath in table:
+            table[fpath].append((i, dataset[0], fieldname))
+    return datagroups, table
+
+
 def load_datadict_old(
     location,
     file,
@@ -533,6 +635,8 @@ def load_datadict_old(
     lazy=True,  # if true, call da.from_array delayed
     filetype="hdf5",
     withunits=False,
+    tree=None,
+    sources=None,
 ):
     """
     Load data from HDF5/Zarr resource into a dictionary of dask arrays.
@@ -556,6 +660,11 @@ def load_datadict_old(
         Filetype of resource.
     withunits: bool
         Whether to load units.
+    tree: dict
+        Tree of the resource as returned by walk_hdf5file/walk_zarrfile, if already walked.
+    sources: dict
+        Source file ranges of the datasets as returned by get_chunksources. If given,
+        datasets are read directly from the source files, one file range per dask block or blocks.
 
     Returns
     -------
@@ -567,87 +676,68 @@ def load_datadict_old(
     inline_array = False  # inline arrays in dask; intended to improve dask scheduling (?). However, doesnt work with h5py (need h5pickle wrapper or zarr).
     if isinstance(file, h5py.File):
         inline_array = False
+    # read through picklable references and pooled file handles instead of the given handle
+    pooled = isinstance(file, h5py.File) and get_config_flag("filehandle_pool")
 
-    data = {}
-    tree = {}
-    if filetype == "hdf5":
-        walk_hdf5file(location, tree)
-    elif filetype == "zarr":
-        walk_zarrfile(location, tree)
-    else:
-        raise ValueError("Unknown filetype ''" % filetype)
+    if tree is None:
+        tree = {}
+        if filetype == "hdf5":
+            walk_hdf5file(location, tree)
+        elif filetype == "zarr":
+            walk_zarrfile(location, tree)
+        else:
+            raise ValueError("Unknown filetype ''" % filetype)
 
     # hosting all data
     rootcontainer = FieldContainer(fieldrecipes_kwargs=derivedfields_kwargs, withunits=withunits)
 
-    datagroups = []  # names of groups with datasets
-    # othergroups = []  # names of groups without datasets
-    # datasets = []  # list of datasets (relative path from root)
-    # each dataset entry is a tuple of (relpath, shape, dtype)
-    # attributes = {}  # dictionary of attributes
-    # key holds the relpath to the group and the value a dictionary of the attribute data
-
-    grps = tree["groups"]
-    dts = tree["datasets"]
-    for grp in grps:
-        for dt in dts:
-            dn = dt[0]
-            if dn.startswith(grp):
-                datagroups.append(grp)
-                break
-
-    # groups
-    if groups_load is not None:
-        datagroups = sorted([grp for grp in datagroups if grp in groups_load])
+    # groups with datasets, and the datasets per group to load
+    datagroups, table = _get_datagroups(tree, groups_load=groups_load)
 
     # Make each datadict entry a FieldContainer
     for group in datagroups:
         get_container_from_path(group, rootcontainer, create_missing=True)
 
+    dsnames = dict()
+    if "__dask_tokenize__" in file:  # check if the file contains the dask names.
+        dsnames = file["__dask_tokenize__"].attrs
+
     # datasets
-    for i, dataset in enumerate(tree["datasets"]):
-        # fpath is the path to the group containing given field
-        # ignore if scalar
-        if len(dataset[1]) == 0:
-            continue
-        fpath = "/".join(dataset[0].split("/")[:-1])
-        toload = fpath == "" or fpath in datagroups
-        if not toload:
+    datasets = tree["datasets"]
+    for fpath, entries in table.items():
+        if len(entries) == 0:
             continue
-
         container = get_container_from_path(fpath, rootcontainer)
-        # TODO: still change for nesting
-        splt = dataset[0].rstrip("/").split("/")
-        group = splt[1]
-        fieldname = splt[-1]
-        name = "Dataset" + str(token) + dataset[0].replace("/", "_")
-        if "__dask_tokenize__" in file:  # check if the file contains the dask name.
-            name = file["__dask_tokenize__"].attrs.get(dataset[0].strip("/"), name)
-
-        # we do not support HDF5 vlen dtype
-        if filetype == "hdf5":
-            hds = file[dataset[0]]
-            dt = hds.dtype
-            if h5py.check_vlen_dtype(dt):
-                log.warning("HDF5 vlen dtypes not supported. Skip loading field '%s'" % fieldname)
-                continue
-
-        lz = lazy and i > 0  # need one non-lazy field (?)
-        fieldpath = dataset[0]
-        _add_hdf5arr_to_fieldcontainer(
-            file,
-            container,
-            fieldpath,
-            fieldname,
-            name,
-            chunksize,
-            inline_array=inline_array,
-            lazy=lz,
-        )
+        for i, fieldpath, fieldname in entries:
+            name = "Dataset" + str(token) + fieldpath.replace("/", "_")
+            name = dsnames.get(fieldpath.strip("/"), name)
+
+            # we do not support HDF5 vlen dtype
+            if filetype == "hdf5":
+                dt = datasets[i][2]
+                if dt is None or np.dtype(dt).kind == "O":
+                    dt = file[fieldpath].dtype
+                if h5py.check_vlen_dtype(dt):
+                    log.warning("HDF5 vlen dtypes not supported. Skip loading field '%s'" % fieldname)
+                    continue
+
+            lz = lazy and i > 0  # need one non-lazy field (?)
+            _add_hdf5arr_to_fieldcontainer(
+                file,
+                container,
+                fieldpath,
+                fieldname,
+                name,
+                chunksize,
+                inline_array=inline_array,
+                lazy=lz,
+                pooled=pooled,
+                sources=None if sources is None else sources.get(fieldpath),
+            )
 
     data = rootcontainer
 
-    dtsdict = {k[0]: k[1:] for k in tree["datasets"]}
+    dtsdict = {k[0]: k[1:] for k in datasets}
 
     # create uids fields for all containers
     def create_uids(container: FieldContainer, path: str):
@@ -816,6 +906,8 @@ def _add_hdf5arr_to_fieldcontainer(
     chunksize,
     inline_array=False,
     lazy=True,
+    pooled=False,
+    sources=None,
 ):
     """
     Add HDF5 array to field container.
@@ -837,44 +929,78 @@ def _add_hdf5arr_to_fieldcontainer(
         whether to inline array in dask
     lazy: bool
         whether to load array lazily
+    pooled: bool
+        whether to read through picklable dataset references and the file handle pool
+        rather than the given file handle
+    sources: list
+        (file, length) of the source files holding consecutive ranges of the field to read directly from
 
     Returns
     -------
     None
     """
-    if not lazy:
-        hds = file[fieldpath]
-        ds = da.from_array(
-            hds,
-            chunks=chunksize,
-            name=name,
-            inline_array=inline_array,
-        )
-        container[fieldname] = ds
-        return
-
-    def field(arrs, snap=None, h5path="", chunksize="", name="", inline_array=False, file=None, **kwargs):
-        """
-        helper function to load resource field into dask array
-        """
-        hds = file[h5path]
-        arr = da.from_array(
-            hds,
-            chunks=chunksize,
-            name=name,
-            inline_array=inline_array,
-        )
-        return arr
-
     fnc = partial(
-        field,
+        _hdf5field,
         h5path=fieldpath,
         chunksize=chunksize,
         name=name,
         inline_array=inline_array,
         file=file,
+        pooled=pooled,
+        sources=sources,
+    )
+    if not lazy:
+        container[fieldname] = fnc(None)
+        return
+    container[fieldname] = DerivedFieldRecipe(fieldname, fnc, description=fieldname + ": lazy field from disk")
+
+
+def _hdf5field(
+    arrs,
+    snap=None,
+    h5path="",
+    chunksize="",
+    name="",
+    inline_array=False,
+    file=None,
+    pooled=False,
+    sources=None,
+    **kwargs,
+):
+    """
+    Recipe to load resource field into dask array.
+    """
+    hds = file[h5path]
+    filechunks = chunksize == "files"
+    if filechunks:
+        chunksize = "auto"
+    rowbytes = get_dtype(hds).itemsize * int(np.prod(hds.shape[1:], dtype=np.int64))
+    if sources is not None and sum(n for _, n in sources) == hds.shape[0]:
+        # bypass the virtual dataset: concatenate the ranges of the source files
+        arrs = []
+        for k, (fn, n) in enumerate(sources):
+            ref = HDF5DatasetReference(fn, h5path, (n,) + hds.shape[1:], get_dtype(hds))
+            chunks = chunksize
+            if filechunks:
+                chunks = (get_filealigned_chunks([n], rowbytes),) + hds.shape[1:]
+            arrs.append(da.from_array(ref, chunks=chunks, name="%s-file%i" % (name, k)))
+        if len(arrs) == 1:
+            return arrs[0]
+        return da.concatenate(arrs, axis=0)
+    if filechunks and isinstance(file, h5py.File) and "_chunks" in file and h5path in file["_chunks"].attrs:
+        # align chunks with the files concatenated in the cache file
+        lengths = file["_chunks"].attrs[h5path][:, 1]
+        if np.sum(lengths[lengths > 0]) == hds.shape[0]:
+            chunksize = (get_filealigned_chunks(lengths, rowbytes),) + hds.shape[1:]
+    if pooled and isinstance(hds, h5py.Dataset):
+        hds = HDF5DatasetReference.from_dataset(hds)
+    arr = da.from_array(
+        hds,
+        chunks=chunksize,
+        name=name,
+        inline_array=inline_array,
     )
-    container.register_field(name=fieldname, description=fieldname + ": lazy field from disk")(fnc)
+    return arr
 
 
 def _get_chunkedfiles(path, fileprefix: Optional[str] = "", choose_prefix=False) -> list:
@@ -0,0 +1,181 @@
+"""
+Pooled HDF5 file handles and picklable dataset references for lazy fields.
+"""
+
+import logging
+import os
+import threading
+
+import h5py
+import numpy as np
+
+from scida.config import get_config
+
+log = logging.getLogger(__name__)
+
+
+class FileHandlePool:
+    """
+    Per-process pool of open read-only HDF5 file handles with least-recently-used eviction.
+    """
+
+    def __init__(self, maxsize=None):
+        """
+        Initialize an empty pool.
+
+        Parameters
+        ----------
+        maxsize: Optional[int]
+            Maximum number of open file handles. If None, read from config option "filehandle_pool_size".
+        """
+        self._maxsize = maxsize
+        self._handles = dict()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self) -> int:
+        """Maximum number of open file handles."""
+        if self._maxsize is None:
+            return int(get_config().get("filehandle_pool_size", 128))
+        return self._maxsize
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __contains__(self, path):
+        return os.path.realpath(path) in self._handles
+
+    def get(self, path) -> h5py.File:
+        """
+        Return an open handle for the given file, opening it if needed.
+
+        Parameters
+        ----------
+        path: str
+            Path to the HDF5 file.
+
+        Returns
+        -------
+        h5py.File
+        """
+        path = os.path.realpath(path)
+        with self._lock:
+            if self._pid != os.getpid():
+                # handles inherited from a forked parent process must not be used
+                self._handles = dict()
+                self._pid = os.getpid()
+            hf = self._handles.pop(path, None)
+            if hf is None or not hf.id.valid:
+                hf = h5py.File(path, "r")
+            self._handles[path] = hf  # (re-)insert as most recently used
+            while len(self._handles) > max(self.maxsize, 1):
+                # evicted handles are closed once no dataset of theirs is referenced anymore
+                evicted = next(iter(self._handles))
+                log.debug("Evicting file handle '%s' from pool.", evicted)
+                self._handles.pop(evicted)
+        return hf
+
+    def clear(self, close=False):
+        """
+        Remove all handles from the pool.
+
+        Parameters
+        ----------
+        close: bool
+            Whether to explicitly close the handles, invalidating datasets still referencing them.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            handles = list(self._handles.values())
+            self._handles = dict()
+        if close:
+            for hf in handles:
+                hf.close()
+
+
+_pool = FileHandlePool()
+
+
+def get_filehandle_pool() -> FileHandlePool:
+    """
+    Return the process-wide file handle pool.
+
+    Returns
+    -------
+    FileHandlePool
+    """
+    return _pool
+
+
+class HDF5DatasetReference:
+    """
+    Picklable reference to a HDF5 dataset that is read through the process-wide file handle pool.
+    Can be passed to dask.array.from_array in place of a h5py.Dataset.
+    """
+
+    def __init__(self, path, name, shape, dtype):
+        """
+        Create a reference to a dataset.
+
+        Parameters
+        ----------
+        path: str
+            Path to the HDF5 file.
+        name: str
+            Path of the dataset within the file.
+        shape: tuple
+            Shape of the dataset.
+        dtype: np.dtype
+            Data type of the dataset.
+        """
+        self.path = os.path.realpath(path)
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def from_dataset(cls, dataset: h5py.Dataset):
+        """
+        Create a reference from an open h5py dataset.
+
+        Parameters
+        ----------
+        dataset: h5py.Dataset
+
+        Returns
+        -------
+        HDF5DatasetReference
+        """
+        return cls(dataset.file.filename, dataset.name, dataset.shape, dataset.dtype)
+
+    @property
+    def ndim(self) -> int:
+        """Number of dimensions."""
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        """Number of elements."""
+        return int(np.prod(self.shape, dtype=np.int64))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return get_filehandle_pool().get(self.path)[self.name][key]
+
+    def __dask_tokenize__(self):
+        return (type(self).__name__, self.path, self.name, self.shape, str(self.dtype))
+
+    def __repr__(self):
+        return "%s(path='%s', name='%s', shape=%s, dtype=%s)" % (
+            type(self).__name__,
+            self.path,
+            self.name,
+            self.shape,
+            self.dtype,
+        )
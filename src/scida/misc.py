@@ -93,7 +93,7 @@ def path_hdf5cachefile_exists(path, **kwargs) -> bool:
     return False
 
 
-def return_cachefile_path(fname: str) -> Optional[str]:
+def return_cachefile_path(fname: str, create: bool = True) -> Optional[str]:
     """
     Return the path to the cache file, return None if path cannot be generated.
 
@@ -101,6 +101,8 @@ def return_cachefile_path(fname: str) -> Optional[str]:
     ----------
     fname: str
         filename of cache file
+    create: bool
+        whether to create the cache directory and the parent directory of the cache file
 
     Returns
     -------
@@ -112,10 +114,12 @@ def return_cachefile_path(fname: str) -> Optional[str]:
         return None
     cp = config["cache_path"]
     cp = os.path.expanduser(cp)
-    path = pathlib.Path(cp)
-    path.mkdir(parents=True, exist_ok=True)
     fp = os.path.join(cp, fname)
     fp = os.path.expanduser(fp)
+    if not create:
+        return fp
+    path = pathlib.Path(cp)
+    path.mkdir(parents=True, exist_ok=True)
     bp = os.path.dirname(fp)
     if not os.path.exists(bp):
         try:
@@ -125,6 +129,82 @@ def return_cachefile_path(fname: str) -> Optional[str]:
     return fp
 
 
+def get_pathfiles(path) -> list:
+    """
+    List the files making up a (possibly multi-file) data set.
+
+    Parameters
+    ----------
+    path: str
+        Path to a file or directory.
+
+    Returns
+    -------
+    list
+        Sorted real paths of the files.
+    """
+    path = os.path.realpath(path)
+    if not os.path.isdir(path):
+        return [path]
+    files = []
+    for root, dirs, fns in os.walk(path):
+        dirs.sort()
+        files += [os.path.join(root, fn) for fn in sorted(fns)]
+    return files
+
+
+def coalesce_ranges(starts, lengths):
+    """
+    Merge consecutive index ranges that are contiguous.
+
+    Parameters
+    ----------
+    starts: np.ndarray
+        Start of each range.
+    lengths: np.ndarray
+        Length of each range.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        start and end of the merged ranges, at least one (possibly empty) range
+    """
+    starts, lengths = np.asarray(starts, dtype=np.int64), np.asarray(lengths, dtype=np.int64)
+    keep = lengths > 0
+    starts, ends = starts[keep], starts[keep] + lengths[keep]
+    if starts.shape[0] == 0:
+        return np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+    brk = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+    return starts[np.append(0, brk)], ends[np.append(brk - 1, ends.shape[0] - 1)]
+
+
+def take_ranges(arr, starts, ends):
+    """
+    Concatenate the given index ranges of an array along the first axis.
+
+    Parameters
+    ----------
+    arr: da.Array
+        Array, optionally with units.
+    starts: np.ndarray
+        Start of each range.
+    ends: np.ndarray
+        End of each range.
+
+    Returns
+    -------
+    da.Array
+    """
+    if len(starts) == 0:
+        return arr[:0]
+    if len(starts) == 1:
+        return arr[int(starts[0]) : int(ends[0])]
+    units = getattr(arr, "units", None)
+    mag = arr.magnitude if units is not None else arr
+    res = da.concatenate([mag[int(start) : int(end)] for start, end in zip(starts, ends)])
+    return res * units if units is not None else res
+
+
 def map_interface_args(paths: list, *args, **kwargs):
     """
     Map arguments for interface if they are not lists.
@@ -226,6 +306,41 @@ def rectangular_cutout_mask(center, width, coords, pbc=True, boxsize=None, backe
     return mask
 
 
+def box_overlaps_bounds(center, width, lower, upper, boxsize=None):
+    """
+    Check whether an axis-aligned box can overlap with axis-aligned bounds.
+
+    Parameters
+    ----------
+    center: np.ndarray
+        center of the box
+    width: np.ndarray
+        widths of the box
+    lower: np.ndarray
+        lower corners of the bounds, shape (N, 3)
+    upper: np.ndarray
+        upper corners of the bounds, shape (N, 3)
+    boxsize: Optional[np.ndarray]
+        size of the periodic domain; no periodic wrapping if None
+
+    Returns
+    -------
+    np.ndarray
+        boolean array of shape (N,), conservatively True if the box might overlap with the bounds
+    """
+    center = np.asarray(center, dtype=np.float64)
+    half = np.asarray(width, dtype=np.float64) / 2.0
+    lower, upper = np.asarray(lower, dtype=np.float64), np.asarray(upper, dtype=np.float64)
+    shifts = [0.0]
+    if boxsize is not None and np.all(np.isfinite(boxsize)):
+        shifts = [-1.0, 0.0, 1.0]
+    overlap = np.zeros(lower.shape, dtype=bool)
+    for shift in shifts:
+        c = center + shift * (boxsize if len(shifts) > 1 else 0.0)
+        overlap |= (lower <= c + half) & (upper >= c - half)
+    return np.all(overlap, axis=-1)
+
+
 def check_config_for_dataset(metadata, path: Optional[str] = None, unique: bool = True):
     """
     Check whether the given dataset can be identified to be a certain simulation (type) by its metadata.
@@ -277,6 +277,24 @@ class DatasetSeries(object):
         result = result[:-2] + "]"
         return result
 
+    @classmethod
+    def check_fingerprint(cls, fingerprint: dict) -> bool:
+        """
+        Cheap check whether a path can be valid for this dataseries class based on its fingerprint,
+        see scida.discovertypes.get_fingerprint. Returning False skips the full validate_path.
+        Subclasses may only prune paths that validate_path would reject.
+
+        Parameters
+        ----------
+        fingerprint: dict
+            Fingerprint of the path.
+
+        Returns
+        -------
+        bool
+        """
+        return True
+
     @classmethod
     def validate_path(cls, path, *args, **kwargs) -> CandidateStatus:
         """
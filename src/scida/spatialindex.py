@@ -0,0 +1,543 @@
+"""
+Coarse spatial index of particle coordinates.
+
+The particles are split into blocks of consecutive particles. For each block, the index stores the bounding
+box and the cells of a coarse uniform grid over the domain that hold at least one of its particles. Queries
+return the particle ranges of the blocks that can hold particles in the queried region, so that only these
+need to be read. The index is stored in the cache directory and keyed by the state of the data set's files.
+"""
+
+import hashlib
+import logging
+import os
+from typing import Optional
+
+import dask
+import h5py
+import numpy as np
+
+from scida.helpers_hdf5 import get_filestats
+from scida.misc import coalesce_ranges, get_pathfiles, return_cachefile_path
+
+log = logging.getLogger(__name__)
+
+_version = 1
+_ngrid_default = 16
+_blocksize_default = 2**20
+
+
+def _block_summary(coords, origin, cellsize, ngrid, periodic):
+    """Bounding box and packed cell occupancy of a block of coordinates."""
+    coords = np.asarray(coords)
+    occupancy = np.zeros(ngrid**3, dtype=bool)
+    if coords.shape[0] == 0:
+        return np.full((2, 3), np.nan), np.packbits(occupancy)
+    idx = np.floor((coords - origin) / cellsize).astype(np.int64)
+    if periodic:
+        idx %= ngrid  # positions on or beyond the box boundary map to their periodic image
+    else:
+        np.clip(idx, 0, ngrid - 1, out=idx)
+    occupancy[(idx[:, 0] * ngrid + idx[:, 1]) * ngrid + idx[:, 2]] = True
+    return np.stack([coords.min(axis=0), coords.max(axis=0)]), np.packbits(occupancy)
+
+
+class GridIndex:
+    """
+    Block bounding boxes and occupancy of a coarse uniform grid for the coordinates of a particle type.
+    """
+
+    def __init__(self, blockedges, bboxes, occupancy, origin, cellsize, ngrid, periodic=True):
+        """
+        Initialize the index.
+
+        Parameters
+        ----------
+        blockedges: np.ndarray
+            Particle index of the block boundaries, shape (Nblocks + 1,).
+        bboxes: np.ndarray
+            Minimum and maximum coordinates of each block, shape (Nblocks, 2, 3).
+        occupancy: np.ndarray
+            Bit-packed occupied grid cells of each block, shape (Nblocks, ceil(ngrid**3 / 8)).
+        origin: np.ndarray
+            Lower corner of the grid.
+        cellsize: np.ndarray
+            Size of a grid cell along each axis.
+        ngrid: int
+            Number of grid cells along each axis.
+        periodic: bool
+            Whether the grid covers a periodic box.
+        """
+        self.blockedges = np.asarray(blockedges, dtype=np.int64)
+        self.bboxes = np.asarray(bboxes, dtype=np.float64)
+        self.occupancy = np.asarray(occupancy, dtype=np.uint8)
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.cellsize = np.asarray(cellsize, dtype=np.float64)
+        self.ngrid = int(ngrid)
+        self.periodic = bool(periodic)
+
+    @property
+    def nblocks(self) -> int:
+        """Number of particle blocks."""
+        return self.blockedges.shape[0] - 1
+
+    @classmethod
+    def build(cls, coords, boxsize=None, ngrid=None, blocksize=None):
+        """
+        Build the index in a single pass over the coordinates.
+
+        Parameters
+        ----------
+        coords: da.Array
+            Coordinates of shape (N, 3) without units.
+        boxsize: Optional[np.ndarray]
+            Size of the periodic box. If None or not finite, the grid spans the bounding box of the coordinates.
+        ngrid: Optional[int]
+            Number of grid cells along each axis.
+        blocksize: Optional[int]
+            Number of particles per block.
+
+        Returns
+        -------
+        GridIndex
+        """
+        ngrid = _ngrid_default if ngrid is None else int(ngrid)
+        blocksize = _blocksize_default if blocksize is None else int(blocksize)
+        periodic = boxsize is not None and np.all(np.isfinite(boxsize))
+        if periodic:
+            origin = np.zeros(3)
+            cellsize = np.broadcast_to(np.asarray(boxsize, dtype=np.float64), (3,)) / ngrid
+        else:
+            lo, hi = dask.compute(coords.min(axis=0), coords.max(axis=0))
+            extent = np.where(hi > lo, hi - lo, 1.0)
+            origin = lo
+            cellsize = extent * (1.0 + 1e-9) / ngrid
+        coords = coords.rechunk((blocksize, 3))
+        blockedges = np.concatenate([[0], np.cumsum(coords.chunks[0])])
+        tasks = [
+            dask.delayed(_block_summary)(blk, origin, cellsize, ngrid, periodic) for blk in coords.to_delayed().ravel()
+        ]
+        summaries = dask.compute(*tasks)
+        nbytes = (ngrid**3 + 7) // 8
+        bboxes = np.array([s[0] for s in summaries]).reshape(-1, 2, 3)
+        occupancy = np.array([s[1] for s in summaries], dtype=np.uint8).reshape(-1, nbytes)
+        return cls(blockedges, bboxes, occupancy, origin, cellsize, ngrid, periodic=periodic)
+
+    def write(self, path) -> None:
+        """
+        Write the index to a HDF5 file.
+
+        Parameters
+        ----------
+        path: str
+
+        Returns
+        -------
+        None
+        """
+        tmppath = "%s.%i.tmp" % (path, os.getpid())
+        with h5py.File(tmppath, "w") as hf:
+            hf.attrs["version"] = _version
+            hf.attrs["ngrid"] = self.ngrid
+            hf.attrs["periodic"] = self.periodic
+            for k in ["blockedges", "bboxes", "occupancy", "origin", "cellsize"]:
+                hf.create_dataset(k, data=getattr(self, k))
+        os.replace(tmppath, path)  # other processes never see partially written files
+
+    @classmethod
+    def read(cls, path) -> Optional["GridIndex"]:
+        """
+        Read an index written by write().
+
+        Parameters
+        ----------
+        path: str
+
+        Returns
+        -------
+        Optional[GridIndex]
+            The index or None if it does not exist or cannot be read.
+        """
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with h5py.File(path, "r") as hf:
+                if hf.attrs.get("version", -1) != _version:
+                    return None
+                arrs = {k: hf[k][()] for k in ["blockedges", "bboxes", "occupancy", "origin", "cellsize"]}
+                return cls(ngrid=hf.attrs["ngrid"], periodic=hf.attrs["periodic"], **arrs)
+        except OSError as e:
+            log.warning("Could not read spatial index '%s': %s", path, e)
+            return None
+
+    def get_cells(self, lower, upper) -> np.ndarray:
+        """
+        Get the grid cells overlapping an axis-aligned box.
+
+        Parameters
+        ----------
+        lower: np.ndarray
+            Lower corner of the box. For periodic grids, the box may extend beyond the domain.
+        upper: np.ndarray
+            Upper corner of the box.
+
+        Returns
+        -------
+        np.ndarray
+            Flat indices of the cells.
+        """
+        lower, upper = np.asarray(lower, dtype=np.float64), np.asarray(upper, dtype=np.float64)
+        axes = []
+        for i in range(3):
+            i0 = int(np.floor((lower[i] - self.origin[i]) / self.cellsize[i]))
+            i1 = int(np.floor((upper[i] - self.origin[i]) / self.cellsize[i]))
+            if self.periodic:
+                idx = np.arange(self.ngrid) if i1 - i0 + 1 >= self.ngrid else np.arange(i0, i1 + 1) % self.ngrid
+            else:
+                idx = np.arange(max(i0, 0), min(i1, self.ngrid - 1) + 1)
+            axes.append(idx)
+        ix, iy, iz = np.meshgrid(*axes, indexing="ij")
+        return np.unique(((ix * self.ngrid + iy) * self.ngrid + iz).ravel())
+
+    def query_cells(self, cells) -> np.ndarray:
+        """
+        Get the blocks occupying any of the given cells.
+
+        Parameters
+        ----------
+        cells: np.ndarray
+            Flat indices of grid cells.
+
+        Returns
+        -------
+        np.ndarray
+            Indices of the blocks.
+        """
+        cells = np.asarray(cells, dtype=np.int64)
+        if cells.shape[0] == 0:
+            return np.zeros(0, dtype=np.int64)
+        bits = (self.occupancy[:, cells // 8] >> (7 - cells % 8).astype(np.uint8)) & 1
+        return np.flatnonzero(bits.any(axis=1))
+
+    def query_box(self, center, width) -> np.ndarray:
+        """
+        Get the blocks that can hold particles within an axis-aligned box.
+
+        Parameters
+        ----------
+        center: np.ndarray
+            Center of the box.
+        width: np.ndarray
+            Width of the box along each axis.
+
+        Returns
+        -------
+        np.ndarray
+            Indices of the blocks.
+        """
+        center = np.broadcast_to(np.asarray(center, dtype=np.float64), (3,))
+        half = np.broadcast_to(np.asarray(width, dtype=np.float64), (3,)) / 2.0
+        blocks = self.query_cells(self.get_cells(center - half, center + half))
+        if not self.periodic:
+            bbox = self.bboxes[blocks]
+            overlap = np.all((bbox[:, 0] <= center + half) & (bbox[:, 1] >= center - half), axis=1)
+            blocks = blocks[overlap]
+        return blocks
+
+    def query_sphere(self, center, radius) -> np.ndarray:
+        """
+        Get the blocks that can hold particles within a sphere.
+
+        Parameters
+        ----------
+        center: np.ndarray
+            Center of the sphere.
+        radius: float
+            Radius of the sphere.
+
+        Returns
+        -------
+        np.ndarray
+            Indices of the blocks.
+        """
+        return self.query_box(center, 2.0 * np.asarray(radius, dtype=np.float64))
+
+    def get_ranges(self, blocks):
+        """
+        Get the particle ranges of the given blocks, merging adjacent blocks.
+
+        Parameters
+        ----------
+        blocks: np.ndarray
+            Sorted block indices.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            start and end of the particle ranges
+        """
+        blocks = np.asarray(blocks, dtype=np.int64)
+        starts = self.blockedges[blocks]
+        return coalesce_ranges(starts, self.blockedges[blocks + 1] - starts)
+
+
+def _ranges_to_indices(starts, ends) -> np.ndarray:
+    """Concatenate np.arange(start, end) for all given ranges."""
+    starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    lengths = ends - starts
+    keep = lengths > 0
+    starts, lengths = starts[keep], lengths[keep]
+    if starts.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(np.sum(lengths))
+
+
+def periodic_distance(coords, center, boxsize=None) -> np.ndarray:
+    """
+    Distance of coordinates to a center, using the nearest periodic image if a boxsize is given.
+
+    Parameters
+    ----------
+    coords: np.ndarray
+        Coordinates of shape (N, 3).
+    center: np.ndarray
+        Center.
+    boxsize: Optional[np.ndarray]
+        Size of the periodic box.
+
+    Returns
+    -------
+    np.ndarray
+    """
+    d = np.asarray(coords) - np.asarray(center)
+    if boxsize is not None:
+        d -= boxsize * np.round(d / boxsize)
+    return np.sqrt(np.sum(d**2, axis=-1))
+
+
+class BlockTree:
+    """
+    Cell list of the particles of a block of the spatial index for exact neighbor queries.
+    Particles are sorted by the cells of a uniform grid over the block's bounding box.
+    """
+
+    def __init__(self, coords, boxsize=None, leafsize=16):
+        """
+        Build the cell list.
+
+        Parameters
+        ----------
+        coords: np.ndarray
+            Coordinates of the block's particles, shape (N, 3).
+        boxsize: Optional[np.ndarray]
+            Size of the periodic box. No periodic images are considered if None.
+        leafsize: int
+            Average number of particles per cell.
+        """
+        self.coords = np.asarray(coords, dtype=np.float64)
+        self.boxsize = None
+        if boxsize is not None and np.all(np.isfinite(boxsize)):
+            self.boxsize = np.broadcast_to(np.asarray(boxsize, dtype=np.float64), (3,))
+        n = self.coords.shape[0]
+        self.ngrid = max(1, int(np.cbrt(n / max(leafsize, 1))))
+        if n == 0:
+            self.lower, self.upper = np.zeros(3), np.zeros(3)
+        else:
+            self.lower, self.upper = self.coords.min(axis=0), self.coords.max(axis=0)
+        extent = self.upper - self.lower
+        self.cellsize = np.where(extent > 0, extent, 1.0) * (1.0 + 1e-9) / self.ngrid
+        cells = self._get_cellids(self.coords)
+        self.order = np.argsort(cells, kind="stable")
+        self.cellstarts = np.searchsorted(cells[self.order], np.arange(self.ngrid**3 + 1))
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the cell list in bytes."""
+        return self.coords.nbytes + self.order.nbytes + self.cellstarts.nbytes
+
+    def _get_cellids(self, coords):
+        """Flat cell index of coordinates."""
+        idx = np.floor((coords - self.lower) / self.cellsize).astype(np.int64)
+        np.clip(idx, 0, self.ngrid - 1, out=idx)
+        return (idx[:, 0] * self.ngrid + idx[:, 1]) * self.ngrid + idx[:, 2]
+
+    def _get_images(self, center, radius):
+        """Periodic images of the center whose sphere can overlap with the bounding box."""
+        shifts = [np.zeros(3)]
+        if self.boxsize is not None:
+            grid = np.stack(np.meshgrid(*[[-1.0, 0.0, 1.0]] * 3, indexing="ij"), axis=-1).reshape(-1, 3)
+            shifts = grid * self.boxsize
+        images = center + np.asarray(shifts)
+        overlap = np.all((images - radius <= self.upper) & (images + radius >= self.lower), axis=1)
+        return images[overlap]
+
+    def query_ball(self, center, radius, rmin=None):
+        """
+        Get the particles within a sphere or spherical shell around a center.
+
+        Parameters
+        ----------
+        center: np.ndarray
+            Center.
+        radius: float
+            Outer radius (exclusive).
+        rmin: Optional[float]
+            Inner radius (inclusive).
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            sorted indices of the particles within the block and their distances
+        """
+        center = np.asarray(center, dtype=np.float64)
+        candidates = []
+        for image in self._get_images(center, radius):
+            lo = np.floor((image - radius - self.lower) / self.cellsize).astype(np.int64)
+            hi = np.floor((image + radius - self.lower) / self.cellsize).astype(np.int64)
+            lo, hi = np.clip(lo, 0, self.ngrid - 1), np.clip(hi, 0, self.ngrid - 1)
+            # cells are contiguous along the last axis
+            ix, iy = np.meshgrid(np.arange(lo[0], hi[0] + 1), np.arange(lo[1], hi[1] + 1), indexing="ij")
+            base = (ix.ravel() * self.ngrid + iy.ravel()) * self.ngrid
+            starts, ends = self.cellstarts[base + lo[2]], self.cellstarts[base + hi[2] + 1]
+            candidates.append(self.order[_ranges_to_indices(starts, ends)])
+        if len(candidates) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        candidates = np.unique(np.concatenate(candidates))
+        dists = periodic_distance(self.coords[candidates], center, self.boxsize)
+        keep = dists < radius
+        if rmin is not None:
+            keep &= dists >= rmin
+        return candidates[keep], dists[keep]
+
+
+class BoxBinning:
+    """
+    Binning of axis-aligned query boxes onto a uniform grid, mapping each grid cell to the boxes overlapping it.
+    Used to assign particles to many boxes in a single pass.
+    """
+
+    def __init__(self, centers, widths, origin, span, boxsize=None, ngrid=None):
+        """
+        Bin the boxes.
+
+        Parameters
+        ----------
+        centers: np.ndarray
+            Centers of the boxes, shape (N, 3).
+        widths: np.ndarray
+            Widths of the boxes, shape (N, 3) or broadcastable.
+        origin: np.ndarray
+            Lower corner of the domain.
+        span: np.ndarray
+            Extent of the domain along each axis.
+        boxsize: Optional[np.ndarray]
+            Size of the periodic box. Boxes do not wrap around if None.
+        ngrid: Optional[int]
+            Number of grid cells along each axis. Default: chosen from the median box width, at most 128.
+        """
+        self.centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+        self.widths = np.broadcast_to(np.asarray(widths, dtype=np.float64), self.centers.shape)
+        self.boxsize = None
+        if boxsize is not None and np.all(np.isfinite(boxsize)):
+            self.boxsize = np.broadcast_to(np.asarray(boxsize, dtype=np.float64), (3,))
+        self.origin = np.asarray(origin, dtype=np.float64)
+        span = np.broadcast_to(np.asarray(span, dtype=np.float64), (3,))
+        if ngrid is None:
+            width = np.median(self.widths) if self.widths.size > 0 else 1.0
+            ngrid = int(np.clip(np.min(span) / max(width, 1e-30), 1, 128))
+        self.ngrid = int(ngrid)
+        self.cellsize = span / self.ngrid
+        nboxes = self.centers.shape[0]
+        cells = [self._get_box_cells(i) for i in range(nboxes)]
+        counts = np.array([c.shape[0] for c in cells], dtype=np.int64)
+        cells = np.concatenate(cells) if nboxes > 0 else np.zeros(0, dtype=np.int64)
+        boxes = np.repeat(np.arange(nboxes), counts)
+        order = np.argsort(cells, kind="stable")
+        self.boxes = boxes[order]
+        self.cellstarts = np.searchsorted(cells[order], np.arange(self.ngrid**3 + 1))
+
+    def _get_box_cells(self, i):
+        """Flat indices of the grid cells overlapping the i-th box."""
+        axes = []
+        for j in range(3):
+            lo = self.centers[i, j] - self.widths[i, j] / 2.0
+            hi = self.centers[i, j] + self.widths[i, j] / 2.0
+            i0 = int(np.floor((lo - self.origin[j]) / self.cellsize[j]))
+            i1 = int(np.floor((hi - self.origin[j]) / self.cellsize[j]))
+            if self.boxsize is not None:
+                idx = np.arange(self.ngrid) if i1 - i0 + 1 >= self.ngrid else np.arange(i0, i1 + 1) % self.ngrid
+            else:
+                idx = np.arange(max(i0, 0), min(i1, self.ngrid - 1) + 1)
+            axes.append(idx)
+        ix, iy, iz = np.meshgrid(*axes, indexing="ij")
+        return np.unique(((ix * self.ngrid + iy) * self.ngrid + iz).ravel())
+
+    def assign(self, coords):
+        """
+        Assign particles to the boxes containing them.
+
+        Parameters
+        ----------
+        coords: np.ndarray
+            Coordinates of shape (N, 3).
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            box and particle index of each (box, particle) pair
+        """
+        coords = np.asarray(coords, dtype=np.float64)
+        idx = np.floor((coords - self.origin) / self.cellsize).astype(np.int64)
+        if self.boxsize is not None:
+            idx %= self.ngrid
+        else:
+            np.clip(idx, 0, self.ngrid - 1, out=idx)
+        cells = (idx[:, 0] * self.ngrid + idx[:, 1]) * self.ngrid + idx[:, 2]
+        # candidate pairs of each particle with all boxes overlapping its cell
+        starts, ends = self.cellstarts[cells], self.cellstarts[cells + 1]
+        parts = np.repeat(np.arange(coords.shape[0]), ends - starts)
+        boxes = self.boxes[_ranges_to_indices(starts, ends)]
+        # same criterion as rectangular_cutout_mask
+        dists = np.fabs(coords[parts] - self.centers[boxes])
+        if self.boxsize is not None:
+            dists = np.where(dists > 0.5 * self.boxsize, np.fabs(self.boxsize - dists), dists)
+        inside = np.all(dists < self.widths[boxes] / 2.0, axis=1)
+        return boxes[inside], parts[inside]
+
+
+def get_spatialindex_path(path, name, shape, ngrid=None, blocksize=None, units=None) -> Optional[str]:
+    """
+    Return the path of the spatial index for a field of a data set.
+
+    Parameters
+    ----------
+    path: str
+        Path of the data set.
+    name: str
+        Name of the indexed field, e.g. "PartType0/Coordinates".
+    shape: tuple
+        Shape of the indexed field.
+    ngrid: Optional[int]
+        Number of grid cells along each axis.
+    blocksize: Optional[int]
+        Number of particles per block.
+    units: Optional[str]
+        Units of the indexed field, if any.
+
+    Returns
+    -------
+    Optional[str]
+        Path of the index in the cache directory, None if there is no cache directory.
+    """
+    files = get_pathfiles(path)
+    mtimes, sizes = get_filestats(files)
+    sha = hashlib.sha256()
+    sha.update(str(_version).encode())
+    sha.update(os.path.realpath(path).encode())
+    sha.update("".join(files).encode())
+    sha.update(mtimes.tobytes())
+    sha.update(sizes.tobytes())
+    ngrid = _ngrid_default if ngrid is None else int(ngrid)
+    blocksize = _blocksize_default if blocksize is None else int(blocksize)
+    sha.update(str((name, tuple(shape), ngrid, blocksize, units)).encode())
+    return return_cachefile_path(os.path.join("spatialindex", sha.hexdigest()[:32] + ".hdf5"))
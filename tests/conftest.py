@@ -5,8 +5,9 @@ import pytest
 from scida import ArepoSnapshot, load
 from scida.config import get_config
 from scida.customs.gadgetstyle.dataset import GadgetStyleSnapshot
+from scida.helpers_hdf5 import clear_metadata_cache
 from scida.series import DatasetSeries
-from tests.helpers import DummyGadgetCatalogFile, DummyGadgetSnapshotFile, DummyTNGFile
+from tests.helpers import DummyGadgetCatalogFile, DummyGadgetSnapshotFile, DummyTNGFile, write_arepo_testdata
 
 flag_test_long = False  # Set to true to run time-taking tests.
 flag_test_big = False  # Set to true to run memory-taking tests.
@@ -71,6 +72,7 @@ def cachedir(monkeypatch, tmp_path_factory):
 def cleancache(cachedir):
     """Always start with empty cache."""
     get_config(reload=True)
+    clear_metadata_cache()
     return cachedir
 
 
@@ -96,3 +98,18 @@ def gadgetcatalogfile_dummy(tmp_path):
     dummy = DummyGadgetCatalogFile()
     dummy.write(tmp_path / "dummy_gadgetcatalogfile.hdf5")
     return dummy
+
+
+@pytest.fixture
+def arepotestdata(request, tmp_path):
+    """
+    Multi-file Arepo snapshot and group catalog with known halo/subhalo tables.
+    Indirect parameters are passed to write_arepo_testdata.
+    """
+    return write_arepo_testdata(tmp_path, **getattr(request, "param", {}))
+
+
+@pytest.fixture
+def arepods(request, arepotestdata):
+    """Snapshot and catalog of arepotestdata loaded together. The indirect parameter sets the units (default: False)."""
+    return load(arepotestdata["snappath"], catalog=arepotestdata["grouppath"], units=getattr(request, "param", False))
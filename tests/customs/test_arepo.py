@@ -1,4 +1,5 @@
 import logging
+import os
 
 import dask.array as da
 import numpy as np
@@ -346,3 +347,544 @@ def test_allunitsdiscovered(testdatapath, caplog):
     load(testdatapath)
     caplog.set_level(logging.DEBUG)
     assert "Cannot determine units from neither unit file nor metadata" not in caplog.text
+
+
+def test_get_hidx_vectorized():
+    from scida.customs.arepo.dataset import get_hidx, get_hidx_vectorized
+
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(0, 5, size=200)
+    lengths[:10] = 0  # leading empty halos
+    celloffsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    ntot = celloffsets[-1] + 20  # trailing unbound cells
+    for start, count in [(0, ntot), (0, 1), (3, 50), (celloffsets[-1] - 2, 10), (celloffsets[-1] + 5, 5)]:
+        ref = get_hidx(start, count, celloffsets)
+        res = get_hidx_vectorized(start, count, celloffsets)
+        assert np.array_equal(ref, res)
+    res = get_hidx_vectorized(celloffsets[-1] - 2, 10, celloffsets, index_unbound=-1)
+    assert np.all(res[2:] == -1)
+
+
+def test_groupquantities_synthetic(arepods, arepotestdata):
+    for i in [0, 1, 4, 5]:
+        glen = arepotestdata["GroupLenType"][:, i]
+        nbound = glen.sum()
+        data = arepods.data["PartType%i" % i]
+        gid = data["GroupID"].compute()
+        assert np.array_equal(gid[:nbound], np.repeat(np.arange(glen.shape[0]), glen))
+        assert np.all(gid[nbound:] == np.iinfo(np.int64).max)
+        gfs = data["GroupFirstSub"].compute()
+        assert np.array_equal(gfs[:nbound], np.repeat(arepotestdata["GroupFirstSub"], glen))
+        assert np.all(gfs[nbound:] == -1)
+
+
+def test_groupquantities_unsigned(arepods, arepotestdata):
+    glen = arepotestdata["GroupLenType"][:, 0]
+    nbound = glen.sum()
+    for dtype, offset in [(np.uint8, 0), (np.uint32, 2**31), (np.uint64, 2**40)]:
+        name = "Unsigned%s" % np.dtype(dtype).name
+        vals = (np.arange(glen.shape[0]) % 200 + offset).astype(dtype)
+        arepods.data["Group"][name] = da.from_array(vals)
+        arepods.add_groupquantity_to_particles(name, parttype="PartType0")
+        res = arepods.data["PartType0"][name]
+        assert res.dtype.kind in "if"
+        res = res.compute()
+        assert res.dtype.kind in "if"
+        assert np.array_equal(res[:nbound], np.repeat(vals, glen))
+        assert np.all(res[nbound:] == -1)
+
+
+def test_catalogindex(arepotestdata, monkeypatch, mocker):
+    from scida.config import get_config
+    from scida.customs.arepo import dataset
+
+    fields = ["GroupID", "SubhaloID", "LocalSubhaloID", "GroupFirstSub"]
+    ds = load(arepotestdata["snappath"], catalog=arepotestdata["grouppath"])
+    ref = {i: [ds.data["PartType%i" % i][k].compute() for k in fields] for i in [0, 1, 4, 5]}
+    shoffsets = {i: ds.get_subhalooffsets("PartType%i" % i) for i in [0, 1, 4, 5]}
+
+    monkeypatch.setenv("SCIDA_PERSIST_CATALOG_INDEX", "1")
+    get_config(reload=True)
+    spy = mocker.spy(dataset, "build_catalogindex")
+    for _ in range(2):  # first load builds and stores the index, second reads it
+        ds = load(arepotestdata["snappath"], catalog=arepotestdata["grouppath"])
+        for i in [0, 1, 4, 5]:
+            for k, arr in zip(fields, ref[i]):
+                assert np.array_equal(ds.data["PartType%i" % i][k].compute(), arr)
+            assert np.array_equal(ds.get_subhalooffsets("PartType%i" % i), shoffsets[i])
+    assert spy.call_count == 1
+
+
+@pytest.mark.parametrize("arepotestdata", [dict(groupfirstsub=False)], ids=["nofirstsub"], indirect=True)
+@pytest.mark.parametrize("persist", [False, True])
+def test_catalogIDs_computed_firstsub(arepotestdata, monkeypatch, persist):
+    from scida.config import get_config
+
+    monkeypatch.setenv("SCIDA_PERSIST_CATALOG_INDEX", str(int(persist)))
+    get_config(reload=True)
+    ds = load(arepotestdata["snappath"], catalog=arepotestdata["grouppath"], units=False)
+    firstsub = arepotestdata["GroupFirstSub"]
+    assert np.any(firstsub == -1)
+    assert np.array_equal(ds.data["Group"]["GroupFirstSub"].compute(), firstsub)
+    assert np.array_equal(ds.data["Group"]["GroupNsubs"].compute(), arepotestdata["GroupNsubs"])
+    glen = arepotestdata["GroupLenType"][:, 0]
+    nbound = glen.sum()
+    assert np.array_equal(ds.data["PartType0"]["GroupFirstSub"][:nbound].compute(), np.repeat(firstsub, glen))
+
+
+def test_catalogindex_key(arepotestdata):
+    from scida.customs.arepo.catalogindex import get_catalogindex_path
+
+    snappath, grouppath = arepotestdata["snappath"], arepotestdata["grouppath"]
+    npart = dict(PartType0=int(arepotestdata["NumPart_Total"][0]))
+    path = get_catalogindex_path(snappath, grouppath, npart)
+    assert get_catalogindex_path(snappath, grouppath, npart) == path
+    # changes to the snapshot files invalidate the index
+    with open(os.path.join(snappath, "snap_099.0.hdf5"), "ab") as f:
+        f.write(b"\0")
+    assert get_catalogindex_path(snappath, grouppath, npart) != path
+
+
+def test_subhalotables(arepotestdata, monkeypatch, mocker):
+    from scida.config import get_config
+    from scida.customs.arepo import dataset
+
+    ds = load(arepotestdata["snappath"], catalog=arepotestdata["grouppath"], units=True)
+    offsets, lengths = ds.get_subhalotables()
+    nsubs = arepotestdata["SubhaloLenType"].shape[0]
+    assert offsets.shape == lengths.shape == (nsubs, 6)
+    assert np.array_equal(lengths, arepotestdata["SubhaloLenType"])
+    for i in [0, 1, 4, 5]:
+        shids = ds.data["PartType%i" % i]["SubhaloID"].compute()
+        shids = getattr(shids, "magnitude", shids)
+        ids, first, counts = np.unique(shids, return_index=True, return_counts=True)
+        bound = ids < nsubs
+        assert np.array_equal(offsets[ids[bound], i], first[bound])
+        assert np.array_equal(lengths[ids[bound], i], counts[bound])
+        assert np.array_equal(ds.get_subhalooffsets("PartType%i" % i), offsets[:, i])
+    assert np.array_equal(ds.data["Subhalo"]["SubhaloOffsetType"].compute(), offsets)
+
+    shid = int(np.argmax(lengths[:, 0]))
+    d = ds.return_data(subhaloID=shid)
+    assert d["PartType0"]["Masses"].shape[0] == lengths[shid, 0]
+    assert np.all(d["PartType0"]["SubhaloID"].compute() == shid)
+
+    monkeypatch.setenv("SCIDA_PERSIST_CATALOG_INDEX", "1")
+    get_config(reload=True)
+    spy = mocker.spy(dataset, "get_subhalooffsettype")
+    for _ in range(2):  # first load computes and stores the tables, second reads them
+        ds = load(arepotestdata["snappath"], catalog=arepotestdata["grouppath"])
+        assert np.array_equal(ds.get_subhalotables()[0], offsets)
+    assert spy.call_count == 1
+
+
+@pytest.mark.parametrize("objtype", ["halo", "subhalo"])
+@pytest.mark.parametrize("arepods", [True], indirect=True)
+def test_selector_multiple(arepods, objtype):
+    from scida.customs.arepo.selector import GroupSelection
+    from scida.misc import coalesce_ranges
+
+    key = "haloID" if objtype == "halo" else "subhaloID"
+    offsets, lengths = arepods.get_grouptables() if objtype == "halo" else arepods.get_subhalotables()
+    ids = np.array([0, 1, 2, 7, 3])
+    sel = arepods.return_data(**{key: ids})
+    assert isinstance(sel, GroupSelection) and len(sel) == ids.shape[0]
+    assert isinstance(arepods.data, type(sel.data))  # original data restored
+    assert sel["PartType0"]["Masses"].shape[0] == lengths[ids, 0].sum()
+    masses = arepods.data["PartType0"]["Masses"].compute()
+    for i, (idx, grp) in enumerate(zip(ids, sel)):
+        single = arepods.return_data(**{key: int(idx)})
+        for p in ["PartType0", "PartType1"]:
+            assert np.array_equal(grp[p]["ParticleIDs"].compute(), single[p]["ParticleIDs"].compute())
+        o, n = offsets[idx, 0], lengths[idx, 0]
+        assert np.allclose(sel[i]["PartType0"]["Masses"].compute(), masses[o : o + n])
+        assert grp["PartType0"]["Masses"].units == masses.units
+    pids = [g["PartType0"]["ParticleIDs"].compute() for g in [sel.get_group(7), sel[3]]]
+    assert np.array_equal(*pids)
+    with pytest.raises(KeyError):
+        sel.get_group(4)
+    with pytest.raises(ValueError):
+        arepods.return_data(**{key: [0, offsets.shape[0]]})
+    with pytest.raises(ValueError):
+        arepods.return_data(haloID=[0, 1], localSubhaloID=0)
+
+    starts, ends = coalesce_ranges([0, 5, 5, 9, 20], [5, 0, 4, 3, 1])
+    assert np.array_equal(starts, [0, 20]) and np.array_equal(ends, [12, 21])
+
+
+@pytest.mark.parametrize("objtype", ["halo", "subhalo"])
+def test_groupedoperations_reductions(arepods, objtype):
+    masses = arepods.data["PartType0"]["Masses"].compute()
+    if objtype == "halo":
+        offsets, lengths = arepods.get_groupoffsets("PartType0"), arepods.get_grouplengths("PartType0")
+    else:
+        offsets, lengths = arepods.get_subhalooffsets("PartType0"), arepods.get_subhalolengths("PartType0")
+    g = arepods.grouped("Masses", objtype=objtype)
+    for op, func in [("sum", np.sum), ("min", np.min), ("max", np.max)]:
+        ref = np.array([func(masses[o : o + n]) if n > 0 else 0 for o, n in zip(offsets, lengths)])
+        res = getattr(g, op)().evaluate()
+        assert res.shape == lengths.shape
+        assert np.allclose(res, ref)
+        # custom functions take the generic per-group path
+        assert np.allclose(g.apply(lambda x, f=func: f(x), final=True).evaluate(), ref)
+
+
+def test_groupedoperations_dtype(arepods):
+    # integers beyond the precision of float64
+    arepods.data["PartType0"]["BigID"] = arepods.data["PartType0"]["ParticleIDs"].astype(np.int64) + 2**60
+    bigids = arepods.data["PartType0"]["BigID"].compute()
+    offsets, lengths = arepods.get_groupoffsets("PartType0"), arepods.get_grouplengths("PartType0")
+    g = arepods.grouped("BigID")
+    for res, func in [
+        (g.max().evaluate(), np.max),
+        (g.apply(lambda x: x[0], final=True).evaluate(), lambda x: x[0]),
+        (g.apply(lambda x: x[0], final=True, jit=True).evaluate(), lambda x: x[0]),
+    ]:
+        ref = np.array([func(bigids[o : o + n]) if n > 0 else 0 for o, n in zip(offsets, lengths)])
+        assert res.dtype == np.int64
+        assert np.array_equal(res, ref)
+    assert arepods.grouped("ParticleIDs").sum().evaluate().dtype.kind in "iu"
+    # explicit dtypes are applied
+    res = g.apply(lambda x: x[0], final=True, output_spec=dict(dtype=np.float32)).evaluate()
+    assert res.dtype == np.float32
+
+
+def test_reduce_segments():
+    from scida.customs.arepo.dataset import reduce_segments
+
+    arr = np.arange(12, dtype=np.int32).reshape(6, 2)
+    offsets, lengths = np.array([0, 1, 1, 4, 6]), np.array([1, 0, 2, 2, 0])  # gap at index 3, empty segments
+    res = reduce_segments(np.add, arr, offsets, lengths, fill_value=-1)
+    assert res.dtype == np.sum(arr).dtype
+    assert np.array_equal(res, [1, -1, 14, 38, -1])
+    assert np.array_equal(reduce_segments(np.maximum, arr, offsets, lengths), [1, 0, 5, 11, 0])
+    assert np.array_equal(reduce_segments(np.minimum, arr, offsets, np.zeros(5, dtype=int), fill_value=3), [3] * 5)
+
+
+def test_groupedoperations_jit(arepods):
+    g = arepods.grouped(["Masses", "ParticleIDs"], objtype="subhalo")
+
+    def weighted_id(mass, ids):
+        return np.sum(mass * ids) / np.sum(mass)
+
+    ref = g.apply(weighted_id, final=True).evaluate()
+    res = g.apply(weighted_id, final=True, jit=True).evaluate()
+    assert np.allclose(ref, res)
+
+    # chained operations with vector output
+    def minmax(mass):
+        return np.array([mass.min(), mass.max()])
+
+    g = arepods.grouped("Masses", objtype="subhalo")
+    ref = g.half().apply(minmax, final=True).evaluate()
+    res = g.half().apply(minmax, final=True, jit=True).evaluate()
+    assert res.shape == ref.shape
+    assert np.allclose(ref, res)
+
+
+def test_groupedoperations_jit_manyinputs(arepods):
+    # more inputs than the compiled loops take
+    g = arepods.grouped(["Masses", "ParticleIDs", "GroupID", "SubhaloID", "LocalSubhaloID"], objtype="subhalo")
+
+    def idsum(mass, ids, gid, sid, lsid):
+        return np.sum(mass * ids) + np.sum(gid) + np.sum(sid) + np.sum(lsid)
+
+    ref = g.apply(idsum, final=True).evaluate()
+    res = g.apply(idsum, final=True, jit=True).evaluate()
+    assert np.allclose(ref, res)
+
+
+def test_groupedoperations_jitchaincache(monkeypatch):
+    from scida.customs.arepo import dataset
+
+    monkeypatch.setattr(dataset, "_jit_chains", dict())
+    monkeypatch.setattr(dataset, "_jit_chains_size", 2)
+    funcs = [np.sum, np.min, np.max]
+    chain = dataset.get_jit_chain((funcs[0],))
+    dataset.get_jit_chain((funcs[1],))
+    assert dataset.get_jit_chain((funcs[0],)) is chain  # reused and now most recently used
+    dataset.get_jit_chain((funcs[2],))
+    assert list(dataset._jit_chains) == [(funcs[0],), (funcs[2],)]
+    assert chain(np.arange(4.0)) == 6.0
+
+
+def test_groupedoperations_batch(arepods):
+    from scida.customs.arepo.dataset import reduce_segments
+
+    g = arepods.grouped(["Masses", "ParticleIDs"], objtype="subhalo")
+
+    def weighted_id(mass, ids):
+        return np.sum(mass * ids) / np.sum(mass) if mass.shape[0] > 0 else 0.0
+
+    def weighted_id_batch(mass, ids, offsets=None, lengths=None):
+        msum = reduce_segments(np.add, mass, offsets, lengths, fill_value=1.0)
+        return reduce_segments(np.add, mass * ids, offsets, lengths) / msum
+
+    ref = g.apply(weighted_id, final=True).evaluate()
+    res = g.apply(weighted_id_batch, batch=True).evaluate()
+    assert np.allclose(ref, res)
+
+    # vector output per group
+    def firstlast_batch(mass, offsets=None, lengths=None):
+        return np.stack([mass[offsets], mass[offsets + lengths - 1]], axis=1)
+
+    res = arepods.grouped("Masses").apply(firstlast_batch, batch=True).evaluate()
+    masses = arepods.data["PartType0"]["Masses"].compute()
+    offsets, lengths = arepods.get_groupoffsets("PartType0"), arepods.get_grouplengths("PartType0")
+    assert res.shape == (lengths.shape[0], 2)
+    assert np.allclose(res[:, 1], masses[offsets + lengths - 1])
+
+    with pytest.raises(ValueError):
+        arepods.grouped("Masses").half().apply(firstlast_batch, batch=True)
+
+
+def test_groupedoperations_batch_validation(arepods):
+    lengths = arepods.get_grouplengths("PartType0")
+
+    def firstlast_batch(mass, offsets=None, lengths=None):
+        return np.stack([mass[offsets], mass[offsets + lengths - 1]], axis=1)
+
+    # results are checked against the output specification, or cast to an explicit dtype
+    spec = dict(shape=(3,), dtype=np.float64)
+    with pytest.raises(ValueError):
+        arepods.grouped("Masses").apply(firstlast_batch, batch=True, output_spec=spec).evaluate()
+
+    def count_batch(mass, offsets=None, lengths=None):
+        return lengths.astype(np.int64 if lengths.shape[0] == 1 else np.int32)  # dtype differs from inference
+
+    with pytest.raises(ValueError):
+        arepods.grouped("Masses").apply(count_batch, batch=True).evaluate()
+    res = arepods.grouped("Masses").apply(count_batch, batch=True, output_spec=dict(dtype=np.int64)).evaluate()
+    assert res.dtype == np.int64 and np.array_equal(res, lengths)
+    res = arepods.grouped("Masses").apply(firstlast_batch, batch=True, output_spec=dict(dtype=np.float32)).evaluate()
+    assert res.dtype == np.float32 and res.shape == (lengths.shape[0], 2)
+
+
+def test_map_group_operation_get_chunkedges():
+    from scida.customs.arepo.dataset import map_group_operation_get_chunkedges
+
+    rng = np.random.default_rng(0)
+    lengths = np.sort((32 * (1 + rng.pareto(1.0, size=10000))).astype(np.int64))[::-1]
+    lengths[0] = 10 * lengths.sum()  # one dominating halo
+    kwargs = dict(cpucost_halo=100.0, chunksize_bytes=2**29)
+    edges = map_group_operation_get_chunkedges(lengths, 12, 8, ntasks=16, **kwargs)
+    # contiguous and complete
+    assert edges[0, 0] == 0 and edges[-1, 1] == lengths.shape[0]
+    assert np.all(edges[1:, 0] == edges[:-1, 1])
+    assert np.all(edges[:, 1] > edges[:, 0])
+    # dominating halo is isolated
+    assert edges[0, 1] == 1
+    # memory limit respected
+    assert np.all(np.add.reduceat(12 * lengths + 8, edges[:, 0]) <= 2**29)
+    # balanced cost for the remaining chunks
+    cost = lengths + 100.0
+    sumcost = np.concatenate([[0.0], np.cumsum(cost)])
+    taskcost = sumcost[edges[1:, 1]] - sumcost[edges[1:, 0]]
+    assert taskcost.max() <= sumcost[-1] / 16
+    # target task count
+    n = map_group_operation_get_chunkedges(lengths[1:], 12, 8, ntasks=64, **kwargs).shape[0]
+    assert 64 <= n <= 66
+    # memory-bound chunking
+    edges = map_group_operation_get_chunkedges(lengths[1:], 12, 8, cpucost_halo=100.0, chunksize_bytes=2**23, ntasks=1)
+    assert edges.shape[0] > 1
+    assert np.all(np.add.reduceat(12 * lengths[1:] + 8, edges[:, 0]) <= 2**23)
+    with pytest.raises(ValueError):
+        map_group_operation_get_chunkedges(lengths, 12, 8, cpucost_halo=1.0, chunksize_bytes=1024)
+
+
+@pytest.mark.filterwarnings("error::UserWarning")
+@pytest.mark.parametrize("arepods", [False, True], indirect=True)
+@pytest.mark.parametrize("objtype", ["halo", "subhalo"])
+def test_groupedoperations_idxlist(arepods, objtype):
+    g = arepods.grouped("Masses", objtype=objtype)
+    ref = g.sum().evaluate()
+    rng = np.random.default_rng(1)
+    idxlist = np.sort(rng.choice(ref.shape[0], size=ref.shape[0] // 3, replace=False))
+    for gap_tolerance in [0, 10, None]:
+        res = g.sum().evaluate(idxlist=idxlist, gap_tolerance=gap_tolerance, compute=False)
+        if gap_tolerance is None:
+            assert len(res.chunks[0]) < idxlist.shape[0]  # selected halos are batched
+        assert np.allclose(res.compute(), ref[idxlist])
+        res = g.apply(lambda x: np.sum(x), final=True).evaluate(idxlist=idxlist, gap_tolerance=gap_tolerance)
+        assert np.allclose(res, ref[idxlist])
+
+
+@pytest.mark.parametrize("arepods", [True], indirect=True)
+def test_groupedoperations_signaturecache(arepods, mocker):
+    from scida.customs.arepo import dataset
+
+    dataset.clear_signature_cache()
+    g = arepods.grouped("Masses")
+
+    def meanmass(mass):
+        return np.mean(mass)
+
+    spy = mocker.spy(dataset, "infer_signature")
+    res1 = g.apply(meanmass, final=True).evaluate(compute=False)
+    res2 = g.apply(meanmass, final=True).evaluate(compute=False)
+    assert spy.call_count == 1
+    assert res1.units == res2.units == arepods.data["PartType0"]["Masses"].units
+    assert np.allclose(res1.compute(), res2.compute())
+
+    # explicit output specification skips inference
+    def minmax(mass):
+        return np.array([mass.min(), mass.max()])
+
+    spec = dict(shape=(2,), units=res1.units, dtype=np.float32, fill_value=-1)
+    res = arepods.grouped("Masses", objtype="subhalo").apply(minmax, final=True, output_spec=spec).evaluate()
+    assert spy.call_count == 1
+    assert res.shape[1] == 2 and res.dtype == np.float32 and res.units == res1.units
+    with pytest.raises(ValueError):
+        g.apply(minmax, final=True, output_spec=dict(size=2)).evaluate()
+
+
+@pytest.mark.parametrize("arepods", [False, True], indirect=True)
+def test_groupedoperations_aggregate(arepods, arepotestdata):
+    g = arepods.grouped(["Masses", "ParticleIDs", "Coordinates"], objtype="subhalo")
+
+    def com(Masses, Coordinates):
+        return np.sum(Masses[:, None] * Coordinates, axis=0) / np.sum(Masses)
+
+    def maxid(ids):
+        return np.max(ids)
+
+    aggs = dict(mass=("Masses", "sum"), com=com, maxid=("ParticleIDs", maxid), mmin=("Masses", "min"))
+    res = g.aggregate(aggs, compute=False)
+    # all outputs are computed by the same tasks
+    deps = [getattr(res[k], "magnitude", res[k]).dask.dependencies for k in aggs]
+    assert len({frozenset().union(*d.values()) - set(d) for d in deps}) == 1
+    res = g.aggregate(aggs)
+    assert set(res) == set(aggs)
+    for k in ["mass", "mmin"]:
+        ref = getattr(arepods.grouped("Masses", objtype="subhalo"), k[1:] if k == "mmin" else "sum")().evaluate()
+        assert np.allclose(res[k], ref)
+    ds_nou = load(arepotestdata["snappath"], catalog=arepotestdata["grouppath"], units=False)
+    masses = ds_nou.data["PartType0"]["Masses"].compute()
+    coords = ds_nou.data["PartType0"]["Coordinates"].compute()
+    offsets, lengths = arepods.get_subhalooffsets("PartType0"), arepods.get_subhalolengths("PartType0")
+    ref = [com(masses[o : o + n], coords[o : o + n]) if n > 0 else np.zeros(3) for o, n in zip(offsets, lengths)]
+    assert res["com"].shape == (len(ref), 3)
+    assert np.allclose(getattr(res["com"], "magnitude", res["com"]), ref)
+    if arepods.withunits:
+        assert res["com"].units == arepods.data["PartType0"]["Coordinates"].units
+    assert np.allclose(res["maxid"], arepods.grouped("ParticleIDs", objtype="subhalo").max().evaluate())
+
+    # selection of groups and preceding operations
+    idxlist = np.arange(0, res["mass"].shape[0], 3)
+    sel = g.aggregate(dict(mass=("Masses", "sum")), idxlist=idxlist)
+    assert np.allclose(sel["mass"], res["mass"][idxlist])
+    half = arepods.grouped("Masses").half()
+    sel = half.aggregate(dict(total="sum", maximum="max"), nmax=5)
+    assert np.allclose(sel["total"], half.sum().evaluate(nmax=5))
+    with pytest.raises(ValueError):
+        g.aggregate(dict(mass="sum"))  # ambiguous input field
+
+
+@pytest.mark.parametrize("arepods", [False, True], indirect=True)
+def test_group_aligned_view(arepods):
+    view = arepods.get_group_aligned_view("PartType0", objtype="subhalo")
+    assert arepods.get_group_aligned_view("PartType0", objtype="subhalo") is view
+    assert arepods.get_group_aligned_view("PartType0", objtype="halo") is not view
+
+    g = arepods.grouped(["Masses", "Coordinates"], objtype="subhalo")
+    assert g.view is view
+    masses = arepods.data["PartType0"]["Masses"]
+    assert masses not in view
+    ref = arepods.grouped("Masses", objtype="subhalo", aligned=False).sum().evaluate()
+    res = g.aggregate(dict(mass=("Masses", "sum"), com=("Coordinates", lambda x: np.mean(x, axis=0))))
+    assert masses in view
+    assert np.allclose(res["mass"], ref)
+    # aligned arrays are reused by subsequent operations
+    assert view.align(masses).name == view.align(masses).name
+    assert np.allclose(arepods.grouped("Masses", objtype="subhalo").sum().evaluate(), ref)
+
+    view.materialize([masses, arepods.data["PartType0"]["Coordinates"]])
+    assert os.path.isdir(view.store)
+    assert view.align(masses).chunks[0] == view.chunks
+    res2 = g.aggregate(dict(mass=("Masses", "sum"), com=("Coordinates", lambda x: np.mean(x, axis=0))))
+    for k in res:
+        assert np.allclose(res2[k], res[k])
+    if arepods.withunits:
+        assert res2["mass"].units == masses.units
+    view.persist([masses])
+    assert np.allclose(arepods.grouped("Masses", objtype="subhalo").sum().evaluate(), ref)
+
+
+@pytest.mark.parametrize("objtype", ["halo", "subhalo"])
+def test_export_groups(arepotestdata, objtype, mocker):
+    from scida.config import get_config
+    from scida.customs.arepo import dataset, selector
+
+    ds = load(arepotestdata["snappath"], catalog=arepotestdata["grouppath"], units=True)
+    key = "haloID" if objtype == "halo" else "subhaloID"
+    spy = mocker.spy(dataset, "get_groupexport_fingerprint")
+    ids = np.array([3, 0, 7])
+    ref = {int(idx): ds.return_data(**{key: int(idx)}) for idx in ids}
+    assert ds.get_group_export(objtype) is None
+    # without exports, selections neither check the files nor create directories
+    assert spy.call_count == 0
+    assert not os.path.exists(os.path.join(get_config()["cache_path"], "groupexports"))
+    export = ds.export_groups(ids, objtype=objtype)
+    assert np.array_equal(export.ids, np.sort(ids))
+    assert os.path.isfile(export.indexpath)
+    assert all(os.path.isfile(export.get_filename(idx)) for idx in ids)
+    assert "Masses" in export.fields["PartType0"]
+
+    spy = mocker.spy(selector, "_get_exported_field")
+    for _ in range(2):  # first from this instance, then picked up from the cache directory
+        for idx in ids:
+            d = ds.return_data(**{key: int(idx)})
+            for k in ["Masses", "Coordinates", "ParticleIDs"]:
+                arr, arr_ref = d["PartType0"][k].compute(), ref[int(idx)]["PartType0"][k].compute()
+                assert str(getattr(arr, "units", "")) == str(getattr(arr_ref, "units", ""))
+                assert np.array_equal(getattr(arr, "magnitude", arr), getattr(arr_ref, "magnitude", arr_ref))
+        sel = ds.return_data(**{key: ids})
+        for i, idx in enumerate(ids):
+            pids = sel[i]["PartType1"]["ParticleIDs"].compute()
+            assert np.array_equal(pids, ref[int(idx)]["PartType1"]["ParticleIDs"].compute())
+        ds = load(arepotestdata["snappath"], catalog=arepotestdata["grouppath"], units=True)
+    assert spy.call_count > 0
+
+    # objects not exported are read from the snapshot
+    spy.reset_mock()
+    ds.return_data(**{key: [0, 1]})
+    assert spy.call_count == 0
+    # exports of modified snapshots are ignored
+    fn = arepotestdata["snappath"] + "/snap_099.0.hdf5"
+    os.utime(fn, (0, 0))
+    ds._groupexports.clear()
+    assert ds.get_group_export(objtype) is None
+
+
+@pytest.mark.parametrize("objtype", ["halo", "subhalo"])
+def test_export_groups_all(arepods, arepotestdata, objtype):
+    # all objects need to be requested explicitly
+    with pytest.raises(TypeError):
+        arepods.export_groups(objtype=objtype)
+    with pytest.raises(ValueError):
+        arepods.export_groups("any", objtype=objtype)
+    export = arepods.export_groups("all", objtype=objtype, fields=["Masses"])
+    nobj = arepotestdata["GroupLenType" if objtype == "halo" else "SubhaloLenType"].shape[0]
+    assert np.array_equal(export.ids, np.arange(nobj))
+
+
+def test_group_aligned_view_memory(arepods):
+    import dask
+
+    def profile(Masses):
+        return np.histogram(Masses, bins=1000)[0]
+
+    spec = dict(shape=(1000,), dtype=np.int64)
+    with dask.config.set({"array.chunk-size": "2KiB"}):
+        chunksize_bytes = 16 * 2048
+        view = arepods.get_group_aligned_view("PartType0", objtype="subhalo")
+        assert not view.fits(8, 8 * 1000)
+        # operations within the view's memory limit reuse its plan
+        res = arepods.grouped("Masses", objtype="subhalo").sum().evaluate(compute=False)
+        assert res.chunks[0] == tuple(np.diff(view.chunkedges, axis=1).ravel())
+        # operations with larger outputs get their own chunks within the memory limit
+        res = arepods.grouped("Masses", objtype="subhalo").apply(profile, final=True, output_spec=spec)
+        res = res.evaluate(compute=False)
+        assert max(res.chunks[0]) * 8 * 1000 < chunksize_bytes
+        ref = arepods.grouped("Masses", objtype="subhalo", aligned=False).apply(profile, final=True, output_spec=spec)
+        assert np.array_equal(res.compute(), ref.evaluate())
@@ -1,3 +1,5 @@
+import os
+
 import h5py
 import numpy as np
 
@@ -176,3 +178,119 @@ def write_gadget_testfile(path):
     # create a dummy Gadget snapshot
     dummy = DummyGadgetSnapshotFile()
     dummy.write(path)
+
+
+def write_arepo_testdata(path, ngroups=50, nfiles=4, seed=42, groupfirstsub=True):
+    """
+    Write a consistent multi-file Arepo snapshot and group catalog with particles ordered by
+    halo and subhalo membership. Returns the snapshot and catalog directory as well as the
+    group/subhalo tables used for their construction. Without groupfirstsub, the catalog
+    lacks "GroupFirstSub" and "GroupNsubs".
+    """
+    rng = np.random.default_rng(seed)
+    glen = rng.integers(0, 40, size=(ngroups, 6))
+    glen[:, 2:4] = 0  # no lowres dm and tracers
+    glen = glen[np.argsort(-glen.sum(axis=1), kind="stable")]
+    shgrnr, shlen = [], []
+    gfirstsub = -np.ones(ngroups, dtype=np.int64)
+    gnsubs = np.zeros(ngroups, dtype=np.int64)
+    for g in range(ngroups):
+        nsubs = rng.integers(0, 4)
+        remaining = glen[g].copy()
+        if nsubs > 0:
+            gfirstsub[g] = len(shgrnr)
+        gnsubs[g] = nsubs
+        for _ in range(nsubs):
+            n = (remaining * rng.uniform(0.3, 0.8)).astype(np.int64)
+            remaining -= n
+            shgrnr.append(g)
+            shlen.append(n)
+    shgrnr = np.array(shgrnr, dtype=np.int64)
+    shlen = np.array(shlen, dtype=np.int64).reshape(-1, 6)
+    npart = glen.sum(axis=0) + rng.integers(5, 30, size=6)  # plus unbound particles
+    npart[2:4] = 0
+    nsubs_tot = shgrnr.shape[0]
+
+    snapdir = os.path.join(path, "snapdir_099")
+    grpdir = os.path.join(path, "groups_099")
+    os.makedirs(snapdir, exist_ok=True)
+    os.makedirs(grpdir, exist_ok=True)
+
+    def write_header(hf, extra):
+        header = hf.create_group("Header")
+        attrs = dict(
+            Time=1.0,
+            Redshift=0.0,
+            BoxSize=100.0,
+            Omega0=0.3,
+            OmegaLambda=0.7,
+            HubbleParam=0.7,
+            Git_commit=b"0000000",
+            NumFilesPerSnapshot=nfiles,
+        )
+        attrs.update(**extra)
+        for k, v in attrs.items():
+            header.attrs[k] = v
+        hf.create_group("Parameters")
+        hf.create_group("Config")
+
+    def split(n):
+        return np.concatenate([[0], np.sort(rng.integers(0, n + 1, size=nfiles - 1)), [n]])
+
+    coords = {i: rng.uniform(0.0, 100.0, size=(npart[i], 3)) for i in range(6)}
+    edges = {i: split(npart[i]) for i in range(6)}
+    for f in range(nfiles):
+        with h5py.File(os.path.join(snapdir, "snap_099.%i.hdf5" % f), "w") as hf:
+            nthisfile = np.zeros(6, dtype=np.int64)
+            for i in range(6):
+                if npart[i] == 0:
+                    continue
+                slc = slice(edges[i][f], edges[i][f + 1])
+                nthisfile[i] = slc.stop - slc.start
+                grp = hf.create_group("PartType%i" % i)
+                grp["Coordinates"] = coords[i][slc]
+                grp["ParticleIDs"] = np.arange(npart[i])[slc]
+                grp["Masses"] = np.ones(npart[i])[slc]
+            extra = dict(
+                NumPart_ThisFile=nthisfile,
+                NumPart_Total=npart,
+                NumPart_Total_HighWord=np.zeros(6, dtype=np.int64),
+                MassTable=np.zeros(6),
+            )
+            write_header(hf, extra)
+
+    gedges, sedges = split(ngroups), split(nsubs_tot)
+    for f in range(nfiles):
+        with h5py.File(os.path.join(grpdir, "fof_subhalo_tab_099.%i.hdf5" % f), "w") as hf:
+            gslc = slice(gedges[f], gedges[f + 1])
+            grp = hf.create_group("Group")
+            grp["GroupLenType"] = glen[gslc]
+            grp["GroupLen"] = glen[gslc].sum(axis=1)
+            grp["GroupMass"] = glen[gslc].sum(axis=1).astype(float)
+            grp["GroupPos"] = rng.uniform(0.0, 100.0, size=(gslc.stop - gslc.start, 3))
+            if groupfirstsub:
+                grp["GroupFirstSub"] = gfirstsub[gslc]
+                grp["GroupNsubs"] = gnsubs[gslc]
+            sslc = slice(sedges[f], sedges[f + 1])
+            sh = hf.create_group("Subhalo")
+            sh["SubhaloLenType"] = shlen[sslc]
+            sh["SubhaloLen"] = shlen[sslc].sum(axis=1)
+            sh["SubhaloGrNr"] = shgrnr[sslc]
+            sh["SubhaloPos"] = rng.uniform(0.0, 100.0, size=(sslc.stop - sslc.start, 3))
+            extra = dict(
+                Ngroups_ThisFile=gslc.stop - gslc.start,
+                Ngroups_Total=ngroups,
+                Nsubgroups_ThisFile=sslc.stop - sslc.start,
+                Nsubgroups_Total=nsubs_tot,
+            )
+            write_header(hf, extra)
+    return dict(
+        snappath=snapdir,
+        grouppath=grpdir,
+        GroupLenType=glen,
+        SubhaloLenType=shlen,
+        SubhaloGrNr=shgrnr,
+        GroupFirstSub=gfirstsub,
+        GroupNsubs=gnsubs,
+        NumPart_Total=npart,
+    )
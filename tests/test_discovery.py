@@ -2,6 +2,7 @@ import pathlib
 from typing import Type
 
 from scida import ArepoSnapshot, MTNGArepoSnapshot, TNGClusterSnapshot
+from scida.config import get_config
 from scida.customs.arepo.dataset import ArepoCatalog
 from scida.customs.arepo.MTNG.dataset import MTNGArepoCatalog
 from scida.customs.arepo.series import ArepoSimulation
@@ -190,3 +191,68 @@ def test_simconf_detection(testdatapath):
     else:
         pass  # no special type here.
     # print(testdatapath, tp)
+
+
+def test_determine_type_pruning_and_memo(arepotestdata, mocker, monkeypatch):
+    monkeypatch.setenv("SCIDA_PERSIST_DISCOVERY_CACHE", "true")
+    get_config(reload=True)
+    snappath, grouppath = arepotestdata["snappath"], arepotestdata["grouppath"]
+    spy_swift = mocker.spy(SwiftSimulation, "validate_path")
+    spy_rockstar = mocker.spy(RockstarCatalog, "validate_path")
+    spy_arepo = mocker.spy(ArepoSnapshot, "validate_path")
+
+    names, classes = _determine_type(snappath)
+    assert classes == [ArepoSnapshot]
+    assert _determine_type(grouppath)[1] == [ArepoCatalog]
+    # pruned by the fingerprint
+    assert spy_swift.call_count == 0
+    assert spy_rockstar.call_count == 0
+    ncalls = spy_arepo.call_count
+    assert ncalls > 0
+
+    # memoized on disk
+    assert _determine_type(snappath)[1] == [ArepoSnapshot]
+    assert spy_arepo.call_count == ncalls
+
+    # changes to the path invalidate the memo
+    (pathlib.Path(snappath) / "snap_099.0.hdf5").touch()
+    assert _determine_type(snappath)[1] == [ArepoSnapshot]
+    assert spy_arepo.call_count > ncalls
+
+
+def test_determine_type_memo_subdirectories(arepotestdata, mocker, monkeypatch):
+    monkeypatch.setenv("SCIDA_PERSIST_DISCOVERY_CACHE", "true")
+    get_config(reload=True)
+    snappath = arepotestdata["snappath"]
+    spy_arepo = mocker.spy(ArepoSnapshot, "validate_path")
+    # changes to files within subdirectories invalidate the memo
+    subdir = pathlib.Path(snappath) / "extra"
+    subdir.mkdir()
+    (subdir / "notes.txt").write_text("x")
+    assert _determine_type(snappath)[1] == [ArepoSnapshot]
+    ncalls = spy_arepo.call_count
+    assert _determine_type(snappath)[1] == [ArepoSnapshot]
+    assert spy_arepo.call_count == ncalls
+    with open(subdir / "notes.txt", "a") as f:
+        f.write("y")
+    assert _determine_type(snappath)[1] == [ArepoSnapshot]
+    assert spy_arepo.call_count > ncalls
+
+
+def test_determine_type_memo_skipped_on_exception(arepotestdata, mocker, monkeypatch):
+    snappath = arepotestdata["snappath"]
+    spy_arepo = mocker.spy(ArepoSnapshot, "validate_path")
+    # not remembered by default
+    _determine_type(snappath)
+    ncalls = spy_arepo.call_count
+    _determine_type(snappath)
+    assert spy_arepo.call_count == 2 * ncalls
+
+    monkeypatch.setenv("SCIDA_PERSIST_DISCOVERY_CACHE", "true")
+    get_config(reload=True)
+    # results depending on a swallowed exception are not remembered
+    mocker.patch.object(ArepoCatalog, "validate_path", side_effect=OSError("transient"))
+    assert _determine_type(snappath)[1] == [ArepoSnapshot]
+    ncalls = spy_arepo.call_count
+    assert _determine_type(snappath)[1] == [ArepoSnapshot]
+    assert spy_arepo.call_count > ncalls
@@ -0,0 +1,49 @@
+import pickle
+
+import h5py
+import numpy as np
+
+from scida.config import get_config
+from scida.io import FileHandlePool, HDF5DatasetReference, get_filehandle_pool, load
+
+
+def test_filehandlepool(tmp_path):
+    paths = []
+    for i in range(3):
+        p = str(tmp_path / ("f%i.hdf5" % i))
+        with h5py.File(p, "w") as hf:
+            hf["data"] = np.arange(10) + i
+        paths.append(p)
+    pool = FileHandlePool(maxsize=2)
+    hf0 = pool.get(paths[0])
+    assert pool.get(paths[0]) is hf0  # reused
+    pool.get(paths[1])
+    pool.get(paths[2])
+    assert len(pool) == 2
+    assert paths[0] not in pool  # least recently used evicted
+    assert hf0["data"][0] == 0  # evicted handles stay usable while referenced
+    pool.clear(close=True)
+    assert len(pool) == 0
+
+
+def test_hdf5datasetreference(tmp_path):
+    p = str(tmp_path / "f.hdf5")
+    with h5py.File(p, "w") as hf:
+        hf["group/data"] = np.arange(20).reshape(10, 2)
+        ref = HDF5DatasetReference.from_dataset(hf["group/data"])
+    ref = pickle.loads(pickle.dumps(ref))
+    assert ref.shape == (10, 2) and ref.ndim == 2 and ref.dtype == np.int64
+    assert np.array_equal(ref[2:4], np.array([[4, 5], [6, 7]]))
+    assert p in get_filehandle_pool()
+
+
+def test_load_filehandlepool(arepotestdata, monkeypatch):
+    monkeypatch.setenv("SCIDA_FILEHANDLE_POOL", "true")
+    get_config(reload=True)
+    fcc, metadata, hf, tmpfile = load(arepotestdata["snappath"])
+    arr = fcc["PartType0"]["Masses"]
+    ref = hf["PartType0/Masses"][:]
+    hf.close()  # reads go through the pool, not the loader's handle
+    arr = pickle.loads(pickle.dumps(arr))
+    assert np.array_equal(arr.compute(scheduler="processes"), ref)
+    assert np.array_equal(arr.compute(scheduler="threads"), ref)
@@ -0,0 +1,135 @@
+import os
+
+import h5py
+import numpy as np
+
+from scida.config import get_config
+from scida.helpers_hdf5 import (
+    clear_metadata_cache,
+    create_mergedhdf5file,
+    get_zonemaps,
+    update_mergedhdf5file,
+    walk_hdf5file,
+)
+from scida.io import load_metadata
+from scida.io._base import _get_chunkedfiles
+
+
+def _rewrite_chunk(fn, ngas):
+    """Replace the gas of a chunk file by 'ngas' particles."""
+    with h5py.File(fn, "r+") as hf:
+        for k in list(hf["PartType0"].keys()):
+            shape = hf["PartType0"][k].shape
+            dtype = hf["PartType0"][k].dtype
+            del hf["PartType0"][k]
+            hf["PartType0"][k] = np.full((ngas, *shape[1:]), 7, dtype=dtype)
+        nthisfile = hf["Header"].attrs["NumPart_ThisFile"]
+        nthisfile[0] = ngas
+        hf["Header"].attrs["NumPart_ThisFile"] = nthisfile
+
+
+def test_create_mergedhdf5file(arepotestdata, tmp_path):
+    files = _get_chunkedfiles(arepotestdata["snappath"], fileprefix="snap")
+    fn = str(tmp_path / "merged.hdf5")
+    for virtual in [True, False]:
+        create_mergedhdf5file(fn, files, virtual=virtual, max_workers=1)
+        with h5py.File(fn, "r") as hf:
+            coords = np.concatenate([h5py.File(f, "r")["PartType0/Coordinates"][:] for f in files])
+            assert hf["PartType0/Coordinates"].is_virtual == virtual
+            assert np.array_equal(hf["PartType0/Coordinates"][:], coords)
+            chunks = hf["_chunks"].attrs["/PartType0/Masses"]
+            assert chunks.shape == (len(files), 2)
+            assert np.sum(chunks[:, 1]) == coords.shape[0]
+            # attributes that differ across files are stacked
+            assert hf["Header"].attrs["NumPart_ThisFile"].shape == (len(files), 6)
+            assert hf["Header"].attrs["BoxSize"] == 100.0
+
+
+def test_update_mergedhdf5file(arepotestdata, tmp_path):
+    files = _get_chunkedfiles(arepotestdata["snappath"], fileprefix="snap")
+    fn = str(tmp_path / "merged.hdf5")
+    create_mergedhdf5file(fn, files, max_workers=1)
+    assert update_mergedhdf5file(fn, files)  # nothing changed
+
+    _rewrite_chunk(files[1], 5)
+    assert update_mergedhdf5file(fn, files)
+    with h5py.File(fn, "r") as hf:
+        ref = [h5py.File(f, "r")["PartType0/Masses"][:] for f in files]
+        assert np.array_equal(hf["PartType0/Masses"][:], np.concatenate(ref))
+        assert hf["Header"].attrs["NumPart_ThisFile"][1, 0] == 5
+        assert hf["_chunks"].attrs["/PartType0/Masses"][1, 1] == 5
+        # unaffected datasets keep their layouts
+        assert hf["PartType1/Masses"].shape[0] == np.sum([len(h5py.File(f, "r")["PartType1/Masses"]) for f in files])
+
+    # removing a chunk file requires a full rebuild
+    os.remove(files[-1])
+    assert not update_mergedhdf5file(fn, files[:-1])
+
+
+def test_load_changed_chunk_cache_open(arepotestdata):
+    from scida import load
+
+    files = _get_chunkedfiles(arepotestdata["snappath"], fileprefix="snap")
+    ds = load(arepotestdata["snappath"], catalog="none", units=False)
+    _rewrite_chunk(files[1], 5)
+    # the first dataset still holds the cache file, which thus cannot be updated in place
+    ds2 = load(arepotestdata["snappath"], catalog="none", units=False)
+    ref = np.concatenate([h5py.File(f, "r")["PartType0/Masses"][:] for f in files])
+    assert np.array_equal(ds2.data["PartType0"]["Masses"].compute(), ref)
+    assert ds.file.id.valid and ds.file.filename == ds2.file.filename
+
+
+def test_create_mergedhdf5file_parallelcopy(arepotestdata, tmp_path):
+    files = _get_chunkedfiles(arepotestdata["snappath"], fileprefix="snap")
+    fn = str(tmp_path / "merged.hdf5")
+    # in-flight limit below the block size: readers are throttled to one block at a time
+    create_mergedhdf5file(fn, files, virtual=False, max_workers=2, max_inflight=256)
+    with h5py.File(fn, "r") as hf:
+        for field in ["PartType0/Coordinates", "PartType1/ParticleIDs"]:
+            ref = np.concatenate([h5py.File(f, "r")[field][:] for f in files])
+            assert not hf[field].is_virtual
+            assert np.array_equal(hf[field][:], ref)
+
+
+def test_create_mergedhdf5file_zonemaps(arepotestdata, tmp_path):
+    files = _get_chunkedfiles(arepotestdata["snappath"], fileprefix="snap")
+    fn = str(tmp_path / "merged.hdf5")
+    create_mergedhdf5file(fn, files, max_workers=2, zonemaps="all")
+    with h5py.File(fn, "r") as hf:
+        zonemaps = get_zonemaps(hf)
+        assert "/PartType0/Coordinates" in zonemaps and "/PartType1/ParticleIDs" in zonemaps
+        for field, zones in zonemaps.items():
+            arr = hf[field][:]
+            assert zones["end"][-1] == arr.shape[0]
+            for start, end, lo, hi in zip(zones["start"], zones["end"], zones["min"], zones["max"]):
+                assert np.array_equal(lo, arr[start:end].min(axis=0))
+                assert np.array_equal(hi, arr[start:end].max(axis=0))
+    create_mergedhdf5file(fn, files, max_workers=1)
+    with h5py.File(fn, "r") as hf:
+        assert get_zonemaps(hf) == dict()
+
+
+def test_walk_hdf5file_cache(arepotestdata, mocker, monkeypatch):
+    fn = _get_chunkedfiles(arepotestdata["snappath"], fileprefix="snap")[0]
+    spy = mocker.spy(h5py, "File")
+    tree = load_metadata(fn)
+    tree["/Header"]["BoxSize"] = -1.0  # returned trees are copies
+    assert load_metadata(fn)["/Header"]["BoxSize"] == 100.0
+    assert spy.call_count == 1
+
+    # file changes invalidate the cache
+    with h5py.File(fn, "r+") as hf:
+        hf["Header"].attrs["BoxSize"] = 50.0
+    spy.reset_mock()
+    assert walk_hdf5file(fn, {})["attrs"]["/Header"]["BoxSize"] == 50.0
+    assert spy.call_count == 1
+
+    # persisted to disk if requested
+    monkeypatch.setenv("SCIDA_PERSIST_METADATA_CACHE", "true")
+    get_config(reload=True)
+    clear_metadata_cache()
+    walk_hdf5file(fn, {})
+    clear_metadata_cache()
+    spy.reset_mock()
+    assert walk_hdf5file(fn, {})["attrs"]["/Header"]["BoxSize"] == 50.0
+    assert spy.call_count == 0
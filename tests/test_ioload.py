@@ -1,6 +1,10 @@
 import pathlib
 
-from scida.io import load
+import h5py
+import numpy as np
+
+from scida.helpers_hdf5 import get_filealigned_chunks, walk_hdf5file
+from scida.io import _base, load, load_datadict_old
 
 from .helpers import write_gadget_testfile, write_hdf5flat_testfile
 
@@ -27,3 +31,97 @@ def test_ioload_gadget(tmp_path):
 
     assert "BoxSize" in metadata["/Header"]
     assert "PartType0" in fcc
+
+
+def test_ioload_chunked_update(arepotestdata, mocker):
+    # cache file is updated in place when chunk files change
+    p = arepotestdata["snappath"]
+    fn = sorted(pathlib.Path(p).glob("*.hdf5"))[0]
+    spy = mocker.spy(_base, "create_mergedhdf5file")
+
+    # copied datasets are refreshed as long as shapes stay the same
+    fcc, metadata, hf, tmpfile = load(p)
+    hf.close()
+    with h5py.File(fn, "r+") as f:
+        f["PartType0/Masses"][0] = -1.0
+    fcc, metadata, hf, tmpfile = load(p)
+    assert fcc["PartType0"]["Masses"][0].compute() == -1.0
+    assert spy.call_count == 1
+    hf.close()
+
+    # virtual datasets also allow for changing shapes
+    fcc, metadata, hf, tmpfile = load(p, virtualcache=True, overwrite_cache=True)
+    ngas = fcc["PartType0"]["Masses"].shape[0]
+    hf.close()
+    with h5py.File(fn, "r+") as f:
+        n = f["PartType0/Masses"].shape[0]
+        for k in list(f["PartType0"].keys()):
+            arr = f["PartType0"][k][:]
+            del f["PartType0"][k]
+            f["PartType0"][k] = arr[: n // 2]
+    fcc, metadata, hf, tmpfile = load(p, virtualcache=True)
+    assert fcc["PartType0"]["Masses"].shape[0] == ngas - (n - n // 2)
+    assert spy.call_count == 2
+    hf.close()
+
+
+def test_load_datadict(tmp_path, mocker):
+    # fields are registered from the walked tree without walking the file again
+    p = pathlib.Path(tmp_path) / "test.hdf5"
+    with h5py.File(p, "w") as hf:
+        hf.create_group("Header").attrs["a"] = 1
+        hf["PartType0/Coordinates"] = np.zeros((4, 3))
+        hf["PartType0/Masses"] = np.ones(4)
+        hf["PartType0/Nested/Field"] = np.ones(4)
+        hf["PartType1/Masses"] = np.ones(2)
+        hf["PartType1/Names"] = np.array(["a", "b"], dtype=h5py.string_dtype())
+        hf["Scalar"] = 1.0
+    tree = walk_hdf5file(str(p), {})
+    spy = mocker.spy(_base, "walk_hdf5file")
+    with h5py.File(p, "r") as hf:
+        fcc, metadata = load_datadict_old(str(p), hf, chunksize="auto", tree=tree)
+        assert spy.call_count == 0
+        assert set(fcc.keys()) == {"PartType0", "PartType1"}
+        assert fcc["PartType0"].keys(withgroups=False) == ["Coordinates", "Masses"]
+        assert fcc["PartType0"]["Nested"]["Field"].shape == (4,)
+        assert "Names" not in fcc["PartType1"]  # vlen strings are skipped
+        assert fcc["PartType1"]["uid"].shape == (2,)
+        assert metadata["/Header"]["a"] == 1
+
+        fcc, _ = load_datadict_old(str(p), hf, chunksize="auto", tree=tree, groups_load=["/PartType1"])
+        assert list(fcc.keys()) == ["PartType1"]
+
+
+def test_ioload_chunked_directread(arepotestdata):
+    # dask blocks map onto the ranges of the individual chunk files
+    p = arepotestdata["snappath"]
+    files = sorted(pathlib.Path(p).glob("*.hdf5"))
+    for virtualcache in [True, False]:
+        fcc, metadata, hf, tmpfile = load(p, virtualcache=virtualcache, overwrite_cache=True, directread=True)
+        arr = fcc["PartType0"]["Coordinates"]
+        lengths = [h5py.File(f, "r")["PartType0/Coordinates"].shape[0] for f in files]
+        assert arr.chunks[0] == tuple(n for n in lengths if n > 0)
+        assert np.array_equal(arr.compute(), hf["PartType0/Coordinates"][:])
+        hf.close()
+
+
+def test_ioload_chunked_filechunks(arepotestdata):
+    p = arepotestdata["snappath"]
+    files = sorted(pathlib.Path(p).glob("*.hdf5"))
+    lengths = [h5py.File(f, "r")["PartType0/Masses"].shape[0] for f in files]
+    for directread in [False, True]:
+        fcc, metadata, hf, tmpfile = load(p, chunksize="files", directread=directread)
+        arr = fcc["PartType0"]["Masses"]
+        if directread:
+            assert arr.chunks[0] == tuple(n for n in lengths if n > 0)
+        else:
+            # small files are coalesced into a single chunk
+            assert arr.chunks[0] == (sum(lengths),)
+        assert np.array_equal(arr.compute(), hf["PartType0/Masses"][:])
+        hf.close()
+
+
+def test_get_filealigned_chunks():
+    assert get_filealigned_chunks([10, 10, 10, 100, 5, 0, 5], 1, target=25) == (20, 10, 25, 25, 25, 25, 10)
+    assert get_filealigned_chunks([10, 10], 8, target="1KiB") == (20,)
+    assert get_filealigned_chunks([], 8, target=25) == (0,)
@@ -1,3 +1,14 @@
+import os
+
+import dask.array as da
+import h5py
+import numpy as np
+import pytest
+
+from scida import load
+from scida.config import get_config
+from scida.misc import box_overlaps_bounds, rectangular_cutout_mask
+from scida.spatialindex import BlockTree, BoxBinning, GridIndex, periodic_distance
 from tests.testdata_properties import require_testdata
 
 
@@ -13,3 +24,238 @@ def test_coordsalias(testdata_areposnapshot_withcatalog):
             continue
         coords = obj.get_coords(parttype=ptype)
         assert coords is not None
+
+
+def test_gridindex():
+    rng = np.random.default_rng(42)
+    coords = rng.uniform(0.0, 100.0, size=(10000, 3))
+    coords = coords[np.argsort(coords[:, 0])]  # blocks are spatially compact along x
+    index = GridIndex.build(da.from_array(coords, chunks=(3000, 3)), boxsize=100.0, ngrid=8, blocksize=500)
+    assert index.nblocks == 20
+    assert np.array_equal(index.blockedges, np.arange(0, 10001, 500))
+
+    for center, width in [([50.0, 50.0, 50.0], [10.0, 20.0, 30.0]), ([1.0, 99.0, 50.0], [10.0, 10.0, 10.0])]:
+        mask = rectangular_cutout_mask(center, width, coords, boxsize=100.0, backend="numpy")
+        starts, ends = index.get_ranges(index.query_box(center, width))
+        assert np.sum(ends - starts) < coords.shape[0] / 2
+        selected = np.zeros(coords.shape[0], dtype=bool)
+        for start, end in zip(starts, ends):
+            selected[start:end] = True
+        assert np.all(selected[mask])  # no particle within the box is missed
+        # periodic wrap: the box around x=1 also includes the last blocks
+        if center[0] == 1.0:
+            assert ends[-1] == coords.shape[0]
+
+    # non-periodic index spans the bounding box of the coordinates
+    index2 = GridIndex.build(da.from_array(coords), ngrid=8, blocksize=500)
+    assert not index2.periodic
+    assert index2.query_box([200.0, 50.0, 50.0], [10.0, 10.0, 10.0]).shape[0] == 0
+
+
+def test_gridindex_readwrite(tmp_path):
+    coords = np.random.default_rng(1).uniform(0.0, 10.0, size=(1000, 3))
+    index = GridIndex.build(da.from_array(coords), boxsize=10.0, ngrid=4, blocksize=100)
+    path = str(tmp_path / "index.hdf5")
+    index.write(path)
+    index2 = GridIndex.read(path)
+    for k in ["blockedges", "bboxes", "occupancy", "origin", "cellsize"]:
+        assert np.array_equal(getattr(index, k), getattr(index2, k))
+    assert index2.ngrid == 4 and index2.periodic
+    assert GridIndex.read(str(tmp_path / "missing.hdf5")) is None
+
+
+@pytest.mark.parametrize("units", [False, True, "cgs"])
+def test_rectangular_cutout(arepotestdata, monkeypatch, mocker, units):
+    monkeypatch.setenv("SCIDA_SPATIAL_INDEX_BLOCKSIZE", "100")
+    get_config(reload=True)
+    # indices built for other units are not reused
+    load(arepotestdata["snappath"], units=False).get_spatial_index("PartType0")
+    ds = load(arepotestdata["snappath"], units=units)
+    center, width = np.array([95.0, 50.0, 20.0]), np.array([20.0, 30.0, 30.0])
+    if units:
+        ureg = ds.data["PartType0"]["Coordinates"].units._REGISTRY
+        center, width = center * ureg.code_length, width * ureg.code_length
+    mask = ds.rectangular_cutout_mask(center, width, parttype="PartType0").compute()
+    cutout = ds.rectangular_cutout(center, width, parttype="PartType0")
+    assert cutout["Coordinates"].shape[0] == np.sum(mask) > 0
+    pids = ds.data["PartType0"]["ParticleIDs"][mask].compute()
+    assert np.array_equal(np.sort(cutout["ParticleIDs"].compute()), np.sort(pids))
+    if units:
+        assert cutout["Masses"].units == ds.data["PartType0"]["Masses"].units
+    index = ds.get_spatial_index("PartType0")
+    assert index.nblocks > 1
+    if units:
+        cunits = ds.data["PartType0"]["Coordinates"].units
+        starts, ends = index.get_ranges(index.query_box(center.to(cunits).magnitude, width.to(cunits).magnitude))
+    else:
+        starts, ends = index.get_ranges(index.query_box(center, width))
+    assert np.sum(ends - starts) < ds.data["PartType0"]["Coordinates"].shape[0]
+
+    # the index is built once and read from the cache directory afterwards
+    spy = mocker.spy(GridIndex, "build")
+    for _ in range(2):
+        ds = load(arepotestdata["snappath"], units=units)
+        ds.rectangular_cutout(center, width, parttype="PartType0")
+    assert spy.call_count == 0
+
+
+def _write_slab_coordinates(snappath, nfiles=4, boxsize=100.0):
+    """Shift the coordinates of the i-th file of the test snapshot into the i-th slab along x."""
+    for i in range(nfiles):
+        with h5py.File(os.path.join(snappath, "snap_099.%i.hdf5" % i), "r+") as hf:
+            for k in hf.keys():
+                if k.startswith("PartType") and "Coordinates" in hf[k]:
+                    coords = hf[k]["Coordinates"][()]
+                    coords[:, 0] = (coords[:, 0] + i * boxsize) / nfiles
+                    hf[k]["Coordinates"][:] = coords
+
+
+def test_zonemaps(arepotestdata, monkeypatch):
+    snappath = arepotestdata["snappath"]
+    _write_slab_coordinates(snappath)
+    ds = load(snappath)
+    assert ds.get_zonemaps() == dict()
+    assert ds.get_coordinate_zones("PartType0") is None
+
+    monkeypatch.setenv("SCIDA_CACHE_ZONEMAPS", "Coordinates,Masses")
+    get_config(reload=True)
+    ds.file.close()  # the cache file is modified below
+    ds = load(snappath)  # zone maps are added to the existing cache file
+    zonemaps = ds.get_zonemaps()
+    assert "/PartType0/Coordinates" in zonemaps and "/PartType1/Masses" in zonemaps
+    assert "/PartType0/ParticleIDs" not in zonemaps
+    coords = ds.data["PartType0"]["Coordinates"].compute()
+    coords = getattr(coords, "magnitude", coords)
+    zones = ds.get_coordinate_zones("PartType0")
+    assert zones["end"][-1] == coords.shape[0]
+    for start, end, lo, hi in zip(zones["start"], zones["end"], zones["min"], zones["max"]):
+        assert np.array_equal(lo, coords[start:end].min(axis=0))
+        assert np.array_equal(hi, coords[start:end].max(axis=0))
+
+    for center in [[10.0, 50.0, 50.0], [99.0, 50.0, 50.0]]:
+        width = [10.0, 40.0, 40.0]
+        keep = box_overlaps_bounds(center, width, zones["min"], zones["max"], boxsize=ds.boxsize)
+        assert 0 < np.sum(keep) < keep.shape[0]
+        mask = ds.rectangular_cutout_mask(center, width, parttype="PartType0")
+        ref = rectangular_cutout_mask(center, width, coords, boxsize=ds.boxsize, backend="numpy")
+        assert np.array_equal(mask.compute(), ref)
+
+    # zone maps of changed files are updated with the cache file
+    ds.file.close()
+    fn = os.path.join(snappath, "snap_099.0.hdf5")
+    with h5py.File(fn, "r+") as hf:
+        hf["PartType0"]["Coordinates"][0, 1] = 0.5
+    st = os.stat(fn)
+    os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    zones = load(snappath).get_coordinate_zones("PartType0")
+    assert zones["min"][0, 1] == 0.5
+
+
+def test_blocktree():
+    rng = np.random.default_rng(3)
+    coords = rng.uniform(0.0, 10.0, size=(2000, 3))
+    for boxsize in [None, 10.0]:
+        tree = BlockTree(coords, boxsize=boxsize, leafsize=8)
+        for center, radius, rmin in [
+            ([5.0, 5.0, 5.0], 2.0, None),
+            ([0.5, 9.5, 5.0], 1.5, 0.5),
+            ([1.0, 1.0, 1.0], 6.0, 1.0),
+        ]:
+            idx, dists = tree.query_ball(center, radius, rmin=rmin)
+            ref = periodic_distance(coords, center, boxsize)
+            expected = (ref < radius) & (ref >= (rmin or 0.0))
+            assert np.array_equal(idx, np.flatnonzero(expected))
+            assert np.allclose(dists, ref[expected])
+
+
+@pytest.mark.parametrize("units", [False, True, "cgs"])
+def test_spherical_queries(arepotestdata, monkeypatch, units):
+    monkeypatch.setenv("SCIDA_SPATIAL_INDEX_BLOCKSIZE", "100")
+    monkeypatch.setenv("SCIDA_SPATIAL_TREE_CACHE_SIZE", "8KiB")
+    get_config(reload=True)
+    ds = load(arepotestdata["snappath"], units=units)
+    coords = ds.data["PartType0"]["Coordinates"].compute()
+    coords = getattr(coords, "magnitude", coords)
+    pids = ds.data["PartType0"]["ParticleIDs"].compute()
+    # lengths in the units of the coordinates, the box size is 100 in code units
+    cunits = getattr(ds.data["PartType0"]["Coordinates"], "units", None)
+    scale = cunits._REGISTRY.Quantity(1.0, "code_length").to(cunits).magnitude if units else 1.0
+    boxsize = 100.0 * scale
+
+    center = np.array([98.0, 3.0, 50.0]) * scale  # sphere extends across periodic boundaries
+    r0, r1 = 10.0 * scale, 20.0 * scale
+    ref = periodic_distance(coords, center, boxsize)
+    assert 0 < np.sum(ref < r1) < coords.shape[0] // 10
+    idx, dists = ds.query_sphere(center, r1, parttype="PartType0")
+    assert idx.shape[0] > 0
+    assert np.array_equal(idx, np.flatnonzero(ref < r1))
+    assert np.allclose(dists, ref[idx])
+    nblocks = ds.get_spatial_index("PartType0").query_sphere(center, r1).shape[0]
+    assert len(ds._blocktrees) == nblocks or sum(t.nbytes for t in ds._blocktrees.values()) <= 8 * 1024
+
+    cutout = ds.spherical_cutout(center, r1, parttype="PartType0")
+    assert np.array_equal(cutout["ParticleIDs"].compute(), pids[ref < r1])
+    cutout = ds.shell_cutout(center, r0, r1, parttype="PartType0")
+    assert np.array_equal(cutout["ParticleIDs"].compute(), pids[(ref >= r0) & (ref < r1)])
+
+    idx, dists = ds.nearest_neighbors(center, k=5, parttype="PartType0")
+    assert np.array_equal(idx, np.argsort(ref, kind="stable")[:5])
+    if units:
+        assert dists.units == ds.data["PartType0"]["Coordinates"].units
+        dists = dists.magnitude
+    assert np.allclose(dists, np.sort(ref)[:5])
+    # more neighbors than particles returns all particles
+    idx, _ = ds.nearest_neighbors(center, k=coords.shape[0] + 10, parttype="PartType0")
+    assert idx.shape[0] == coords.shape[0]
+
+
+def test_boxbinning():
+    rng = np.random.default_rng(5)
+    coords = rng.uniform(0.0, 10.0, size=(3000, 3))
+    centers = rng.uniform(0.0, 10.0, size=(50, 3))
+    widths = rng.uniform(0.5, 3.0, size=(50, 3))
+    for boxsize in [None, 10.0]:
+        if boxsize is None:
+            binning = BoxBinning(centers, widths, np.zeros(3), 10.0)
+        else:
+            binning = BoxBinning(centers, widths, np.zeros(3), boxsize, boxsize=boxsize)
+        boxes, parts = binning.assign(coords)
+        for i in range(centers.shape[0]):
+            mask = rectangular_cutout_mask(
+                centers[i], widths[i], coords, pbc=boxsize is not None, boxsize=boxsize, backend="numpy"
+            )
+            assert np.array_equal(np.sort(parts[boxes == i]), np.flatnonzero(mask))
+
+
+@pytest.mark.filterwarnings("error::RuntimeWarning")  # e.g. overflowing cell indices
+@pytest.mark.parametrize("units", [False, True, "cgs"])
+def test_rectangular_cutouts(arepotestdata, monkeypatch, mocker, units):
+    monkeypatch.setenv("SCIDA_SPATIAL_INDEX_BLOCKSIZE", "100")
+    get_config(reload=True)
+    ds = load(arepotestdata["snappath"], units=units)
+    coords = ds.data["PartType0"]["Coordinates"].compute()
+    coords = getattr(coords, "magnitude", coords)
+    pids = ds.data["PartType0"]["ParticleIDs"].compute()
+    # lengths in the units of the coordinates, the box size is 100 in code units
+    cunits = getattr(ds.data["PartType0"]["Coordinates"], "units", None)
+    scale = cunits._REGISTRY.Quantity(1.0, "code_length").to(cunits).magnitude if units else 1.0
+    boxsize = 100.0 * scale
+    centers = np.array([[95.0, 50.0, 20.0], [5.0, 5.0, 5.0], [50.0, 50.0, 50.0], [500.0, 50.0, 50.0]]) * scale
+    widths = np.array([20.0, 10.0, 10.0]) * scale
+
+    spy = mocker.spy(BoxBinning, "assign")
+    cutouts = ds.rectangular_cutouts(centers, widths, parttype="PartType0")
+    assert len(cutouts) == centers.shape[0]
+    # each block is scanned at most once
+    assert spy.call_count <= ds.get_spatial_index("PartType0").nblocks
+    for i, idx in enumerate(cutouts):
+        mask = rectangular_cutout_mask(centers[i], widths, coords, boxsize=boxsize, backend="numpy")
+        assert np.array_equal(idx, np.flatnonzero(mask))
+        assert np.array_equal(cutouts.get_cutout(i)["ParticleIDs"].compute(), pids[mask])
+    assert cutouts.lengths[-1] == 0  # more than a box length outside, as for rectangular_cutout_mask
+    masses = cutouts.get_field("Masses").compute()
+    if units:
+        masses = masses.magnitude
+    ref = ds.data["PartType0"]["Masses"].compute()
+    ref = getattr(ref, "magnitude", ref)
+    assert np.array_equal(masses, ref[cutouts.indices])